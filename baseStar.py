@@ -18,11 +18,14 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-t", "--tempdir", help = "Force the program to try using a temporary directory.  The directory should not already exist.")
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
         parser.add_argument("-f", "--fileList", help = "List of files to operate on, separated by commas")
+        parser.add_argument("-o", "--output", help = "Write the combined data here instead of the default name in finalParts")
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         if not rawArgs.tempdir:
             raise RuntimeError("A temporary directory must be passed as an argument.  None was found.")
         if rawArgs.tempdir:
-            if not os.path.isdir:
+            if not os.path.isdir(rawArgs.tempdir):
                 raise RuntimeError("Specified temporary directory was not found.  " + rawArgs.tempdir)
             self.tempdir = rawArgs.tempdir
         else:
@@ -32,6 +35,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         if not fileList:
             raise RuntimeError("No file list given, nothing to operate on.")
         self.fileList = fileList.split(",")
+        self.output = rawArgs.output
 
 def addDataFromFile(file):
     import os
@@ -41,23 +45,31 @@ def addDataFromFile(file):
     inputFile = open(file,'rb')
     #if args.verbose:
         #print("Loading pickle")
-    data = pickle.load(inputFile)
+    with recorder.timing("pickleLoad"):
+        data = pickle.load(inputFile)
     inputFile.close()
+    recorder.readFile(file)
     #if args.verbose:
         #print("Loaded pickle.")
     for key in list(data.keys()):
         #if args.verbose:
         #    print("Key: " + key + ":" + str(len(data[key])))
+        if key in combinedData:  #with partials being merged into partials, a repeat would otherwise quietly overwrite a sample
+            raise RuntimeError("Sample name collision.  Two samples being entered with name " + key)
         combinedData[key] = data[key]
+        recorder.count("rowsRead", len(data[key]))
 
 def main():
     import datetime
     import os
     import pickle
     import random
+    import flightRecorder
     start = datetime.datetime.now()
     global args
     args = CheckArgs()
+    global recorder
+    recorder = flightRecorder.FlightRecorder("baseStar", args.tempdir, args.profile)
     global combinedData
     combinedData = {}
     progress = 0
@@ -68,10 +80,18 @@ def main():
         progress += 1
     if args.verbose:
         print("Added data from all " + str(len(args.fileList)) + " files.                                                   ")
-    outputFileName = args.tempdir + os.sep + "finalParts" + os.sep + args.fileList[0].split(os.sep)[-1] +".andFriends.scatter.pkl"
-    outputFile = open(outputFileName, 'wb')
-    pickle.dump(combinedData, outputFile)
+    if args.output:
+        outputFileName = args.output
+    else:
+        outputFileName = args.tempdir + os.sep + "finalParts" + os.sep + args.fileList[0].split(os.sep)[-1] +".andFriends.scatter.pkl"
+    outputFile = open(outputFileName + ".tmp", 'wb')
+    with recorder.timing("pickleDump"):
+        pickle.dump(combinedData, outputFile)
     outputFile.close()
+    os.rename(outputFileName + ".tmp", outputFileName)
+    recorder.count("rowsAccepted", sum([len(combinedData[key]) for key in combinedData]))
+    recorder.wroteFile(outputFileName)
+    recorder.finish()
     if args.verbose:
         runtime = datetime.datetime.now() - start
         print("Partial build process complete in " + str(runtime))
@@ -6,14 +6,12 @@ University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
 email: [myfirstname].[mylastname] AT ucla.edu
 '''
 
-global pythonInterpreterAbsolutePath
-pythonInterpreterAbsolutePath = "/u/local/apps/python/3.4.3/bin/python3"
-
 class CheckArgs():  #class that checks arguments and ultimately returns a validated set of arguments to the main program
     
     def __init__(self):
         import argparse
         import os
+        import dradis
         parser = argparse.ArgumentParser()
         parser.add_argument("-d", "--directory", help = "Directory of files to work with.")
         parser.add_argument("-c", "--minCoverage", help = "Minimum coverage", default = 10, type = int)
@@ -22,6 +20,12 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
         parser.add_argument("-s", "--contextRequirement", help = "Specify context sequence requirements (multiples can be passed separated by commas)")
         parser.add_argument("-e", "--contextExclusion", help = "Specify context sequence exclusions (multiples can be passed separated by commas)")
+        parser.add_argument("--maxCoverage", help = "Maximum coverage (0 for no ceiling)", default = 0, type = int)
+        parser.add_argument("--minRatio", help = "Drop loci with a ratio below this", type = float)
+        parser.add_argument("--maxRatio", help = "Drop loci with a ratio above this", type = float)
+        parser.add_argument("--contigAllow", help = "Only keep these contigs (names or patterns such as 1,2,X or GL*, separated by commas).  Names are matched with any chr dropped, as they appear in the output.")
+        parser.add_argument("--contigDeny", help = "Drop these contigs (names or patterns such as M,Un*,*_random, separated by commas).  Names are matched with any chr dropped, as they appear in the output.")
+        parser.add_argument("--regions", help = "BED file of target regions.  Loci outside them are dropped in filter 1, before anything is counted or indexed.")
         parser.add_argument("--sampleSize", help = "Specify how many lines from both the locus list and data set should be shown", default = 10, type = int)
         parser.add_argument("-r", "--minRepresentation", help = "Minimum percent of the time a specific locus needs to have been reported in samples", default = 75, type = int)
         parser.add_argument("-p", "--maxParallelJobs", help = "Maximum number of parallel array jobs allowed", default = 301, type = int)
@@ -29,11 +33,29 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("--directToCount", help = "Go directly to the counting step, pass the temporary directory to be used")
         parser.add_argument("--directToFilter2", help = "Go directly to the second filter step, pass the temporary directory to be used")
         parser.add_argument("--directToFinalBuild", help = "Go directly to the final build process")
-        parser.add_argument("-m", "--emptyCellMarker", help = "Marker for blank cells.", default = "")
+        parser.add_argument("-m", "--emptyCellMarker", help = "Marker for blank cells in the text table.  Missing values are NaN everywhere else, including pickle output.", default = "")
         parser.add_argument("-o", "--outputFile", help = "Specify the output file name.", default = "output.txt")
         parser.add_argument("-k", "--pickleOut", help = "Output to a Pandas pickle instead of a delimited text file.", action = 'store_true')
         parser.add_argument("-1", "--filter1RAM", help = "Specify (in GB) how much RAM to allocate for every parallel instance of filter 1", default = 4, type = int)
         parser.add_argument("--directToFilter1", help = "Skip prefilter step (assume it has already been done")
+        parser.add_argument("--cohortStore", help = "Keep every sample's filtered data, the locus counts and the result matrix in this directory, and only process samples that are new or changed since the last run")
+        parser.add_argument("--resume", help = "Pick up an interrupted run in this temporary directory, skipping every stage and sample whose results are still valid")
+        parser.add_argument("--executor", help = "Where to run the parallel jobs: sge for array jobs on the cluster, local for a pool of processes on this machine", default = "sge", choices = ["sge", "local"])
+        parser.add_argument("--localWorkers", help = "Maximum number of processes for the local executor (default: detected from cores and memory)", default = 0, type = int)
+        parser.add_argument("--pythonInterpreter", help = "Python interpreter used to launch each stage (default: the cluster python if present, otherwise this one)")
+        parser.add_argument("--sharedMatrix", help = "Have filter 2 jobs write straight into one preallocated on-disk result matrix instead of pickling per-sample lists", action = 'store_true')
+        parser.add_argument("--fanIn", help = "How many scatter partials each merge job combines when counts and data are reduced in rounds", default = 8, type = int)
+        parser.add_argument("--streamOutput", help = "Write the output table in blocks of rows, formatted in parallel, so memory does not grow with the size of the table", action = 'store_true')
+        parser.add_argument("--sparseOutput", help = "Carry only observed (locus, sample, ratio) entries through filter 2 and write the results as a sparse CSR file", action = 'store_true')
+        parser.add_argument("--outputStore", help = "Write the results as a chunked store directory that can be read a region at a time (see kobol.py) instead of a table", action = 'store_true')
+        parser.add_argument("--quantizeRatios", help = "Keep ratios as 16-bit integers (within 7.6e-6 of the original value) in the sample files, the shared result matrix, sparse output and the output store, halving their size.  Text output shows the dequantized values.", action = 'store_true')
+        parser.add_argument("--blockRows", help = "Rows per block when streaming the output table or writing an output store", default = 100000, type = int)
+        parser.add_argument("--shardedFinalBuild", help = "Skip the per-sample filter 2 and build the final table in locus shards (contig megabase groups), one job per shard with every sample, then join the shards in order", action = 'store_true')
+        parser.add_argument("--workStealing", help = "Queue one task per sample (or scatter group) and let the parallel workers pull tasks until the queue is empty, instead of fixing each job's files up front", action = 'store_true')
+        parser.add_argument("--metricsReport", help = "Write the per-stage metrics report (throughput, skew, rejections, slowest tasks) gathered from every worker to this JSON file")
+        parser.add_argument("--profile", help = "Run every worker under cProfile (cpu), or cProfile and tracemalloc (memory), and merge the results per stage", choices = ["cpu", "memory"])
+        parser.add_argument("--profileDirectory", help = "Where the merged per-stage profiles go (default: the output file name plus .profile)")
+        parser.add_argument("--prefilter", help = "Run the separate refinery prefilter on very large files instead of streaming them through filter 1", action = 'store_true')
         rawArgs = parser.parse_args()
         self.doPrefilter = True
         self.doFilter1 = True
@@ -58,7 +80,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             self.directory = False
         self.minCoverage = rawArgs.minCoverage
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 raise RuntimeError("Specified temporary directory already exists.  Please use one that that does not.  " + rawArgs.tempdir)
             self.tempdir = rawArgs.tempdir
         else:
@@ -74,10 +96,15 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             self.contextExclusion = [item.upper() for item in self.contextExclusion]
         else:
             self.contextExclusion = []
-        if self.contextExclusion and self.contextRequirement:  #why someone would specify both an inclusion and exclusion list is beyond me, but...
-            for item in self.contextRequirement:
-                if item in self.contextExclusion:
-                    raise RuntimeError("Error, " + item + " is included in both the requirement and exclusion lists.")
+        self.maxCoverage = rawArgs.maxCoverage
+        self.minRatio = rawArgs.minRatio
+        self.maxRatio = rawArgs.maxRatio
+        self.contigAllow = dradis.contigList(rawArgs.contigAllow)
+        self.contigDeny = dradis.contigList(rawArgs.contigDeny)
+        if rawArgs.regions and not os.path.isfile(rawArgs.regions):
+            raise RuntimeError("Region file not found: " + rawArgs.regions)
+        self.regions = os.path.abspath(rawArgs.regions) if rawArgs.regions else False
+        dradis.LocusFilter(self.minCoverage, self.maxCoverage, self.contextRequirement, self.contextExclusion, self.minRatio, self.maxRatio, self.contigAllow, self.contigDeny)  #raises here, before any jobs go out, if the filter options contradict each other
         self.sampleSize = rawArgs.sampleSize
         minRepresentation = rawArgs.minRepresentation
         if minRepresentation < 0 or minRepresentation > 100:
@@ -120,7 +147,16 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             if os.path.isdir(rawArgs.directToFinalBuild):
                 self.tempdir = rawArgs.directToFinalBuild
             else:
-                raise RuntimeError("Specified temporary directory for continuing does not exist: " + rawArgs.directToFilter2)
+                raise RuntimeError("Specified temporary directory for continuing does not exist: " + rawArgs.directToFinalBuild)
+        if rawArgs.resume:
+            if os.path.isdir(rawArgs.resume):
+                self.tempdir = rawArgs.resume
+            else:
+                raise RuntimeError("Specified temporary directory for resuming does not exist: " + rawArgs.resume)
+        self.resume = bool(rawArgs.resume)
+        if rawArgs.cohortStore and (rawArgs.directToCount or rawArgs.directToFilter2 or rawArgs.directToFinalBuild):
+            raise RuntimeError("The cohort store keeps its own record of what has been done.  Please do not combine it with the directTo flags.")
+        self.cohortStore = rawArgs.cohortStore
         self.noCleanUp = False
         if rawArgs.noCleanUp:
             self.noCleanUp = True
@@ -147,15 +183,53 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             outputFile = outputFile.replace(".txt",".pandas.pkl")
         else:
             self.pickleOut = False
-        if os.path.isfile(outputFile):
+        if rawArgs.outputStore:
+            if rawArgs.pickleOut or rawArgs.streamOutput:
+                raise RuntimeError("An output store replaces the table, so it cannot be combined with pickle or streaming output.")
+            outputFile = outputFile.replace(".txt",".store")
+            if os.path.isfile(outputFile):
+                raise RuntimeError("Output store path is an existing file: " + outputFile)
+        self.outputStore = rawArgs.outputStore
+        if rawArgs.sparseOutput:
+            if rawArgs.pickleOut or rawArgs.streamOutput or rawArgs.outputStore or rawArgs.sharedMatrix or rawArgs.cohortStore:
+                raise RuntimeError("Sparse output is its own output format.  It cannot be combined with pickle, streaming, store, shared matrix or cohort output.")
+            outputFile = outputFile.replace(".txt",".sparse.npz")
+        self.sparseOutput = rawArgs.sparseOutput
+        if rawArgs.shardedFinalBuild and (rawArgs.streamOutput or rawArgs.outputStore or rawArgs.sharedMatrix or rawArgs.sparseOutput or rawArgs.cohortStore):
+            raise RuntimeError("A sharded final build reads the filter 1 results itself.  It cannot be combined with streaming, store, shared matrix, sparse or cohort output.")
+        self.shardedFinalBuild = rawArgs.shardedFinalBuild
+        if os.path.isfile(outputFile) or os.path.isdir(outputFile):
             print("Warning: Output file already exists.")
             if not yesAnswer("Overwrite existing file?"):
                 quit("By your command")
         self.outputFile = outputFile
+        if rawArgs.streamOutput and rawArgs.pickleOut:
+            raise RuntimeError("Streaming output writes a text table.  It cannot be combined with pickle output.")
+        self.streamOutput = rawArgs.streamOutput
+        if rawArgs.blockRows < 1:
+            raise RuntimeError("Block size must be at least one row.  We got: " + str(rawArgs.blockRows))
+        self.blockRows = rawArgs.blockRows
+        self.quantizeRatios = rawArgs.quantizeRatios
+        self.metricsReport = rawArgs.metricsReport
+        self.profile = rawArgs.profile
+        self.profileDirectory = rawArgs.profileDirectory or outputFile + ".profile"
         filter1RAM = rawArgs.filter1RAM
         if filter1RAM < 1 or filter1RAM > 16:
             raise RuntimeError("Excessive RAM requested for first filter job.")
         self.filter1RAM = filter1RAM
+        self.prefilter = rawArgs.prefilter
+        self.sharedMatrix = rawArgs.sharedMatrix
+        self.workStealing = rawArgs.workStealing
+        if rawArgs.fanIn < 2:
+            raise RuntimeError("Fan in must be at least 2.  We got: " + str(rawArgs.fanIn))
+        self.fanIn = rawArgs.fanIn
+        self.executor = rawArgs.executor
+        if rawArgs.localWorkers < 0:
+            raise RuntimeError("Local worker count cannot be negative.  We got: " + str(rawArgs.localWorkers))
+        self.localWorkers = rawArgs.localWorkers
+        if rawArgs.pythonInterpreter and not os.path.isfile(rawArgs.pythonInterpreter):
+            raise RuntimeError("Specified python interpreter was not found: " + rawArgs.pythonInterpreter)
+        self.pythonInterpreter = rawArgs.pythonInterpreter
 
 def displaySplash():
     print("   ___       _   _   _      __ _             ")
@@ -186,23 +260,23 @@ def createTempDir():  #makes a temporary directory for this run.  Completions wi
         except OSError:  #if it doesn't work
             continue  #go back and try again
         successful = True  #otherwise, set successful to true, return to the start of the loop, and exit
-    os.mkdir(tempdir + os.sep + "filter1")  #make a bunch of subdirectories in the tempdir 
-    os.mkdir(tempdir + os.sep + "filter2")
-    os.mkdir(tempdir + os.sep + "loci")
-    os.mkdir(tempdir + os.sep + "lociGather")
-    os.mkdir(tempdir + os.sep + "lociClockOut")
-    os.mkdir(tempdir + os.sep + "filter1ClockOut")
-    os.mkdir(tempdir + os.sep + "filter2ClockOut")
-    os.mkdir(tempdir + os.sep + "bashFiles")
-    os.mkdir(tempdir + os.sep + "finalParts")
-    os.mkdir(tempdir + os.sep + "finalPartsClockOut")
-    os.mkdir(tempdir + os.sep + "prefilter")
-    os.mkdir(tempdir + os.sep + "prefilterClockOut")
+    makeTempSubdirectories(tempdir)
     return tempdir
+
+def makeTempSubdirectories(tempdir):  #make a bunch of subdirectories in the tempdir.  Anything already there (from a run we are resuming) is left alone.
+    import os
+    if not os.path.isdir(tempdir):
+        os.mkdir(tempdir)
+    for subdirectory in ["filter1", "filter2", "loci", "lociGather", "lociClockOut", "filter1ClockOut", "filter2ClockOut", "bashFiles", "finalParts", "finalPartsClockOut", "prefilter", "prefilterClockOut", "metrics", "profiles"]:
+        if not os.path.isdir(tempdir + os.sep + subdirectory):
+            os.mkdir(tempdir + os.sep + subdirectory)
     
-def getFilter1FileList():  #function to get a list of files for our first filter
+def getFilter1FileList(tempdir):  #function to get a list of files for our first filter.  Returns the job list and the manifest key for every sample, leaving out samples whose filter 1 results are still valid.
     import os  #import the library for making os system calls
-    import operator
+    import fleetCommand
+    import colonialOne
+    import pegasus
+    import tylium
     if args.directory:  #if the user specified a directory to work on
         directory = args.directory  #use that directory
     else:  #otherwise
@@ -210,169 +284,172 @@ def getFilter1FileList():  #function to get a list of files for our first filter
     if not directory.endswith(os.sep):  #if the directory does not end with a slash or backslash (depending on operating system)
         directory += os.sep #if not, add one
     rawFileList = os.listdir(directory)  #get a list of files in that directory
-    for i in range(0,len(rawFileList)):
-        rawFileList[i] = [rawFileList[i], os.path.getsize(directory + rawFileList[i])]
-    rawFileList = sorted(rawFileList, key = operator.itemgetter(1), reverse = True)
-    for i in range(0,len(rawFileList)):
-        rawFileList[i] = rawFileList[i][0]
     filteredFileList = []  #initialize an empty list for storing the files we are interested in
     for file in rawFileList:  #go through the files in the directory
-        if file.endswith(".ratio"):  #if they end with .ratio
+        if tylium.isRatioFile(file):  #if they end with .ratio (or .ratio.gz)
             filteredFileList.append(directory + file)  #add them on to the list of files we are interested in
-    if len(filteredFileList) < args.maxParallelJobs:  #if there are fewer files than permitted parallel jobs
+    if not filteredFileList:
+        raise RuntimeError("No data files to process for filter 1.")
+    taskKeys = {}
+    pendingFileList = []
+    for file in filteredFileList:
+        sample = colonialOne.sampleName(file)
+        taskKeys[sample] = pegasus.inputKey(filter1Parameters(), [file])
+        if cohort and cohort.sampleKey(sample) == taskKeys[sample]:  #already in the cohort store, made from this same file
+            continue
+        if not manifest.taskComplete("filter1", sample, taskKeys[sample]):
+            pendingFileList.append(file)
+    if args.verbose and len(pendingFileList) < len(filteredFileList):
+        print(str(len(filteredFileList) - len(pendingFileList)) + " of " + str(len(filteredFileList)) + " samples already have valid filter 1 results.")
+    filteredFileList = pendingFileList
+    if len(filteredFileList) < args.maxParallelJobs or args.workStealing:  #if there are fewer files than permitted parallel jobs (or workers will pull files one at a time)
         parallelJobs = len(filteredFileList) #set the limit on parallel jobs to the number of files
-    fileJobList = []  #initialize an empty list of jobs to parallelize filter 1
-    for i in range(0,parallelJobs):
-        fileJobList.append([])  #this loop puts a number of empty lists in our job list equal to our number of parallel jobs
-    for i in range(0,len(filteredFileList)):  #for every file we need to filter at the step
-        fileJobList[i % parallelJobs].append(filteredFileList[i])  #add files to our job list for each job 
-    return fileJobList  #return the list of job files, where each element is a list of files for a job to handle
+    else:
+        parallelJobs = args.maxParallelJobs
+    fileSizes = [tylium.estimatedRatioBytes(file) for file in filteredFileList]  #file size is our estimate of how long a file will take.  Compressed files count at their estimated uncompressed size.
+    fileJobList, jobSizes = fleetCommand.packBySize(filteredFileList, fileSizes, parallelJobs)  #biggest files first, each to the least loaded job, so no one job ends up with several of the largest samples
+    if args.verbose and fileJobList:
+        print("Packed " + str(len(filteredFileList)) + " files into " + str(len(fileJobList)) + " jobs.  Largest job: " + str(max(jobSizes)) + " bytes.  Smallest job: " + str(min(jobSizes)) + " bytes.")
+    return (fileJobList, taskKeys)  #return the list of job files, where each element is a list of files for a job to handle
+
+def filter1Parameters():  #everything that changes what filter 1 writes for a sample
+    import pegasus
+    parameters = {"minCoverage" : args.minCoverage,
+                  "contextRequirement" : args.contextRequirement,
+                  "contextExclusion" : args.contextExclusion,
+                  "quantizeRatios" : args.quantizeRatios}
+    if args.maxCoverage:  #filters left off do not change the key, so samples filtered before these options existed are still valid
+        parameters["maxCoverage"] = args.maxCoverage
+    if args.minRatio is not None:
+        parameters["minRatio"] = args.minRatio
+    if args.maxRatio is not None:
+        parameters["maxRatio"] = args.maxRatio
+    if args.contigAllow:
+        parameters["contigAllow"] = args.contigAllow
+    if args.contigDeny:
+        parameters["contigDeny"] = args.contigDeny
+    if args.regions:
+        parameters["regions"] = [args.regions, pegasus.fileSignature(args.regions)]
+    return parameters
+
+def regionIndexFileName(tempdir):
+    import os
+    return tempdir + os.sep + "loci" + os.sep + "regions.npz"
+
+def buildRegionIndex(tempdir):  #parses the BED file once here instead of once in every filter 1 job
+    import os
+    import dradis
+    regions = dradis.RegionIndex.fromBed(args.regions)
+    if args.verbose:
+        print("Restricting loci to " + str(len(regions)) + " target intervals covering " + str(regions.coveredBases()) + " bases.")
+    regions.save(regionIndexFileName(tempdir) + ".tmp")
+    os.rename(regionIndexFileName(tempdir) + ".tmp", regionIndexFileName(tempdir))
+
+def filterArguments(tempdir):  #the locus filter options added to the refinery and viper commands
+    arguments = {"--maxCoverage" : str(args.maxCoverage) if args.maxCoverage else False,
+                 "--contigAllow" : ",".join(args.contigAllow),
+                 "--contigDeny" : ",".join(args.contigDeny),
+                 "--regions" : regionIndexFileName(tempdir) if args.regions else False}
+    if args.minRatio is not None:
+        arguments["--minRatio"] = str(args.minRatio)
+    if args.maxRatio is not None:
+        arguments["--maxRatio"] = str(args.maxRatio)
+    return arguments
+
+def filter1OutputFiles(fileName, tempdir):  #what viper.py writes for this input file
+    import os
+    import colonialOne
+    sampleFileName = tempdir + os.sep + "filter1" + os.sep + fileName.split(os.sep)[-1] + colonialOne.sampleSuffix
+    return [sampleFileName, colonialOne.headerFileName(sampleFileName)]
+
+def filter1SampleFiles(tempdir):  #the sample files of every sample in this run with finished filter 1 results, in a fixed order
+    import colonialOne
+    return sorted([file for file in manifest.completedOutputs("filter1") if file.endswith(colonialOne.sampleSuffix)])
 
 
 def runPrefilter(fileList, tempdir):  #function to run a less optimized prefilter on very large files to avoid memory errors from running things in RAM
     import os  #import the library for making system calls
+    import fleetCommand
+    import tylium
     prefilterFileList = []
     for line in fileList:
         for file in line:        
-            if os.path.getsize(file) > (args.filter1RAM * 1000000000) / 10:
+            if tylium.estimatedRatioBytes(file) > (args.filter1RAM * 1000000000) / 10:
                 prefilterFileList.append(file)
     if not prefilterFileList:
         return fileList
-    prefilterFiles = []
     if len(prefilterFileList) > args.maxParallelJobs:
         parallelJobs = args.maxParallelJobs
     else:
         parallelJobs = len(prefilterFileList)
-    for i in range(0, parallelJobs):
-        prefilterFiles.append([])
-    for i in range(0, len(prefilterFileList)):
-        prefilterFiles[i % parallelJobs].append(prefilterFileList[i])
+    prefilterFiles = fleetCommand.packBySize(prefilterFileList, [tylium.estimatedRatioBytes(file) for file in prefilterFileList], parallelJobs)[0]
     if args.doPrefilter:
-        if not os.path.isdir("schedulerOutput"):  #if there is no directory for grabbing the scheduler output
-            os.mkdir("schedulerOutput")  #create one
-        wrapperRunnerName = tempdir + os.sep + "bashFiles" + os.sep + "wrapper.sh"  #define a filename for running the parallel job wrapper
-        wrapperRunner = open(wrapperRunnerName, 'w')  #open the bash file for running the wrapper
-        wrapperRunner.write("#!/bin/bash\n")  #write the first line to the wrapper's bash file
-        wrapperRunner.write(pythonInterpreterAbsolutePath + " raptor.py " + "--tempdir " + tempdir + " --clockOutDir " + tempdir + os.sep + "prefilterClockOut")  #write the actual instructions to the wrapper's bash file
-        wrapperRunner.close()  #close the wrapper bash file
-        clockOutFlush(tempdir + os.sep + "prefilterClockOut")  #make sure that there are no pre-existing clock out files in the clockout directory
+        argumentStrings = []
         for i in range(0,len(prefilterFiles)):  #go through the list of job files
             arguments = {"--fileList" : ",".join(prefilterFiles[i]), #create a comma separated string of all the files for this job  
                          "--minCoverage" : str(args.minCoverage),  #grab the minimum coverage requirement from arguments
                          "--tempdir" : tempdir,  #set the temporary directory
                          "--contextRequirement" : ",".join(args.contextRequirement),  #set the context requirements 
                          "--contextExclusion" : ",".join(args.contextExclusion)}
-            argumentList = []  #initialize an empty argument list
-            for key in list(arguments.keys()):  #iterate over keys in arguments
-                if arguments[key]:  #if there is a value set for that key
-                    argumentList.append(key + " " + arguments[key])  #add the key and value to the arguments list
-            argumentString = " ".join(argumentList)  #create the argument string by joining the argument list with a space separating the elements
-            if i == 0:  #if this is the first parallel job
-                if args.verbose:  #if the user wants to see output 
-                    argumentString += " -v"  #add the verbose argument to this one
-                thisNodesJob = pythonInterpreterAbsolutePath + " refinery.py " + argumentString  #set this node's job to the commandline we just created
-            else:  #for all other (not the first) parallel jobs
-                bashFileName = tempdir + os.sep + "bashFiles" + os.sep + str(i) + ".sh"  #make a string with the name of the bash file containing the command for the job
-                bashFile = open(bashFileName, 'w')  #open that bash file
-                bashFile.write("#!/bin/bash\n")  #write the first line of the bash file
-                bashFile.write(pythonInterpreterAbsolutePath + " refinery.py " + argumentString)  #write the actual command for the program
-                bashFile.close()  #close the bash file
-        jobRange = "1-" + str(len(prefilterFiles)-1) + " "  #creates an empty string for job range
-        if len(prefilterFiles) > 1:
-            command = "qsub -cwd -V -N Refinery -l h_data=1G,time=23:59:00 -e " + os.getcwd() +  "/schedulerOutput/ -o " + os.getcwd() + "/schedulerOutput/ " + "-t " + jobRange + wrapperRunnerName  #create a command line to submit an array job to SGE
-            if args.verbose:
-                print("BASH " + command)
-            os.system(command)  #run the qsub command to create an array job for filter 1
-        if args.verbose:
-            print("Starting the job on this node.")
-            print("BASH " + thisNodesJob)
-        os.system(thisNodesJob)  #run the commandline for this node's job
-        if args.verbose:
-            print("Monitoring other node prefilter jobs.")
-        if len(prefilterFiles) > 1:
-            monitorJobs(tempdir + os.sep + "prefilterClockOut", len(prefilterFiles))  #start the job monitor
+            arguments.update(filterArguments(tempdir))
+            argumentStrings.append(fleetCommand.makeArgumentString(arguments))
+        executor.runJobs("Refinery", "refinery.py", argumentStrings, "prefilterClockOut", memoryGB = 1)
     for i in range(0, len(fileList)):
         for j in range(0, len(fileList[i])):
             if fileList[i][j] in prefilterFileList:
                 fileList[i][j] = tempdir + os.sep + "prefilter" + os.sep + fileList[i][j].split(os.sep)[-1] + ".prefilter.ratio"
     return fileList
 
-def runFilter1(fileList, tempdir):  #function to run the first filter (on items that are strictly within a single file)
-    import os  #import the library for making system calls
-    if not os.path.isdir("schedulerOutput"):  #if there is no directory for grabbing the scheduler output
-        os.mkdir("schedulerOutput")  #create one
-    wrapperRunnerName = tempdir + os.sep + "bashFiles" + os.sep + "wrapper.sh"  #define a filename for running the parallel job wrapper
-    wrapperRunner = open(wrapperRunnerName, 'w')  #open the bash file for running the wrapper
-    wrapperRunner.write("#!/bin/bash\n")  #write the first line to the wrapper's bash file
-    wrapperRunner.write(pythonInterpreterAbsolutePath + " raptor.py " + "--tempdir " + tempdir + " --clockOutDir " + tempdir + os.sep + "filter1ClockOut")  #write the actual instructions to the wrapper's bash file
-    wrapperRunner.close()  #close the wrapper bash file
-    clockOutFlush(tempdir + os.sep + "filter1ClockOut")  #make sure that there are no pre-existing clock out files in the clockout directory
+def runFilter1(fileList, tempdir, taskKeys):  #function to run the first filter (on items that are strictly within a single file)
+    import fleetCommand
+    import colonialOne
+    import tylium
+    taskOutputs = {}
+    for line in fileList:
+        for file in line:
+            taskOutputs[colonialOne.sampleName(file)] = filter1OutputFiles(file, tempdir)
+    manifest.startTasks("filter1", taskOutputs, taskKeys)
+    memoryList = []
+    for i in range(0,len(fileList)):  #each job asks for what its largest file needs instead of everyone getting filter1RAM
+        memoryList.append(fleetCommand.estimateFilter1MemoryGB(max([tylium.estimatedRatioBytes(file) for file in fileList[i]]), args.filter1RAM))
+    if not args.workStealing:  #a queue is already biggest first, which is the order we want tasks claimed in
+        fileList, memoryList = fleetCommand.orderForArrayJob(fileList, memoryList)
+    argumentStrings = []
     for i in range(0,len(fileList)):  #go through the list of job files
         arguments = {"--fileList" : ",".join(fileList[i]), #create a comma separated string of all the files for this job  
                      "--minCoverage" : str(args.minCoverage),  #grab the minimum coverage requirement from arguments
                      "--tempdir" : tempdir,  #set the temporary directory
                      "--contextRequirement" : ",".join(args.contextRequirement),  #set the context requirements 
                      "--contextExclusion" : ",".join(args.contextExclusion),  #set the context exclusion
-                     "--sampleSize" : str(args.sampleSize)}
-        argumentList = []  #initialize an empty argument list
-        for key in list(arguments.keys()):  #iterate over keys in arguments
-            if arguments[key]:  #if there is a value set for that key
-                argumentList.append(key + " " + arguments[key])  #add the key and value to the arguments list
-        argumentString = " ".join(argumentList)  #create the argument string by joining the argument list with a space separating the elements
-        if i == 0:  #if this is the first parallel job
-            if args.verbose:  #if the user wants to see output 
-                argumentString += " -v"  #add the verbose argument to this one
-            thisNodesJob = pythonInterpreterAbsolutePath + " viper.py " + argumentString  #set this node's job to the commandline we just created
-        else:  #for all other (not the first) parallel jobs
-            bashFileName = tempdir + os.sep + "bashFiles" + os.sep + str(i) + ".sh"  #make a string with the name of the bash file containing the command for the job
-            bashFile = open(bashFileName, 'w')  #open that bash file
-            bashFile.write("#!/bin/bash\n")  #write the first line of the bash file
-            bashFile.write(pythonInterpreterAbsolutePath + " viper.py " + argumentString + " -v")  #write the actual command for the program
-            bashFile.close()  #close the bash file
-    jobRange = "1-" + str(len(fileList)) + " "  #creates an empty string for job range
-    if len(fileList) > 1:
-        command = "qsub -cwd -V -N Vipers -l h_data=" + str(args.filter1RAM) + "G,time=23:59:00 -e " + os.getcwd() +  "/schedulerOutput/ -o " + os.getcwd() + "/schedulerOutput/ " + "-t " + jobRange + wrapperRunnerName  #create a command line to submit an array job to SGE
-        if args.verbose:
-            print("BASH " + command)
-        os.system(command)  #run the qsub command to create an array job for filter 1
-    if args.verbose:
-        print("Starting the job on this node.")
-        print("BASH " + thisNodesJob)
-    os.system(thisNodesJob)  #run the commandline for this node's job
-    if args.verbose:
-        print("Monitoring other node filtering and extraction jobs.")
-    if len(fileList) > 1:
-        monitorJobs(tempdir + os.sep + "filter1ClockOut", len(fileList))  #start the job monitor
-    
-def monitorJobs(clockOutDirectory, jobCount):
-    import os
-    import time
-    done = False  #initialize this variable to False
-    completed = 1  #one job should already be done on this one
-    jobList = []  #initialize an empty list for jobList
-    for i in range(1,jobCount):  #for each job we have
-        jobList.append([i,False])  #add a list to the list of jobs that has job number and job's done status (initially false)
-    while not done:
-        if args.verbose:
-            print("Completed " + str(completed) + " of " + str(jobCount) + " jobs.       ", end = "\r")  #display a counter without writing a new line
-        for i in range(0,len(jobList)):  #for each job in the list of parallel jobs
-            if not jobList[i][1]:  #if it is not already marked as done
-                if os.path.isfile(clockOutDirectory + os.sep + str(jobList[i][0])):  #check if the job of that number (in index 0) now has a clock out file
-                    jobList[i][1] = True  #set the done marker to true
-                    completed += 1  #add one more job completed to our count
-                    if completed == len(jobList) + 1:  #if our completed count is equal to our number of jobs
-                        done = True  #set done to true
-                        break
-        time.sleep(1)  #after going through all the files, wait a second before starting again
-    if args.verbose:
-        print("Completed " + str(completed) + " of " + str(jobCount) + " jobs.       ")
-        
-def clockOutFlush(clockOutDir):
+                     "--sampleSize" : str(args.sampleSize),
+                     "--memoryCeiling" : str(memoryList[i] * 0.75),  #leave some headroom under what the scheduler gives us
+                     "--quantizeRatios" : args.quantizeRatios}
+        arguments.update(filterArguments(tempdir))
+        argumentStrings.append(fleetCommand.makeArgumentString(arguments))
+    try:
+        if args.workStealing:
+            executor.runQueue("Vipers", "viper.py", argumentStrings, "filter1ClockOut", args.maxParallelJobs, memoryGB = memoryList)
+        else:
+            executor.runJobs("Vipers", "viper.py", argumentStrings, "filter1ClockOut", memoryGB = memoryList)
+    finally:
+        manifest.settleTasks("filter1")  #whatever finished before a failure does not need to run again
+
+def recordExistingSamples(tempdir):  #for the directTo flags: trust the filter 1 results already in the tempdir
     import os
-    import shutil
-    shutil.rmtree(clockOutDir)
-    os.mkdir(clockOutDir) 
-        
+    import colonialOne
+    import pegasus
+    taskOutputs = {}
+    for file in sorted(os.listdir(tempdir + os.sep + "filter1")):
+        if file.endswith(colonialOne.sampleSuffix):
+            sampleFileName = tempdir + os.sep + "filter1" + os.sep + file
+            taskOutputs[colonialOne.sampleName(file)] = [sampleFileName, colonialOne.headerFileName(sampleFileName)]
+    manifest.startTasks("filter1", taskOutputs, dict([(sample, "existing") for sample in taskOutputs]))
+    for sample in taskOutputs:
+        entry = manifest.tasks["filter1"][sample]
+        entry["outputs"] = dict([(fileName, pegasus.fileSignature(fileName)) for fileName in entry["outputs"]])
+        entry["complete"] = True
+    manifest.save()
+
 def bashFileFlush(tempdir):
     import os
     import shutil
@@ -380,31 +457,53 @@ def bashFileFlush(tempdir):
     shutil.rmtree(bashFileDirectory)
     os.mkdir(bashFileDirectory)    
         
+def partialsFlush(tempdir, subdirectory):  #empties a directory the scatter jobs gather into, since the stage gathers every partial it finds there and an earlier attempt's (or an earlier grouping's) would be counted again
+    import os
+    import shutil
+    partialsDirectory = tempdir + os.sep + subdirectory
+    if os.path.isdir(partialsDirectory):
+        shutil.rmtree(partialsDirectory)
+    os.mkdir(partialsDirectory)
+
 def countRepresentation(tempdir):
     import os
+    import fleetCommand
+    import pegasus
+    key = pegasus.inputKey({"minRepresentation" : args.minRepresentation}, filter1SampleFiles(tempdir))
+    if manifest.stageComplete("count", key):
+        if args.verbose:
+            print("Locus counts are still valid, skipping the counting step.")
+        return
+    partialsFlush(tempdir, "lociGather")
     arguments = {"--minRepresentation" : str(args.minRepresentation),
                  "--tempdir" : tempdir}
-    argumentList = []
-    for key in list(arguments.keys()):
-        if arguments[key]:
-            argumentList.append(key + " " + arguments[key])
-    argumentString = " ".join(argumentList)
-    command = pythonInterpreterAbsolutePath + " blackbird.py " + argumentString
-    if args.verbose:
-        command += " -v"
-        print("BASH " + command)
-    os.system(command)
+    arguments.update(executorArguments())
+    executor.runHere("blackbird.py", fleetCommand.makeArgumentString(arguments))
+    manifest.recordStage("count", key, [tempdir + os.sep + "loci" + os.sep + "acceptedLoci.npz"])
+
+def executorArguments():  #lets the stages that scatter their own jobs use the same executor we are using
+    arguments = {"--executor" : args.executor,
+                 "--localWorkers" : str(args.localWorkers),
+                 "--pythonInterpreter" : executor.pythonInterpreter,
+                 "--maxParallelJobs" : str(args.maxParallelJobs),
+                 "--fanIn" : str(args.fanIn)}
+    if args.workStealing:
+        arguments["--workStealing"] = True
+    return arguments
     
 def getFilter2FileList(tempdir):
     import os
+    import colonialOne
     directory = tempdir + os.sep + "filter1"
     rawFileList = os.listdir(directory)
     filteredFileList = []
-    for file in rawFileList:
-        if file.endswith(".data.pkl"):
+    for file in sorted(rawFileList):  #sorted so that a resumed run groups the files the same way
+        if file.endswith(colonialOne.sampleSuffix):
             filteredFileList.append(directory + os.sep + file)
-    if len(filteredFileList) < args.maxParallelJobs:
+    if len(filteredFileList) < args.maxParallelJobs or args.workStealing:
         args.parallelJobs = len(filteredFileList)
+    else:
+        args.parallelJobs = args.maxParallelJobs
     fileJobList = []
     for i in range(0,args.parallelJobs):
         fileJobList.append([])
@@ -414,46 +513,58 @@ def getFilter2FileList(tempdir):
 
 def runFilter2(fileList, tempdir):
     import os
-    if not os.path.isdir("schedulerOutput"):
-        os.mkdir("schedulerOutput")
-    wrapperRunnerName = tempdir + os.sep + "bashFiles" + os.sep + "wrapper.sh"
-    wrapperRunner = open(wrapperRunnerName, 'w')
-    wrapperRunner.write("#!/bin/bash\n")
-    wrapperRunner.write(pythonInterpreterAbsolutePath + " raptor.py " + "--tempdir " + tempdir + " --clockOutDir " + tempdir + os.sep + "filter2ClockOut")
-    wrapperRunner.close()
-    clockOutFlush(tempdir + os.sep + "filter2ClockOut")
+    import fleetCommand
+    import colonialOne
+    import pegasus
+    taskOutputs = {}
+    if not args.sharedMatrix:  #each job pickles its results under the name of its last file, so a job that still has a valid pickle can be skipped
+        taskKeys = {}
+        pendingFileList = []
+        for line in fileList:
+            outputFile = tempdir + os.sep + "filter2" + os.sep + line[-1].split(os.sep)[-1].replace(colonialOne.sampleSuffix, filter2Suffix())
+            taskName = outputFile.split(os.sep)[-1]
+            if args.sparseOutput:  #one file per sample rather than one per job
+                taskOutputs[taskName] = [tempdir + os.sep + "filter2" + os.sep + file.split(os.sep)[-1].replace(colonialOne.sampleSuffix, filter2Suffix()) for file in line]
+            else:
+                taskOutputs[taskName] = [outputFile]
+            taskKeys[taskName] = pegasus.inputKey(filter2Parameters(), line + acceptedIndexFiles(tempdir))
+            if not manifest.taskComplete("filter2", taskName, taskKeys[taskName]):
+                pendingFileList.append(line)
+        pegasus.removeStrays(tempdir + os.sep + "filter2", filter2Suffix(), sum([taskOutputs[taskName] for taskName in taskOutputs if manifest.taskComplete("filter2", taskName, taskKeys[taskName])], []))  #leftovers from other groupings would otherwise be read twice by the final build
+        if args.verbose and len(pendingFileList) < len(fileList):
+            print(str(len(fileList) - len(pendingFileList)) + " of " + str(len(fileList)) + " filter 2 jobs already have valid results.")
+        fileList = pendingFileList
+        manifest.startTasks("filter2", dict([(taskName, taskOutputs[taskName]) for taskName in taskOutputs if not manifest.taskComplete("filter2", taskName, taskKeys[taskName])]), taskKeys)
+    argumentStrings = []
     for i in range(0,len(fileList)):
         arguments = {"--fileList" : ",".join(fileList[i]),
                      "--tempdir" : tempdir}
-        argumentList = []
-        for key in list(arguments.keys()):
-            if arguments[key]:
-                argumentList.append(key + " " + arguments[key])
-        argumentString = " ".join(argumentList)
-        if i == 0:
-            if args.verbose:
-                argumentString += " -v"
-            thisNodesJob = pythonInterpreterAbsolutePath + " cylonRaider.py " + argumentString
+        if args.sharedMatrix:
+            arguments["--resultMatrix"] = resultMatrixBaseName(tempdir)
+        if args.sparseOutput:
+            arguments["--sparse"] = True
+            arguments["--quantizeRatios"] = args.quantizeRatios
+        argumentStrings.append(fleetCommand.makeArgumentString(arguments))
+    try:
+        if args.workStealing:
+            executor.runQueue("CylonRaiders", "cylonRaider.py", argumentStrings, "filter2ClockOut", args.maxParallelJobs, memoryGB = 4)
         else:
-            bashFileName = tempdir + os.sep + "bashFiles" + os.sep + str(i) + ".sh"
-            bashFile = open(bashFileName, 'w')
-            bashFile.write("#!/bin/bash\n")
-            bashFile.write(pythonInterpreterAbsolutePath + " cylonRaider.py " + argumentString)
-            bashFile.close()
-    jobRange = "1-" + str(len(fileList)) + " "
-    command = "qsub -cwd -V -N CylonRaiders -l h_data=4G,time=23:59:00 -e " + os.getcwd() +  "/schedulerOutput/ -o " + os.getcwd() + "/schedulerOutput/ " + "-t " + jobRange + wrapperRunnerName
-    if len(fileList) > 1:
-        if args.verbose:
-            print("BASH " + command)
-        os.system(command)
-    if args.verbose:
-        print("Starting the job on this node.")
-        print("BASH " + thisNodesJob)
-    os.system(thisNodesJob)
-    if args.verbose:
-        print("Monitoring other nodes representation filtering jobs.")
-    if len(fileList) > 1:
-        monitorJobs(tempdir + os.sep + "filter2ClockOut", len(fileList))
+            executor.runJobs("CylonRaiders", "cylonRaider.py", argumentStrings, "filter2ClockOut", memoryGB = 4)
+    finally:
+        if not args.sharedMatrix:
+            manifest.settleTasks("filter2")
+    return sum(list(taskOutputs.values()), [])  #the files the final build should read
+
+def filter2Parameters():
+    return {"missingValues" : "NaN",  #filter 2 results carry NaN for missing values, so pickles from before that change are not reused
+            "sparse" : args.sparseOutput,
+            "quantizeRatios" : args.quantizeRatios}
+
+def filter2Suffix():  #what each filter 2 job leaves in the filter2 folder
+    import colonialOne
+    if args.sparseOutput:
+        return colonialOne.sparseSuffix
+    return ".data.pkl"
 
 def cleanUp(tempdir):
     import shutil
@@ -476,50 +587,24 @@ def yesAnswer(question):  #asks the question passed in and returns True if the a
             
 def getGroupData(tempdir):
     import os
-    import pickle
-    acceptedLociFileName = tempdir + os.sep + "loci" + os.sep + "acceptedLoci.pkl"
+    import numpy
+    import colonialOne
+    acceptedLociFileName = tempdir + os.sep + "loci" + os.sep + "acceptedLoci.npz"
     if not os.path.isfile(acceptedLociFileName):
         raise RuntimeError("Group listing function was unable to find the list of accepted loci.  Was this process missed?")
-    acceptedLociFile = open(acceptedLociFileName, 'rb')
-    acceptedLociTree = pickle.load(acceptedLociFile)
-    acceptedLociFile.close()
-    unsortedContigs = list(acceptedLociTree.keys())
-    numberedContigs = []
-    namedContigs = []
+    acceptedLociTree = colonialOne.loadAcceptedLoci(acceptedLociFileName)  #contig -> sorted array of accepted positions
+    contigs = orderContigs(list(acceptedLociTree.keys()))  #same order as the accepted index, so groups come out in row order
     groupMatrix = {}
-    chrM = False
-    for contig in unsortedContigs:
-        try:
-            contig = int(contig)
-            numberedContigs.append(contig)
-        except ValueError:
-            try:
-                contig = float(contig)
-                numberedContigs.append(contig)
-            except ValueError:
-                if contig.upper() == "M":
-                    chrM = True
-                    mContig = contig
-                else:
-                    namedContigs.append(contig)
-    numberedContigs.sort()
-    namedContigs.sort()
-    contigs = numberedContigs + namedContigs
-    if chrM:
-        contigs += mContig
-    contigs = [str(contig) for contig in contigs]
-    if args.verbose:
-        print("Contig order: " + ", ".join(contigs))
     for contig in contigs:
-        keys = list(acceptedLociTree[contig].keys())
-        keys.sort()
-        groupMatrix[contig] = keys
+        groupMatrix[contig] = numpy.unique(acceptedLociTree[contig] // 1000000).tolist()
     return (contigs, groupMatrix)
 
 def makeJobsGroupList(contigs, groupMatrix):
     totalGroups = 0
     for contig in contigs:
         totalGroups += len(groupMatrix[contig])
+    if not totalGroups:  #nothing accepted, but one job still has to write the header
+        return [[]]
     if totalGroups < args.maxParallelJobs:
         parallelJobs = totalGroups
     else:
@@ -546,19 +631,22 @@ def makeJobsGroupList(contigs, groupMatrix):
                     thisJobSize += 1
     return jobGroupList
 
-def orderedCaseList(tempdir):
+def orderedCaseList(tempdir):  #sample names in output column order
+    import colonialOne
+    if cohort:
+        return list(cohort.sampleOrder)
+    return [colonialOne.sampleName(file) for file in filter1SampleFiles(tempdir)]
+
+def writeColumnNames(tempdir):  #the final build cannot import us, so the column order and header names go to it in a file
+    import json
     import os
-    import pickle
-    filter2Dir = tempdir + os.sep + "filter2"
-    filteredFiles = []
-    rawFiles = os.listdir(filter2Dir)
-    for file in rawFiles:
-        if file.endswith(".data.pkl"):
-            filteredFiles.append(file)
-    file = open(filter2Dir + os.sep + "orderedCaseList.pkl", 'wb')
-    pickle.dump(filteredFiles, file)
-    file.close()
-    return filteredFiles
+    caseList = orderedCaseList(tempdir)
+    headers = trimRepeatingEnds(caseList, trimStart = False) if caseList else []
+    columnNameFileName = tempdir + os.sep + "finalParts" + os.sep + "columnNames.json"
+    columnNameFile = open(columnNameFileName, 'w')
+    json.dump({"samples" : caseList, "headers" : headers}, columnNameFile)
+    columnNameFile.close()
+    return columnNameFileName
 
 def trimRepeatingEnds(nameList, trimStart = True, trimEnd = False):
     startTrim = 0
@@ -608,147 +696,294 @@ def trimRepeatingEnds(nameList, trimStart = True, trimEnd = False):
                 break
     return trimmedNames
         
-def buildFinalDataFrame(tempdir, caseList, totalPieces):
-    import pickle
-    import pandas
+def finalPieceFiles(tempdir, totalPieces, suffix):
     import os
-    caseNameList = [name.split(".")[0] for name in caseList]
-    caseNameList = trimRepeatingEnds(caseNameList, trimStart = False)
-    finalDataFrame = pandas.DataFrame()
+    fileNames = []
     for i in range(0,totalPieces):
-        fileName = tempdir + os.sep + 'finalParts' + os.sep + str(i) + ".data.pkl"
+        fileName = tempdir + os.sep + 'finalParts' + os.sep + str(i) + suffix
         if not os.path.isfile(fileName):
             raise RuntimeError("Expecting final piece file " + fileName + " but it was not found.")
-        file = open(fileName, 'rb')
-        data = pickle.load(file)  #this should come in structured as {locus:[list,of,percentages,in,order,set,by,case,list]}
-        file.close()
-        finalDataFrame = finalDataFrame.append(data)
-    finalDataFrame.columns = caseNameList
-    return finalDataFrame        
+        fileNames.append(fileName)
+    return fileNames
+
+def buildFinalDataFrame(tempdir, totalPieces):  #each piece is a data frame of every sample for one run of loci, already labelled, so they are joined once in order
+    import pandas
+    pieces = [pandas.read_pickle(fileName) for fileName in finalPieceFiles(tempdir, totalPieces, ".data.pkl")]
+    return pandas.concat(pieces, axis = 0)
+
+def joinFinalTextPieces(tempdir, totalPieces):  #the pieces are already formatted text with the header on the first one, so they just get copied out in order
+    import os
+    import shutil
+    outputFile = open(args.outputFile + ".tmp", 'wb')
+    for fileName in finalPieceFiles(tempdir, totalPieces, ".data.txt"):
+        pieceFile = open(fileName, 'rb')
+        shutil.copyfileobj(pieceFile, outputFile, 16777216)
+        pieceFile.close()
+    outputFile.close()
+    os.rename(args.outputFile + ".tmp", args.outputFile)
+
+def runShardedFinalBuild(tempdir):  #one job per run of contig megabase groups, each writing every sample for its loci, so that no node has to hold or format the whole table
+    import fleetCommand
+    contigs, groupMatrix = getGroupData(tempdir)
+    jobGroupList = makeJobsGroupList(contigs, groupMatrix)
+    columnNameFileName = writeColumnNames(tempdir)
+    argumentStrings = []
+    for i in range(0, len(jobGroupList)):
+        arguments = {"--groups" : ",".join(jobGroupList[i]),
+                     "--shardNumber" : str(i),
+                     "--tempdir" : tempdir,
+                     "--columnNames" : columnNameFileName,
+                     "--emptyCellMarker" : str(args.emptyCellMarker),
+                     "--pickleOut" : args.pickleOut}
+        argumentStrings.append(fleetCommand.makeArgumentString(arguments))
+    if args.verbose:
+        print("Building the final table in " + str(len(jobGroupList)) + " locus shards.")
+    if args.workStealing:
+        executor.runQueue("HeavyRaiders", "heavyRaider.py", argumentStrings, "finalPartsClockOut", args.maxParallelJobs, memoryGB = 4)
+    else:
+        executor.runJobs("HeavyRaiders", "heavyRaider.py", argumentStrings, "finalPartsClockOut", memoryGB = 4)
+    if args.pickleOut:
+        buildFinalDataFrame(tempdir, len(jobGroupList)).to_pickle(args.outputFile)
+    else:
+        joinFinalTextPieces(tempdir, len(jobGroupList))
+
+def acceptedIndexFiles(tempdir):
+    import os
+    baseName = tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex'
+    return [baseName + ".npy", baseName + ".json"]
+
+def orderContigs(unsortedContigs):  #numbered contigs in numeric order, then named ones, then the mitochondria
+    import colonialOne
+    contigs = colonialOne.orderContigs(unsortedContigs)
+    if args.verbose:
+        print("Contig order: " + ", ".join(contigs))
+    return contigs
 
 def getAcceptedCoordinateList(tempdir):
     import os
-    import pickle
-    acceptedLociFileName = tempdir + os.sep + 'loci' + os.sep + 'acceptedLoci.pkl'
+    import colonialOne
+    import pegasus
+    acceptedLociFileName = tempdir + os.sep + 'loci' + os.sep + 'acceptedLoci.npz'
     if not os.path.isfile(acceptedLociFileName):
         raise RuntimeError("Group listing function was unable to find the list of accepted loci.  Was this process missed?")
-    acceptedLociFile = open(acceptedLociFileName, 'rb')
-    acceptedLociTree = pickle.load(acceptedLociFile)
-    acceptedLociFile.close()
-    unsortedContigs = list(acceptedLociTree.keys())
-    numberedContigs = []
-    namedContigs = []
-    groupMatrix = {}
-    chrM = False
-    for contig in unsortedContigs:
-        try:
-            contig = int(contig)
-            numberedContigs.append(contig)
-        except ValueError:
-            try:
-                contig = float(contig)
-                numberedContigs.append(contig)
-            except ValueError:
-                if contig.upper() == "M":
-                    chrM = True
-                    mContig = contig
-                else:
-                    namedContigs.append(contig)
-    numberedContigs.sort()
-    namedContigs.sort()
-    contigs = numberedContigs + namedContigs
-    if chrM:
-        contigs += mContig
-    contigs = [str(contig) for contig in contigs]
+    key = pegasus.inputKey({}, [acceptedLociFileName])
+    if manifest.stageComplete("acceptedIndex", key):  #rebuilding it would change its signature and make filter 2 results look stale
+        return colonialOne.AcceptedIndex.load(tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')
+    acceptedLociTree = colonialOne.loadAcceptedLoci(acceptedLociFileName)  #contig -> sorted array of accepted positions
+    contigs = orderContigs(list(acceptedLociTree.keys()))
+    acceptedIndex = colonialOne.AcceptedIndex.fromAcceptedLoci(acceptedLociTree, contigs)  #sorted positions with per-contig offsets, memory mapped by the filter 2 jobs
+    acceptedIndex.save(tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')
+    manifest.recordStage("acceptedIndex", key, acceptedIndexFiles(tempdir))
+    return acceptedIndex
+
+def resultMatrixBaseName(tempdir):
+    import os
+    return tempdir + os.sep + "filter2" + os.sep + "resultMatrix"
+
+def createResultMatrix(tempdir, acceptedIndex):  #lays out the shared matrix that filter 2 jobs write their sample columns into
+    import os
+    import colonialOne
+    sampleFiles = [file.split(os.sep)[-1] for file in filter1SampleFiles(tempdir)]
+    sampleNames = [colonialOne.sampleName(file) for file in sampleFiles]
+    if len(set(sampleNames)) != len(sampleNames):
+        raise RuntimeError("Sample name collision.  Two samples would share a column in the result matrix.")
     if args.verbose:
-        print("Contig order: " + ", ".join(contigs))
-    coordinateList = []
-    for contig in contigs:
-        groups = list(acceptedLociTree[contig].keys())
-        groups.sort()
-        for group in groups:
-            positions = list(acceptedLociTree[contig][group].keys())
-            positions.sort()
-            for position in positions:
-                coordinateList.append(contig + ":" + str(position))            
-    coordinateListFileName = tempdir + os.sep + 'loci' + os.sep + 'acceptedCoordinateList.pkl'
-    coordinateListFile = open(coordinateListFileName,'wb')
-    pickle.dump(coordinateList, coordinateListFile)
-    coordinateListFile.close()
-    coordinateIndex = {}
-    index = 0
-    for coordinates in coordinateList:
-        coordinateIndex[coordinates] = index
-        index += 1
-    coordinateIndexFileName = tempdir + os.sep + 'loci' + os.sep + 'acceptedCoordinateIndex.pkl'
-    coordinateIndexFile = open(coordinateIndexFileName,'wb')
-    pickle.dump(coordinateIndex, coordinateIndexFile)
-    coordinateIndexFile.close()
-    return coordinateList
-
-def runFinalBuild(tempdir):
+        print("Creating a " + str(len(acceptedIndex)) + " x " + str(len(sampleNames)) + " result matrix.")
+    if args.quantizeRatios:
+        dataType = "uint16"
+    else:
+        dataType = "float32"
+    return colonialOne.ResultMatrix.create(resultMatrixBaseName(tempdir), len(acceptedIndex), sampleNames, dataType)
+
+def resultMatrixFiles(baseName):
+    return [baseName + ".json", baseName + ".matrix"]
+
+def runCohortUpdate(tempdir):  #incremental mode: only new or changed samples go through filter 1, then the cohort store updates its counts and just the matrix rows and columns that changed
     import os
+    import colonialOne
+    jobFilesList, filter1Keys = getFilter1FileList(tempdir)
+    if jobFilesList:
+        if args.prefilter:
+            jobFilesList = runPrefilter(jobFilesList, tempdir)
+        runFilter1(jobFilesList, tempdir, filter1Keys)
+    for sample in filter1Keys:
+        if cohort.sampleKey(sample) == filter1Keys[sample]:
+            continue
+        if not manifest.taskComplete("filter1", sample, filter1Keys[sample]):
+            raise RuntimeError("Filter 1 did not produce valid results for sample " + sample)
+        sampleFile = [file for file in manifest.tasks["filter1"][sample]["outputs"] if file.endswith(colonialOne.sampleSuffix)][0]
+        cohort.addSample(sampleFile, filter1Keys[sample])
+    if args.verbose:
+        print("Cohort store holds " + str(len(cohort)) + " samples.")
+    acceptedLoci = cohort.acceptedLoci(args.minRepresentation / 100)
+    acceptedIndex = colonialOne.AcceptedIndex.fromAcceptedLoci(acceptedLoci, orderContigs(list(acceptedLoci.keys())))
+    resultMatrix = cohort.update(acceptedIndex, args.quantizeRatios, args.verbose)
+    acceptedIndex.save(tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')  #the final build labels its rows from here
+    return resultMatrix.files()
+
+def runFinalBuild(tempdir, filter2Outputs):
+    import os
+    import fleetCommand
+    import pegasus
+    parameters = {"outputFile" : args.outputFile,
+                  "pickleOut" : args.pickleOut,
+                  "outputStore" : args.outputStore,
+                  "sparseOutput" : args.sparseOutput,
+                  "emptyCellMarker" : str(args.emptyCellMarker),
+                  "sharedMatrix" : args.sharedMatrix,
+                  "cohortStore" : args.cohortStore,
+                  "shardedFinalBuild" : args.shardedFinalBuild,
+                  "quantizeRatios" : args.quantizeRatios}
+    key = pegasus.inputKey(parameters, sorted(filter2Outputs))
+    if manifest.stageComplete("finalBuild", key):
+        if args.verbose:
+            print("Output file " + args.outputFile + " is already up to date.")
+        return
+    partialsFlush(tempdir, "finalParts")
+    if args.shardedFinalBuild:
+        runShardedFinalBuild(tempdir)
+        manifest.recordStage("finalBuild", key, [args.outputFile])
+        return
     arguments = {"--outputFile" : args.outputFile,
-                 "--tempdir" : tempdir}
-    argumentList = []
-    for key in list(arguments.keys()):
-        if arguments[key]:
-            argumentList.append(key + " " + arguments[key])
-    argumentString = " ".join(argumentList)
-    command = pythonInterpreterAbsolutePath + " resurrectionShip.py " + argumentString
+                 "--tempdir" : tempdir,
+                 "--emptyCellMarker" : str(args.emptyCellMarker),
+                 "--quantizedRatios" : args.quantizeRatios,
+                 "--columnNames" : writeColumnNames(tempdir)}  #every output path takes its column order and header names from this one list
+    if args.cohortStore:
+        arguments["--resultMatrix"] = cohort.matrixBaseName
+    elif args.sharedMatrix:
+        arguments["--resultMatrix"] = resultMatrixBaseName(tempdir)
+    if args.sparseOutput:
+        arguments["--sparse"] = True
+    if args.streamOutput or args.outputStore:
+        arguments["--stream"] = args.streamOutput
+        arguments["--outputStore"] = args.outputStore
+        arguments["--blockRows"] = str(args.blockRows)
+        if args.executor == "local" and args.localWorkers:
+            arguments["--formatWorkers"] = str(args.localWorkers)
+    arguments.update(executorArguments())
+    argumentString = fleetCommand.makeArgumentString(arguments)
     if args.pickleOut:
-        command += " --pickleOut "
+        argumentString += " --pickleOut"
+    executor.runHere("resurrectionShip.py", argumentString)
+    if args.outputStore:
+        manifest.recordStage("finalBuild", key, [args.outputFile + os.sep + "store.json"])
+    else:
+        manifest.recordStage("finalBuild", key, [args.outputFile])
+
+def finishRun(tempdir, start):  #clean up and report, however we got here
+    import datetime
+    import flightRecorder
+    report = flightRecorder.buildReport(tempdir)  #has to be read before the temporary directory goes away
+    if args.metricsReport:
+        flightRecorder.writeReport(report, args.metricsReport)
+    if args.verbose and report["records"]:
+        flightRecorder.printReport(report)
+    if args.profile:
+        profiledStages = flightRecorder.mergeProfiles(tempdir, args.profileDirectory)
+        if args.verbose:
+            print("Profiles for " + ", ".join(profiledStages) + " written to " + args.profileDirectory)
+    if not args.noCleanUp:
+        try:
+            cleanUp(tempdir)
+        except:
+            try:
+                cleanUp(tempdir)
+            except:
+                print("Unable to remove temporary directory: " + tempdir)
+                print("Please remove it manually.")
     if args.verbose:
-        command += " -v "
-        print("BASH " + command)
-    os.system(command)
+        runtime = datetime.datetime.now() - start
+        print("Whole process complete in " + str(runtime))
 
 def main():
     import datetime
-    import pandas
+    import os
+    import fleetCommand
+    import colonialOne
+    import pegasus
+    import quorum
     global args
     args = CheckArgs()  #get validated arguments in the args object
     if args.verbose:   #if the user has allowed output
         displaySplash()  #show the startup screen
-    if args.verbose:
-        start = datetime.datetime.now()  #log the start time
+    start = datetime.datetime.now()  #log the start time
     if args.tempdir:  #if the user specified a temporary directory
         tempdir = args.tempdir  #use that as the temporary directory
+        makeTempSubdirectories(tempdir)
     else:  #if none was specified
         tempdir = createTempDir()  #create one
+    global executor
+    executor = fleetCommand.makeExecutor(args.executor, tempdir, args.pythonInterpreter, args.verbose, args.localWorkers, args.profile)  #everything that runs in parallel goes through this
+    global manifest
+    manifest = pegasus.RunManifest(tempdir)  #what has already been done in this tempdir, and from what inputs
+    if args.regions:
+        buildRegionIndex(tempdir)
+    global cohort
+    if args.cohortStore:
+        cohort = quorum.CohortStore(args.cohortStore)
+        filter2Outputs = runCohortUpdate(tempdir)
+        bashFileFlush(tempdir)
+        if args.verbose:
+            print("Starting final build script.")
+        runFinalBuild(tempdir, filter2Outputs)
+        finishRun(tempdir, start)
+        return
+    cohort = False
     if args.doFilter1:  #if the user did not specify skipping the first filter
-        jobFilesList = getFilter1FileList()  #get a list of files to work on for this step
-        if not jobFilesList:  #if the jobFilesList is empty
-            raise RuntimeError("No data files to process for filter 1.")  #quit and report the error
-        jobFilesList = runPrefilter(jobFilesList, tempdir)
-        runFilter1(jobFilesList, tempdir)  #otherwise, run the first filter (the one that looks just a data within a file)
+        manifest.settleTasks("filter1")  #claim anything a crashed run finished before it went down
+        jobFilesList, filter1Keys = getFilter1FileList(tempdir)  #get a list of files to work on for this step
+        if jobFilesList:
+            if args.prefilter:  #filter 1 streams files of any size under its memory ceiling, so this extra round is only run on request
+                jobFilesList = runPrefilter(jobFilesList, tempdir)
+            runFilter1(jobFilesList, tempdir, filter1Keys)  #otherwise, run the first filter (the one that looks just a data within a file)
+        currentOutputs = []
+        for sample in filter1Keys:
+            if not manifest.taskComplete("filter1", sample, filter1Keys[sample]):
+                raise RuntimeError("Filter 1 did not produce valid results for sample " + sample)
+            currentOutputs += list(manifest.tasks["filter1"][sample]["outputs"].keys())
+        pegasus.removeStrays(tempdir + os.sep + "filter1", colonialOne.sampleSuffix, currentOutputs)  #samples no longer in the input directory should not be counted
+        pegasus.removeStrays(tempdir + os.sep + "filter1", colonialOne.headerSuffix, currentOutputs)
+        for sample in list(manifest.tasks["filter1"].keys()):
+            if not sample in filter1Keys:
+                del manifest.tasks["filter1"][sample]
+        manifest.save()
+    elif not manifest.tasks.get("filter1"):  #skipped straight past filter 1 on a tempdir without a manifest, so take whatever is there
+        recordExistingSamples(tempdir)
     bashFileFlush(tempdir)
     if args.doCount:
         countRepresentation(tempdir)
-    acceptedCoordinateList = getAcceptedCoordinateList(tempdir)
+    acceptedIndex = getAcceptedCoordinateList(tempdir)
     bashFileFlush(tempdir)
-    if args.doFilter2:
+    filter2Outputs = []
+    if args.sharedMatrix:
+        filter2Key = pegasus.inputKey(filter2Parameters(), filter1SampleFiles(tempdir) + acceptedIndexFiles(tempdir))
+        filter2Outputs = resultMatrixFiles(resultMatrixBaseName(tempdir))
+        if args.doFilter2 and not manifest.stageComplete("filter2Matrix", filter2Key):
+            manifest.invalidateStage("filter2Matrix")
+            createResultMatrix(tempdir, acceptedIndex)
+            jobFilesList = getFilter2FileList(tempdir)
+            if not jobFilesList:
+                raise RuntimeError("No data files to process for filter 2.")
+            runFilter2(jobFilesList, tempdir)
+            manifest.recordStage("filter2Matrix", filter2Key, filter2Outputs)
+        elif args.verbose and args.doFilter2:
+            print("Result matrix is still valid, skipping filter 2.")
+    elif args.shardedFinalBuild:  #the shards look up their own loci in the filter 1 results
+        filter2Outputs = filter1SampleFiles(tempdir) + acceptedIndexFiles(tempdir)
+    elif args.doFilter2:
         jobFilesList = getFilter2FileList(tempdir)
         if not jobFilesList:
             raise RuntimeError("No data files to process for filter 2.")
-        runFilter2(jobFilesList, tempdir)
+        filter2Outputs = runFilter2(jobFilesList, tempdir)
+    else:
+        filter2Outputs = [tempdir + os.sep + "filter2" + os.sep + file for file in os.listdir(tempdir + os.sep + "filter2") if file.endswith(filter2Suffix())]
     bashFileFlush(tempdir)
     if args.doFinalBuild:
         if args.verbose:
             print("Starting final build script.")
-            runFinalBuild(tempdir)
-    if not args.noCleanUp:
-        try:
-            cleanUp(tempdir)
-        except:
-            try:
-                cleanUp(tempdir)
-            except:
-                print("Unable to remove temporary directory: " + tempdir)
-                print("Please remove it manually.")
-    if args.verbose:
-        runtime = datetime.datetime.now() - start
-        print("Whole process complete in " + str(runtime))
-        
+        runFinalBuild(tempdir, filter2Outputs)
+    finishRun(tempdir, start)
+
 main()
     
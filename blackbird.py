@@ -6,9 +6,6 @@ University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
 email: [myfirstname].[mylastname] AT ucla.edu
 '''
 
-global pythonInterpreterAbsolutePath
-pythonInterpreterAbsolutePath = "/u/local/apps/python/3.4.3/bin/python3"
-
 class CheckArgs():  #class that checks arguments and ultimately returns a validated set of arguments to the main program
     
     def __init__(self):
@@ -18,24 +15,41 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-r", "--minRepresentation", help = "Minimum percent of the time a specific locus needs to have been reported in samples", default = 75, type = int)
         parser.add_argument("-t", "--tempdir", help = "Holds the name of the temporary directory we are using.")
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
+        parser.add_argument("--executor", help = "Where to run scatter jobs: sge or local", default = "sge", choices = ["sge", "local"])
+        parser.add_argument("--localWorkers", help = "Maximum number of processes for the local executor", default = 0, type = int)
+        parser.add_argument("--pythonInterpreter", help = "Python interpreter used to launch scatter jobs")
+        parser.add_argument("-p", "--maxParallelJobs", help = "Maximum number of parallel workers when work stealing", default = 301, type = int)
+        parser.add_argument("--fanIn", help = "How many partials each merge job combines when reducing scatter results in rounds", default = 8, type = int)
+        parser.add_argument("--workStealing", help = "Put scatter jobs in a task queue that workers pull from until it is empty", action = 'store_true')
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         self.minRepresentationPercent = float(rawArgs.minRepresentation/100)
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 self.tempdir = rawArgs.tempdir
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
         else:
             raise RuntimeError("No temporary directory specified.  This is not designed to run without one.")
         self.verbose = rawArgs.verbose
+        self.executor = rawArgs.executor
+        self.localWorkers = rawArgs.localWorkers
+        self.pythonInterpreter = rawArgs.pythonInterpreter
+        self.maxParallelJobs = rawArgs.maxParallelJobs
+        self.workStealing = rawArgs.workStealing
+        if rawArgs.fanIn < 2:
+            raise RuntimeError("Fan in must be at least 2.  We got: " + str(rawArgs.fanIn))
+        self.fanIn = rawArgs.fanIn
 
 def getListOfFiles():
     import os
-    locusFileDirectory = args.tempdir + os.sep + "loci" + os.sep
+    import colonialOne
+    locusFileDirectory = args.tempdir + os.sep + "filter1" + os.sep
     rawLocusFiles = os.listdir(locusFileDirectory)
     locusFiles = []
     for file in rawLocusFiles:
-        if file.endswith(".loci.pkl"):
+        if file.endswith(colonialOne.sampleSuffix):
             locusFiles.append(locusFileDirectory + file)
     return locusFiles
         
@@ -49,71 +63,24 @@ def makeScatterCountingList(fileList):
     return scatterFileList
 
 def runScatterJobs(scatterFileList):
-    import os
-    if not os.path.isdir("schedulerOutput"):
-        os.mkdir("schedulerOutput")
-    wrapperRunnerName = args.tempdir + os.sep + "bashFiles" + os.sep + "wrapper.sh"
-    wrapperRunner = open(wrapperRunnerName, 'w')
-    wrapperRunner.write("#!/bin/bash\n")
-    wrapperRunner.write(pythonInterpreterAbsolutePath + " raptor.py " + "--tempdir " + args.tempdir + " --clockOutDir " + args.tempdir + os.sep + "lociClockOut")
-    wrapperRunner.close()
-    clockOutFlush(args.tempdir + os.sep + "lociClockOut")
+    import fleetCommand
+    executor = fleetCommand.makeExecutor(args.executor, args.tempdir, args.pythonInterpreter, args.verbose, args.localWorkers, args.profile)
+    argumentStrings = []
     for i in range(0,len(scatterFileList)):
         arguments = {"--fileList" : ",".join(scatterFileList[i]),
                      "--tempdir" : args.tempdir}
-        argumentList = []
-        for key in list(arguments.keys()):
-            if arguments[key]:
-                argumentList.append(key + " " + arguments[key])
-        argumentString = " ".join(argumentList)
-        if i == 0:
-            if args.verbose:
-                argumentString += " -v"
-            thisNodesJob = pythonInterpreterAbsolutePath + " toaster.py " + argumentString
-        else:
-            bashFileName = args.tempdir + os.sep + "bashFiles" + os.sep + str(i) + ".sh"
-            bashFile = open(bashFileName, 'w')
-            bashFile.write("#!/bin/bash\n")
-            bashFile.write(pythonInterpreterAbsolutePath + " toaster.py " + argumentString)
-            bashFile.close()
-    jobRange = "1-" + str(len(scatterFileList) - 1) + " "
-    command = "qsub -cwd -V -N Toasters -l h_data=4G,time=23:59:00 -e " + os.getcwd() +  "/schedulerOutput/ -o " + os.getcwd() + "/schedulerOutput/ " + "-t " + jobRange + wrapperRunnerName
-    if args.verbose:
-        print("BASH " + command)
-    os.system(command)
-    if args.verbose:
-        print("Starting the job on this node.")
-        print("BASH " + thisNodesJob)
-    os.system(thisNodesJob)
-    if args.verbose:
-        print("Monitoring other nodes counting jobs.")
-    monitorJobs(args.tempdir + os.sep + "lociClockOut", len(scatterFileList))
+        argumentStrings.append(fleetCommand.makeArgumentString(arguments))
+    if args.workStealing:
+        executor.runQueue("Toasters", "toaster.py", argumentStrings, "lociClockOut", args.maxParallelJobs, memoryGB = 4)
+    else:
+        executor.runJobs("Toasters", "toaster.py", argumentStrings, "lociClockOut", memoryGB = 4)
     
-def monitorJobs(clockOutDirectory, jobCount):
+def reduceGatheredFiles(fileList):  #merges the scatter partials in parallel rounds so that only a few are left for this node
     import os
-    import time
-    if args.verbose:
-        print("Monitoring jobs on other nodes.")
-    done = False
-    completed = 1
-    jobList = []
-    for i in range(1,jobCount):
-        jobList.append([i,False])
-    while not done:
-        if args.verbose:
-            print("Completed " + str(completed) + " of " + str(jobCount) + " jobs.       ", end = "\r")
-        for i in range(0,len(jobList)):
-            if not jobList[i][1]:
-                if os.path.isfile(clockOutDirectory + os.sep + str(jobList[i][0])):
-                    jobList[i][1] = True
-                    completed += 1
-                    if completed == len(jobList) + 1:
-                        done = True
-                        print()
-                        break
-        time.sleep(1)
-    if args.verbose:
-        print("Completed " + str(completed) + " of " + str(jobCount) + " jobs.       ", end = "\r")
+    import fleetCommand
+    executor = fleetCommand.makeExecutor(args.executor, args.tempdir, args.pythonInterpreter, args.verbose, args.localWorkers, args.profile)
+    return fleetCommand.treeReduce(executor, "ToasterMerge", "toaster.py", fileList, args.tempdir + os.sep + "lociGather", ".counts.npz", "lociClockOut", args.fanIn, memoryGB = 4, extraArguments = {"--tempdir" : args.tempdir, "--merge" : True})
+
 def gatherFiles():
     import os
     if args.verbose:
@@ -122,109 +89,56 @@ def gatherFiles():
     rawFiles = os.listdir(scatterFileDirectory)
     filteredFiles = []
     for file in rawFiles:
-        if file.endswith(".scatter.pkl"):
+        if file.endswith(".counts.npz"):
             filteredFiles.append(scatterFileDirectory + os.sep + file)
     if args.verbose:
         print("Found " + str(len(filteredFiles)) + " sets of results from other jobs.")
     return filteredFiles
 
-def combineGatheredCounts(fileList):  #assumes that locusList will come in as a global to avoid moving around a big dataset too much
-    import os
-    import pickle
+def combineGatheredCounts(fileList):  #assumes that locusCounts will come in as a global to avoid moving around a big dataset too much
+    import colonialOne
     progress = 0
     for fileName in fileList:
         print("Processed " + str(progress) + " of " + str(len(fileList)) + " data files.       ", end = "\r" )
-        file = open(fileName, 'rb')
-        scatteredData = pickle.load(file)
-        file.close()
-        for contig in list(scatteredData.keys()):
-            for group in list(scatteredData[contig].keys()):
-                for position in list(scatteredData[contig][group].keys()):
-                    try:
-                        locusList[contig][group][position] += scatteredData[contig][group][position]
-                    except KeyError:
-                        try:
-                            locusList[contig][group][position] = scatteredData[contig][group][position]
-                        except KeyError:
-                            try:
-                                locusList[contig][group][position] += scatteredData[contig][group][position]
-                            except KeyError:
-                                try:
-                                    locusList[contig][group] = {}
-                                    locusList[contig][group][position] = scatteredData[contig][group][position]
-                                except KeyError:
-                                    locusList[contig] = {}
-                                    locusList[contig][group] = {}
-                                    locusList[contig][group][position] = scatteredData[contig][group][position]
+        partial = colonialOne.LocusCounts.load(fileName)
+        recorder.readFile(fileName)
+        recorder.count("rowsRead", len(partial))
+        locusCounts.addCounts(partial)
         progress += 1
     if args.verbose:
         print("All files processed.                                                        ")
     
-def addLociFromFile(file):  #locusList should come in as a global variable.  Doing this to try and be kind to memory.
-    import pickle
-    dataFile = open(file, 'rb')
-    inputList = pickle.load(dataFile)
-    dataFile.close()
-    for line in inputList:
-        contig, position, group = line  #assuming it comes in with this form, which it should.  The group should just be the megabase number of the locus and should have been calculated by the parallel processes
-        try:
-            locusList[contig][group][position] += 1
-        except KeyError:
-            try:
-                locusList[contig][group][position] = 1
-            except KeyError:
-                try:
-                    locusList[contig][group] = {}
-                    locusList[contig][group][position] = 1
-                except KeyError:
-                    locusList[contig] = {}
-                    locusList[contig][group] = {}
-                    locusList[contig][group][position] = 1
+def addLociFromFile(file):  #locusCounts should come in as a global variable.  Doing this to try and be kind to memory.
+    import colonialOne
+    sample = colonialOne.SampleData(file)
+    recorder.readFile(file)
+    recorder.count("rowsRead", len(sample))
+    locusCounts.addSample(sample)
 
-def filteredLocusTree(minimumObservationCount):  #again, assuming locus list comes in as a global variable
+def filteredLocusTree(minimumObservationCount):  #again, assuming locusCounts comes in as a global variable
     if args.verbose:
         print("Generating a list of loci represented in at least " + str(int(args.minRepresentationPercent*100)) + " percent of samples.")
-    filteredLocusList = {}
-    screenedLoci = 0
-    acceptedLoci = 0
-    for contig in list(locusList.keys()):
-        for group in list(locusList[contig].keys()):
-            for position in list(locusList[contig][group].keys()):
-                screenedLoci += 1
-                if locusList[contig][group][position] >= minimumObservationCount:
-                    acceptedLoci += 1
-                    try:
-                        filteredLocusList[contig][group][position] = True
-                    except KeyError:
-                        try:
-                            filteredLocusList[contig][group] = {}
-                            filteredLocusList[contig][group][position] = True
-                        except KeyError:
-                            filteredLocusList[contig] = {}
-                            filteredLocusList[contig][group] = {}
-                            filteredLocusList[contig][group][position] = True
-                if args.verbose:
-                    if screenedLoci % 10000 == 0:
-                        print(str(acceptedLoci) + " of " + str(screenedLoci) + " loci have acceptable representation.                  ", end = "\r")
+    acceptedLoci = locusCounts.accepted(minimumObservationCount)
+    acceptedCount = sum([len(acceptedLoci[contig]) for contig in acceptedLoci])
+    recorder.count("rowsAccepted", acceptedCount)
+    recorder.reject("representation", len(locusCounts) - acceptedCount)
     if args.verbose:
-        print(str(acceptedLoci) + " of " + str(screenedLoci) + " loci have acceptable representation.                  ")
-    return filteredLocusList
-
-def clockOutFlush(clockOutDir):
-    import os
-    import shutil
-    shutil.rmtree(clockOutDir)
-    os.mkdir(clockOutDir) 
+        screenedLoci = len(locusCounts)
+        print(str(acceptedCount) + " of " + str(screenedLoci) + " loci have acceptable representation.                  ")
+    return acceptedLoci
 
 def main():
-    import pickle
     import datetime
     import os
+    import colonialOne
+    import flightRecorder
     start = datetime.datetime.now()
     global args
     args = CheckArgs()
-    global locusList
-    locusList = {}
+    global recorder
+    recorder = flightRecorder.FlightRecorder("blackbird", args.tempdir, args.profile)
+    global locusCounts
+    locusCounts = colonialOne.LocusCounts()
     fileList = getListOfFiles()
     if len(fileList) < 40:
         progress = 0
@@ -236,21 +150,18 @@ def main():
     else:
         scatterCountingList = makeScatterCountingList(fileList)
         runScatterJobs(scatterCountingList)
-        jobFileList = gatherFiles()
+        jobFileList = reduceGatheredFiles(gatherFiles())
         combineGatheredCounts(jobFileList)
-    acceptedLocusTree = filteredLocusTree(len(fileList) * args.minRepresentationPercent)
-    del locusList
+    acceptedLoci = filteredLocusTree(len(fileList) * args.minRepresentationPercent)
+    del locusCounts
     if args.verbose:
         print("Saving list of accepted loci.")
-    acceptedLociFileName = args.tempdir + os.sep + "loci" + os.sep + "acceptedLoci.pkl"
-    acceptedLociFile = open(acceptedLociFileName, 'wb')
-    pickle.dump(acceptedLocusTree, acceptedLociFile)
-    acceptedLociFile.close()
+    acceptedLociFileName = args.tempdir + os.sep + "loci" + os.sep + "acceptedLoci.npz"
+    colonialOne.saveAcceptedLoci(acceptedLociFileName, acceptedLoci)
+    recorder.wroteFile(acceptedLociFileName)
+    recorder.finish()
     if args.verbose:
         runtime = datetime.datetime.now() - start
         print("Multi-sample locus representation count completed in " + str(runtime))
         
 main()
-    
-    
-        
\ No newline at end of file
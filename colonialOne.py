@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#Colonial One keeps the records.  This module holds the typed, array-backed file formats that pass data between the stages so that nobody has to pickle or unpickle millions of little tuples.
+
+sampleSuffix = ".sample.npy"  #per-sample data written by filter 1
+headerSuffix = ".sample.json"  #small header that goes with each sample file
+formatVersion = 1
+
+quantizedScale = 65534  #ratios in [0,1] are stored as round(ratio * 65534), so any stored ratio is within 0.5 / 65534 (about 7.6e-6) of the original
+quantizedMissing = 65535  #reserved for a missing value
+quantizedDecimals = 4  #dequantized ratios are within 7.6e-6 of the original, so four decimal places are all that text output can vouch for.  Rounding to them gives back any ratio written with four decimals or fewer (0.706 rather than 0.7059999).
+ratioEncodings = {"float32" : "<f4", "uint16" : "<u2"}
+
+def quantizeRatios(ratios):  #float ratios (NaN for missing) to uint16
+    import numpy
+    ratios = numpy.asarray(ratios, dtype = numpy.float64)
+    missing = numpy.isnan(ratios)
+    quantized = numpy.rint(numpy.clip(numpy.where(missing, 0, ratios), 0.0, 1.0) * quantizedScale).astype(numpy.uint16)
+    quantized[missing] = quantizedMissing
+    return quantized
+
+def dequantizeRatios(quantized):  #and back, as float32 with NaN for missing
+    import numpy
+    quantized = numpy.asarray(quantized)
+    ratios = quantized.astype(numpy.float32) / numpy.float32(quantizedScale)
+    ratios[quantized == quantizedMissing] = numpy.nan
+    return ratios
+
+def roundRatios(values):  #dequantized ratios rounded for text output, NaN left alone
+    import numpy
+    return numpy.round(values, quantizedDecimals)
+
+def ratioEncodingOf(dataType):  #"uint16" for quantized arrays, "float32" otherwise
+    import numpy
+    if numpy.dtype(dataType) == numpy.dtype("<u2"):
+        return "uint16"
+    return "float32"
+
+def decodeRatios(values):  #any stored ratios as floats, whichever encoding they were written in
+    if ratioEncodingOf(values.dtype) == "uint16":
+        return dequantizeRatios(values)
+    return values
+
+def sampleDataType(ratioEncoding = "float32"):  #contig code, position, ratio.  Packed, so ten bytes per locus (eight with quantized ratios).
+    import numpy
+    if not ratioEncoding in ratioEncodings:
+        raise RuntimeError("Unknown ratio encoding: " + str(ratioEncoding))
+    return numpy.dtype([("contig", "<u2"), ("pos", "<i4"), ("ratio", ratioEncodings[ratioEncoding])])
+
+def headerFileName(sampleFileName):
+    if sampleFileName.endswith(sampleSuffix):
+        return sampleFileName[:-len(sampleSuffix)] + headerSuffix
+    return sampleFileName + headerSuffix
+
+def sampleName(sampleFileName):  #the sample name used as a column label, which is everything before the first dot, same as it always was
+    import os
+    return sampleFileName.split(os.sep)[-1].split(".")[0]
+
+def writeSample(fileName, contigNames, codes, positions, ratios, blockRows = 4194304, ratioEncoding = "float32"):  #writes the columns to a structured .npy in blocks so that memory mapped inputs are never pulled in all at once
+    import json
+    import os
+    import numpy
+    if len(contigNames) > 65535:
+        raise RuntimeError("Too many contigs to encode in a sample file: " + str(len(contigNames)))
+    rows = len(positions)
+    if rows:
+        if int(numpy.max(positions)) > 2147483647 or int(numpy.min(positions)) < 0:
+            raise RuntimeError("Position out of range for a 32 bit sample file in " + fileName)
+        output = numpy.lib.format.open_memmap(fileName + ".tmp", mode = 'w+', dtype = sampleDataType(ratioEncoding), shape = (rows,))
+        contigRows = ContigRows(len(contigNames))
+        for start in range(0, rows, blockRows):
+            end = min(start + blockRows, rows)
+            contigRows.add(numpy.asarray(codes[start:end]), numpy.asarray(positions[start:end]), start)
+            output["contig"][start:end] = codes[start:end]
+            output["pos"][start:end] = positions[start:end]
+            if ratioEncoding == "uint16":
+                output["ratio"][start:end] = quantizeRatios(ratios[start:end])
+            else:
+                output["ratio"][start:end] = ratios[start:end]
+        output.flush()
+        del output
+    else:
+        output = open(fileName + ".tmp", 'wb')
+        numpy.save(output, numpy.zeros(0, dtype = sampleDataType(ratioEncoding)))
+        output.close()
+        contigRows = ContigRows(len(contigNames))
+    header = {"format" : "battlestar-sample",
+              "version" : formatVersion,
+              "rows" : rows,
+              "contigs" : list(contigNames),
+              "ratioEncoding" : ratioEncoding}
+    if contigRows.ranges is not None:
+        header["contigRows"] = contigRows.ranges
+    headerFile = open(headerFileName(fileName), 'w')
+    json.dump(header, headerFile)
+    headerFile.close()
+    os.rename(fileName + ".tmp", fileName)  #only shows up under its real name once it is complete
+
+class ContigRows(object):  #follows the rows as they are written and works out each contig's [first, last) rows, as long as every contig's rows are together and its positions never go down.  Input that is not sorted like that leaves ranges as None.
+
+    def __init__(self, contigCount):
+        self.ranges = [[0, 0] for i in range(0, contigCount)]
+        self.lastCode = None
+        self.lastPosition = None
+
+    def add(self, codes, positions, offset):  #the next block of rows, starting at row offset
+        import numpy
+        if self.ranges is None or not len(codes):
+            return
+        sameContig = codes[1:] == codes[:-1]
+        if (sameContig & (positions[1:] < positions[:-1])).any() or (codes[0] == self.lastCode and positions[0] < self.lastPosition):
+            self.ranges = None
+            return
+        runStarts = numpy.concatenate([[0], numpy.flatnonzero(~sameContig) + 1])
+        runEnds = numpy.concatenate([runStarts[1:], [len(codes)]])
+        for runStart, runEnd in zip(runStarts.tolist(), runEnds.tolist()):
+            code = int(codes[runStart])
+            if code == self.lastCode:  #carries on from the block before
+                self.ranges[code][1] = offset + runEnd
+            elif self.ranges[code][1]:  #this contig already had its rows, so the file is not grouped by contig
+                self.ranges = None
+                return
+            else:
+                self.ranges[code] = [offset + runStart, offset + runEnd]
+            self.lastCode = code
+        self.lastPosition = int(positions[-1])
+
+class SampleData(object):  #read side of a sample file.  Memory maps the records by default, so loading is close to free.
+
+    def __init__(self, fileName, memoryMap = True):
+        import json
+        import os
+        import numpy
+        if not os.path.isfile(fileName):
+            raise RuntimeError("Sample data file not found: " + fileName)
+        headerFile = open(headerFileName(fileName), 'r')
+        self.header = json.load(headerFile)
+        headerFile.close()
+        if self.header.get("format") != "battlestar-sample" or self.header.get("version", 0) > formatVersion:
+            raise RuntimeError("Unrecognized sample file header for " + fileName)
+        self.fileName = fileName
+        self.name = sampleName(fileName)
+        self.contigNames = self.header["contigs"]
+        if memoryMap and self.header["rows"]:
+            self.records = numpy.load(fileName, mmap_mode = 'r')
+        else:
+            self.records = numpy.load(fileName)
+
+    def __len__(self):
+        return len(self.records)
+
+    def contigCodes(self):
+        return self.records["contig"]
+
+    def contigs(self):  #contig name for every row, as an object array
+        import numpy
+        return numpy.array(self.contigNames, dtype = object)[self.records["contig"]]
+
+    def positions(self):
+        return self.records["pos"]
+
+    def contigRows(self, code):  #(first, last) rows for this contig, whose positions are sorted, or None if the file did not come in sorted by contig and position
+        if not "contigRows" in self.header:
+            return None
+        return tuple(self.header["contigRows"][code])
+
+    def ratios(self):  #always floats, dequantized if the file holds uint16 ratios
+        return decodeRatios(self.records["ratio"])
+
+    def byContig(self):  #yields (contig name, positions, ratios) for each contig present in the sample
+        import numpy
+        codes = numpy.asarray(self.records["contig"])
+        for code in numpy.unique(codes).tolist():
+            mask = codes == code
+            yield (self.contigNames[code], numpy.asarray(self.records["pos"][mask]), decodeRatios(numpy.asarray(self.records["ratio"][mask])))
+
+class LocusCounts(object):  #locus representation counts held as a sorted unique position array and a parallel count array for each contig
+
+    def __init__(self, compactionRows = 50000000):
+        self.positions = {}  #contig -> sorted unique int32 positions
+        self.counts = {}  #contig -> int32 counts, lined up with positions
+        self.pending = {}  #contig -> list of (positions, counts) that have not been merged in yet
+        self.pendingRows = 0
+        self.compactionRows = compactionRows  #merge pending arrays once this many rows are waiting, which keeps memory bounded
+
+    def addPositions(self, contig, positions, counts = None):
+        import numpy
+        positions = numpy.asarray(positions, dtype = numpy.int32)
+        if counts is None:
+            counts = numpy.ones(len(positions), dtype = numpy.int32)
+        try:
+            self.pending[contig].append((positions, numpy.asarray(counts, dtype = numpy.int32)))
+        except KeyError:
+            self.pending[contig] = [(positions, numpy.asarray(counts, dtype = numpy.int32))]
+        self.pendingRows += len(positions)
+        if self.pendingRows >= self.compactionRows:
+            self.compact()
+
+    def addSample(self, sample):  #every row in a sample file counts as one observation of its locus
+        for contig, positions, ratios in sample.byContig():
+            self.addPositions(contig, positions)
+
+    def addCounts(self, other):  #merges another set of counts (from a scatter job, for instance) into this one
+        other.compact()
+        for contig in other.contigs():
+            self.addPositions(contig, other.positions[contig], other.counts[contig])
+
+    def compact(self):  #folds pending arrays into the sorted unique arrays using unique/bincount
+        import numpy
+        for contig in list(self.pending.keys()):
+            positionChunks = [pair[0] for pair in self.pending[contig]]
+            countChunks = [pair[1] for pair in self.pending[contig]]
+            if contig in self.positions:
+                positionChunks.append(self.positions[contig])
+                countChunks.append(self.counts[contig])
+            allPositions = numpy.concatenate(positionChunks)
+            allCounts = numpy.concatenate(countChunks)
+            uniquePositions, inverse = numpy.unique(allPositions, return_inverse = True)
+            self.positions[contig] = uniquePositions.astype(numpy.int32)
+            self.counts[contig] = numpy.bincount(inverse.reshape(-1), weights = allCounts, minlength = len(uniquePositions)).astype(numpy.int32)
+        self.pending = {}
+        self.pendingRows = 0
+
+    def contigs(self):
+        self.compact()
+        return list(self.positions.keys())
+
+    def __len__(self):
+        self.compact()
+        return sum([len(self.positions[contig]) for contig in self.positions])
+
+    def accepted(self, minimumObservationCount):  #vectorized threshold, returns contig -> sorted positions seen at least this many times
+        self.compact()
+        acceptedLoci = {}
+        for contig in self.positions:
+            passing = self.positions[contig][self.counts[contig] >= minimumObservationCount]
+            if len(passing):
+                acceptedLoci[contig] = passing
+        return acceptedLoci
+
+    def save(self, fileName):
+        import numpy
+        self.compact()
+        contigs = list(self.positions.keys())
+        arrays = {"contigs" : numpy.array(contigs, dtype = str)}
+        for i in range(0, len(contigs)):
+            arrays["positions" + str(i)] = self.positions[contigs[i]]
+            arrays["counts" + str(i)] = self.counts[contigs[i]]
+        output = open(fileName, 'wb')
+        numpy.savez(output, **arrays)
+        output.close()
+
+    @classmethod
+    def load(cls, fileName):
+        import numpy
+        locusCounts = cls()
+        data = numpy.load(fileName)
+        contigs = data["contigs"].tolist()
+        for i in range(0, len(contigs)):
+            locusCounts.positions[contigs[i]] = data["positions" + str(i)]
+            locusCounts.counts[contigs[i]] = data["counts" + str(i)]
+        data.close()
+        return locusCounts
+
+def saveAcceptedLoci(fileName, acceptedLoci):  #acceptedLoci is contig -> sorted position array
+    import numpy
+    contigs = list(acceptedLoci.keys())
+    arrays = {"contigs" : numpy.array(contigs, dtype = str)}
+    for i in range(0, len(contigs)):
+        arrays["positions" + str(i)] = numpy.asarray(acceptedLoci[contigs[i]], dtype = numpy.int32)
+    output = open(fileName, 'wb')
+    numpy.savez(output, **arrays)
+    output.close()
+
+def loadAcceptedLoci(fileName):
+    import os
+    import numpy
+    if not os.path.isfile(fileName):
+        raise RuntimeError("Unable to find accepted loci file: " + fileName)
+    data = numpy.load(fileName)
+    contigs = data["contigs"].tolist()
+    acceptedLoci = {}
+    for i in range(0, len(contigs)):
+        acceptedLoci[contigs[i]] = data["positions" + str(i)]
+    data.close()
+    return acceptedLoci
+
+def orderContigs(unsortedContigs):  #numbered contigs in numeric order, then named ones, then the mitochondria
+    numberedContigs = []
+    namedContigs = []
+    chrM = False
+    for contig in unsortedContigs:
+        try:
+            contig = int(contig)
+            numberedContigs.append(contig)
+        except ValueError:
+            try:
+                contig = float(contig)
+                numberedContigs.append(contig)
+            except ValueError:
+                if contig.upper() == "M":
+                    chrM = True
+                    mContig = contig
+                else:
+                    namedContigs.append(contig)
+    numberedContigs.sort()
+    namedContigs.sort()
+    contigs = numberedContigs + namedContigs
+    if chrM:
+        contigs += mContig
+    return [str(contig) for contig in contigs]
+
+class AcceptedIndex(object):  #every accepted locus in final row order: one int32 position array with per-contig offsets, so that row numbers come from searchsorted instead of a dictionary of strings
+
+    def __init__(self, contigs, offsets, positions):
+        self.contigs = list(contigs)  #contig names in output order
+        self.offsets = list(offsets)  #offsets[i] to offsets[i + 1] is the slice of positions belonging to contigs[i]
+        self.positions = positions  #sorted within each contig
+        self.contigNumbers = {}
+        for i in range(0, len(self.contigs)):
+            self.contigNumbers[self.contigs[i]] = i
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    @classmethod
+    def fromAcceptedLoci(cls, acceptedLoci, contigOrder):
+        import numpy
+        offsets = [0]
+        for contig in contigOrder:
+            offsets.append(offsets[-1] + len(acceptedLoci[contig]))
+        if contigOrder:
+            positions = numpy.concatenate([numpy.asarray(acceptedLoci[contig], dtype = numpy.int32) for contig in contigOrder])
+        else:
+            positions = numpy.zeros(0, dtype = numpy.int32)
+        return cls(contigOrder, offsets, positions)
+
+    def save(self, baseName):  #writes baseName.npy (positions) and baseName.json (contigs and offsets)
+        import json
+        import numpy
+        output = open(baseName + ".npy", 'wb')
+        numpy.save(output, self.positions)
+        output.close()
+        headerFile = open(baseName + ".json", 'w')
+        json.dump({"contigs" : self.contigs, "offsets" : self.offsets}, headerFile)
+        headerFile.close()
+
+    @classmethod
+    def load(cls, baseName, memoryMap = True):
+        import json
+        import os
+        import numpy
+        if not os.path.isfile(baseName + ".json"):
+            raise RuntimeError("Unable to find accepted locus index: " + baseName + ".json")
+        headerFile = open(baseName + ".json", 'r')
+        header = json.load(headerFile)
+        headerFile.close()
+        if memoryMap and header["offsets"][-1]:
+            positions = numpy.load(baseName + ".npy", mmap_mode = 'r')
+        else:
+            positions = numpy.load(baseName + ".npy")
+        return cls(header["contigs"], header["offsets"], positions)
+
+    def contigPositions(self, contig):
+        number = self.contigNumbers[contig]
+        return self.positions[self.offsets[number]:self.offsets[number + 1]]
+
+    def lookup(self, contig, positions):  #returns (mask of positions that are accepted, their row numbers in the index)
+        import numpy
+        positions = numpy.asarray(positions)
+        if not contig in self.contigNumbers:
+            return (numpy.zeros(len(positions), dtype = bool), numpy.zeros(0, dtype = numpy.int64))
+        accepted = numpy.asarray(self.contigPositions(contig))
+        slots = numpy.searchsorted(accepted, positions)
+        found = slots < len(accepted)
+        found[found] = accepted[slots[found]] == positions[found]
+        return (found, slots[found] + self.offsets[self.contigNumbers[contig]])
+
+    def lookupSample(self, sample):  #returns (row numbers in the sample, matching row numbers in the index) for every accepted locus in a sample
+        import numpy
+        codes = numpy.asarray(sample.contigCodes())
+        positions = numpy.asarray(sample.positions())
+        sampleRows = []
+        indexRows = []
+        for code in numpy.unique(codes).tolist():
+            rows = numpy.flatnonzero(codes == code)
+            found, matches = self.lookup(sample.contigNames[code], positions[rows])
+            sampleRows.append(rows[found])
+            indexRows.append(matches)
+        if not sampleRows:
+            return (numpy.zeros(0, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.int64))
+        return (numpy.concatenate(sampleRows), numpy.concatenate(indexRows))
+
+    def rowLabels(self, start, end):  #"contig:position" strings for rows start to end only, so a block of output can be labelled without building every label
+        import bisect
+        labels = []
+        number = max(0, bisect.bisect_right(self.offsets, start) - 1)
+        row = start
+        while row < end and number < len(self.contigs):
+            stop = min(end, self.offsets[number + 1])
+            contig = self.contigs[number]
+            labels.extend([contig + ":" + str(position) for position in self.positions[row:stop].tolist()])
+            row = stop
+            number += 1
+        return labels
+
+    def labels(self):  #"contig:position" strings in row order, for labelling output tables
+        labels = []
+        for contig in self.contigs:
+            labels.extend([contig + ":" + str(position) for position in self.contigPositions(contig).tolist()])
+        return labels
+
+class ResultMatrix(object):  #loci x samples matrix on disk, stored one sample column after another.  Each column starts on its own page so that jobs on different nodes can write their columns without touching each other's pages.  A matrix can also be a remapped view of a data file, with a row map (row -> slot within each column) and a physical column for each sample, which is how the cohort store adds loci and samples without moving what is already there.
+
+    pageBytes = 4096
+
+    def __init__(self, baseName, rows, sampleNames, dataType = "float32", mode = 'r', slots = None, columns = None, rowMap = None, matrixFileName = None):
+        import numpy
+        self.baseName = baseName
+        self.rows = rows
+        self.sampleNames = list(sampleNames)
+        self.dataType = numpy.dtype(dataType)
+        if slots is None:
+            slots = rows
+        self.slots = slots  #values each column has room for, at least rows
+        valuesPerPage = self.pageBytes // self.dataType.itemsize
+        self.columnStride = -(-max(slots, 1) // valuesPerPage) * valuesPerPage  #slots rounded up to a whole number of pages
+        self.mode = mode
+        self.columnNumbers = {}
+        for i in range(0, len(self.sampleNames)):
+            self.columnNumbers[self.sampleNames[i]] = i
+        if columns is None:
+            columns = list(range(0, len(self.sampleNames)))
+        self.columns = list(columns)  #physical column in the data file for each sample
+        self.rowMap = rowMap  #None if row i is slot i
+        self.matrixFileName = matrixFileName or baseName + ".matrix"
+
+    def remapped(self):
+        return self.rowMap is not None or self.columns != list(range(0, len(self.sampleNames)))
+
+    @classmethod
+    def create(cls, baseName, rows, sampleNames, dataType = "float32", slots = None):  #lays out an empty matrix file.  Columns are filled in by whoever processes each sample.
+        matrix = cls(baseName, rows, sampleNames, dataType, mode = 'r+', slots = slots)
+        matrix.saveHeader()
+        matrixFile = open(matrix.matrixFileName, 'wb')
+        matrixFile.truncate(matrix.columnStride * matrix.dataType.itemsize * len(matrix.sampleNames))  #sparse file, nothing actually gets written here
+        matrixFile.close()
+        return matrix
+
+    def saveHeader(self):  #the row map goes next to the header, and file names are kept relative so the directory can move
+        import json
+        import os
+        import numpy
+        header = {"rows" : self.rows, "samples" : self.sampleNames, "dataType" : self.dataType.str, "columnStride" : self.columnStride}
+        if self.slots != self.rows:
+            header["slots"] = self.slots
+        if self.remapped():
+            header["columns"] = self.columns
+            header["matrixFile"] = os.path.basename(self.matrixFileName)
+        if self.rowMap is not None:
+            rowMapFile = open(self.baseName + ".rows.npy", 'wb')
+            numpy.save(rowMapFile, numpy.asarray(self.rowMap, dtype = numpy.int64))
+            rowMapFile.close()
+            header["rowMap"] = os.path.basename(self.baseName + ".rows.npy")
+        headerFile = open(self.baseName + ".json.tmp", 'w')
+        json.dump(header, headerFile)
+        headerFile.close()
+        os.rename(self.baseName + ".json.tmp", self.baseName + ".json")
+
+    @classmethod
+    def open(cls, baseName, mode = 'r'):
+        import json
+        import os
+        import numpy
+        if not os.path.isfile(baseName + ".json"):
+            raise RuntimeError("Unable to find result matrix header: " + baseName + ".json")
+        headerFile = open(baseName + ".json", 'r')
+        header = json.load(headerFile)
+        headerFile.close()
+        directory = os.path.dirname(baseName)
+        rowMap = None
+        if "rowMap" in header:
+            rowMap = numpy.load(os.path.join(directory, header["rowMap"]), mmap_mode = 'r')
+        matrixFileName = None
+        if "matrixFile" in header:
+            matrixFileName = os.path.join(directory, header["matrixFile"])
+        return cls(baseName, header["rows"], header["samples"], header["dataType"], mode, header.get("slots"), header.get("columns"), rowMap, matrixFileName)
+
+    def files(self):  #everything this matrix reads
+        files = [self.baseName + ".json", self.matrixFileName]
+        if self.rowMap is not None:
+            files.append(self.baseName + ".rows.npy")
+        return files
+
+    def columnNumber(self, sampleName):
+        try:
+            return self.columnNumbers[sampleName]
+        except KeyError:
+            raise RuntimeError("Sample " + sampleName + " does not have a column in the result matrix " + self.baseName)
+
+    def columnSlots(self, sampleName, mode = 'r'):  #every slot of this sample's column in the data file
+        import numpy
+        return numpy.memmap(self.matrixFileName, dtype = self.dataType, mode = mode, offset = self.columns[self.columnNumber(sampleName)] * self.columnStride * self.dataType.itemsize, shape = (self.slots,))
+
+    def rowSlots(self):  #the slot holding each row
+        import numpy
+        if self.rowMap is None:
+            return numpy.arange(self.rows, dtype = numpy.int64)
+        return numpy.asarray(self.rowMap)
+
+    def writeColumn(self, sampleName, values, rows = None):  #maps just this sample's column and writes it in one go, or only the given rows.  Float values going into a uint16 matrix are quantized.
+        import numpy
+        if ratioEncodingOf(self.dataType) == "uint16" and ratioEncodingOf(numpy.asarray(values).dtype) != "uint16":
+            values = quantizeRatios(values)
+        column = self.columnSlots(sampleName, 'r+')
+        if rows is None and self.rowMap is None:
+            column[:self.rows] = values
+        elif rows is None:
+            column[self.rowMap] = values
+        elif self.rowMap is None:
+            column[rows] = values
+        else:
+            column[numpy.asarray(self.rowMap)[rows]] = values
+        column.flush()
+        del column
+
+    def readColumn(self, sampleName):  #one sample's values in row order, in the matrix encoding
+        import numpy
+        column = self.columnSlots(sampleName)
+        if self.rowMap is None:
+            return numpy.array(column[:self.rows])
+        return column[self.rowMap]
+
+    def array(self):  #the whole matrix as a loci x samples view of a memory map.  A remapped matrix has to be gathered into memory, so use block for those.
+        import numpy
+        if self.remapped():
+            return self.block()
+        if not self.rows or not self.sampleNames:
+            return numpy.zeros((self.rows, len(self.sampleNames)), dtype = self.dataType)
+        matrix = numpy.memmap(self.matrixFileName, dtype = self.dataType, mode = 'r', shape = (len(self.sampleNames), self.columnStride))
+        return matrix[:, :self.rows].T
+
+    def block(self, start = 0, end = None):  #rows start to end in the matrix encoding, read straight from their slots
+        import numpy
+        if end is None:
+            end = self.rows
+        if not self.remapped():
+            return numpy.asarray(self.array()[start:end])
+        if end <= start or not self.sampleNames:
+            return numpy.zeros((max(end - start, 0), len(self.sampleNames)), dtype = self.dataType)
+        matrix = numpy.memmap(self.matrixFileName, dtype = self.dataType, mode = 'r', shape = (max(self.columns) + 1, self.columnStride))
+        if self.rowMap is None:
+            slots = numpy.arange(start, end)
+        else:
+            slots = numpy.asarray(self.rowMap[start:end])
+        return matrix[numpy.ix_(self.columns, slots)].T
+
+    def values(self, start = 0, end = None):  #rows start to end as floats, dequantized if the matrix is uint16
+        return decodeRatios(self.block(start, end))
+
+sparseSuffix = ".sparse.npz"  #one sample's observed (row, ratio) entries from filter 2
+
+def writeSparseColumn(fileName, indexRows, ratios, quantize = False):  #keeps only what the sample observed.  If a locus shows up twice, the last one wins, same as when a dense column is filled in.
+    import os
+    import numpy
+    indexRows = numpy.asarray(indexRows, dtype = numpy.int64)
+    reversedRows = indexRows[::-1]
+    uniqueRows, firstInReverse = numpy.unique(reversedRows, return_index = True)
+    keep = len(indexRows) - 1 - firstInReverse
+    output = open(fileName + ".tmp", 'wb')
+    if quantize:
+        values = quantizeRatios(numpy.asarray(ratios)[keep])
+    else:
+        values = numpy.asarray(ratios, dtype = numpy.float32)[keep]
+    numpy.savez(output, rows = uniqueRows.astype(numpy.int32), values = values)
+    output.close()
+    os.rename(fileName + ".tmp", fileName)
+
+def readSparseColumn(fileName):
+    import numpy
+    data = numpy.load(fileName)
+    rows = data["rows"]
+    values = data["values"]
+    data.close()
+    return (rows, values)
+
+def writeSparseResult(fileName, sampleNames, sparseColumns, acceptedIndex):  #loci x samples in CSR, laid out the way scipy.sparse.save_npz does it so that scipy.sparse.load_npz can open it, plus the labels we need.  sparseColumns is a list of (rows, values) in sample order.
+    import os
+    import numpy
+    rowChunks = [numpy.asarray(rows, dtype = numpy.int64) for rows, values in sparseColumns]
+    columnChunks = [numpy.full(len(sparseColumns[i][0]), i, dtype = numpy.int32) for i in range(0, len(sparseColumns))]
+    valueChunks = [numpy.asarray(values) for rows, values in sparseColumns]  #kept in whatever encoding filter 2 wrote
+    if sparseColumns:
+        rows = numpy.concatenate(rowChunks)
+        columns = numpy.concatenate(columnChunks)
+        values = numpy.concatenate(valueChunks)
+    else:
+        rows = numpy.zeros(0, dtype = numpy.int64)
+        columns = numpy.zeros(0, dtype = numpy.int32)
+        values = numpy.zeros(0, dtype = numpy.float32)
+    ratioEncoding = ratioEncodingOf(values.dtype)
+    order = numpy.lexsort((columns, rows))  #row major, then column within each row
+    indptr = numpy.zeros(len(acceptedIndex) + 1, dtype = numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength = len(acceptedIndex)), out = indptr[1:])
+    output = open(fileName + ".tmp", 'wb')
+    numpy.savez(output,
+                format = numpy.array("csr"),
+                shape = numpy.array([len(acceptedIndex), len(sampleNames)], dtype = numpy.int64),
+                indptr = indptr,
+                indices = columns[order],
+                data = values[order],
+                samples = numpy.array(sampleNames, dtype = str),
+                contigs = numpy.array(acceptedIndex.contigs, dtype = str),
+                offsets = numpy.array(acceptedIndex.offsets, dtype = numpy.int64),
+                positions = numpy.asarray(acceptedIndex.positions, dtype = numpy.int32),
+                ratioEncoding = numpy.array(ratioEncoding))
+    output.close()
+    os.rename(fileName + ".tmp", fileName)
+
+class SparseResult(object):  #reader for the sparse output.  Only the observed entries are held, and rows can be expanded to a dense frame a slice at a time.
+
+    def __init__(self, fileName):
+        import numpy
+        data = numpy.load(fileName)
+        if str(data["format"]) != "csr":
+            raise RuntimeError("Expected a CSR sparse result in " + fileName)
+        self.shape = tuple(data["shape"].tolist())
+        self.indptr = data["indptr"]
+        self.indices = data["indices"]
+        self.data = decodeRatios(data["data"])  #stored quantized if it was written that way, but always handed out as floats
+        self.samples = data["samples"].tolist()
+        self.index = AcceptedIndex(data["contigs"].tolist(), data["offsets"].tolist(), data["positions"])
+        data.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def fillRates(self):  #fraction of loci observed in each sample
+        import numpy
+        import pandas
+        return pandas.Series(numpy.bincount(self.indices, minlength = self.shape[1]) / max(self.shape[0], 1), index = self.samples)
+
+    def toDataFrame(self, start = 0, end = None):  #rows start to end as a dense frame with NaN where nothing was observed
+        import numpy
+        import pandas
+        if end is None:
+            end = self.shape[0]
+        first = self.indptr[start]
+        last = self.indptr[end]
+        dense = numpy.full((end - start, self.shape[1]), numpy.nan, dtype = self.data.dtype)
+        rowNumbers = numpy.repeat(numpy.arange(start, end), numpy.diff(self.indptr[start:end + 1])) - start
+        dense[rowNumbers, self.indices[first:last]] = self.data[first:last]
+        return pandas.DataFrame(dense, index = self.index.rowLabels(start, end), columns = self.samples)
@@ -15,11 +15,14 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-f", "--fileList", help = "List of files to process, separated by a comma.")
         parser.add_argument("-t", "--tempdir", help = "Holds the name of the temporary directory we are using.")
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
-        parser.add_argument("-m", "--emptyCellMarker", help = "Marker for blank cells.", default = "")
-
+        parser.add_argument("-x", "--resultMatrix", help = "Write each sample's column straight into this shared result matrix (base name, without extension) instead of pickling it")
+        parser.add_argument("-s", "--sparse", help = "Write only each sample's observed loci and ratios instead of a full column", action = 'store_true')
+        parser.add_argument("-q", "--quantizeRatios", help = "Store sparse ratios as 16-bit integers (within 7.6e-6 of the original value)", action = 'store_true')
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 self.tempdir = rawArgs.tempdir
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
@@ -34,84 +37,89 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
                 raise RuntimeError("Filtered data file not found: " + file)
         self.fileList = fileList
         self.verbose = rawArgs.verbose
-        self.emptyCellMarker = rawArgs.emptyCellMarker
+        if rawArgs.resultMatrix:
+            if not os.path.isfile(rawArgs.resultMatrix + ".json"):
+                raise RuntimeError("Result matrix not found: " + rawArgs.resultMatrix)
+            self.resultMatrix = rawArgs.resultMatrix
+        else:
+            self.resultMatrix = False
+        if rawArgs.sparse and rawArgs.resultMatrix:
+            raise RuntimeError("Sparse output and a shared result matrix are two different ways of storing the same thing.  Please pick one.")
+        self.sparse = rawArgs.sparse
+        self.quantizeRatios = rawArgs.quantizeRatios
         
-def filterFile(fileName, acceptedLocusTree, acceptedCoordinateIndex):
-    import pickle
-    file = open(fileName, 'rb')
-    rawData = pickle.load(file)
-    file.close()
-    filteredData = [args.emptyCellMarker] * len(acceptedCoordinateIndex.keys())
-    progress = 0
-    accepted = 0
-    for line in rawData:
-        contig, position, ratio = line
-        group = position // 1000000
-        try:
-            acceptedLocus = acceptedLocusTree[contig][group][position]
-        except KeyError:
-            acceptedLocus = False
-        if acceptedLocus:
-            accepted += 1
-            coordinates = contig + ":" + str(position)
-            filteredData[acceptedCoordinateIndex[coordinates]] = ratio
-        progress += 1
-        if args.verbose:
-            if progress % 10000 == 0:
-                print(str(accepted) + " of " + str(progress) + " loci in this sample were adequately represented in other samples.                  ", end = "\r")
+def matchSample(fileName, acceptedIndex):  #returns (row numbers in the accepted index, ratios) for every accepted locus in the sample
+    import numpy
+    import colonialOne
+    sample = colonialOne.SampleData(fileName)
+    sampleRows, indexRows = acceptedIndex.lookupSample(sample)  #membership and row number for every locus in the sample at once
+    recorder.readFile(fileName)
+    recorder.count("rowsRead", len(sample))
+    recorder.count("rowsAccepted", len(sampleRows))
+    recorder.reject("representation", len(sample) - len(sampleRows))
     if args.verbose:
-        print(str(accepted) + " of " + str(progress) + " loci in this sample were adequately represented in other samples.                  ")
-    return filteredData
+        print(str(len(sampleRows)) + " of " + str(len(sample)) + " loci in this sample were adequately represented in other samples.                  ")
+    return (indexRows, numpy.asarray(sample.ratios())[sampleRows])
 
-def getAcceptedLocusTree():
-    import os
-    import pickle
-    fileName = args.tempdir + os.sep + "loci" + os.sep + "acceptedLoci.pkl"
-    if not os.path.isfile(fileName):
-        raise RuntimeError("Unable to find accepted locus tree file: " + fileName)
-    file = open(fileName, 'rb')
-    acceptedLocusTree = pickle.load(file)
-    file.close()
-    return acceptedLocusTree
+def filterFile(fileName, acceptedIndex):  #the sample's column as a float array, with NaN for loci it did not report.  The empty cell marker only goes in when the table is written.
+    import numpy
+    indexRows, ratios = matchSample(fileName, acceptedIndex)
+    filteredData = numpy.full(len(acceptedIndex), numpy.nan, dtype = numpy.float32)
+    filteredData[indexRows] = ratios
+    return filteredData
 
-def getAcceptedCoordiateList():
-    import os
-    import pickle
-    coordinateListFileName = args.tempdir + os.sep + 'loci' + os.sep + 'acceptedCoordinateList.pkl'
-    coordinateListFile = open(coordinateListFileName,'rb')
-    coordinateList = pickle.load(coordinateListFile)
-    coordinateListFile.close()
-    return coordinateList
+def writeMatrixColumn(fileName, acceptedIndex, resultMatrix):  #fills in this sample's column of the shared matrix, with NaN for loci it did not report
+    import numpy
+    import colonialOne
+    indexRows, ratios = matchSample(fileName, acceptedIndex)
+    column = numpy.full(len(acceptedIndex), numpy.nan, dtype = numpy.float32)  #the matrix quantizes it on the way in if it holds uint16
+    column[indexRows] = ratios
+    resultMatrix.writeColumn(colonialOne.sampleName(fileName), column)
+    recorder.bytesOut += len(column) * resultMatrix.dataType.itemsize
 
-def getAcceptedCoordinateIndex():
+def getAcceptedIndex():
     import os
-    import pickle
-    coordinateIndexFileName = args.tempdir + os.sep + 'loci' + os.sep + 'acceptedCoordinateIndex.pkl'
-    coordinateIndexFile = open(coordinateIndexFileName,'rb')
-    coordinateIndex = pickle.load(coordinateIndexFile)
-    return coordinateIndex
+    import colonialOne
+    return colonialOne.AcceptedIndex.load(args.tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')
 
 def main():
     import pickle
     import datetime
     import os
+    import colonialOne
+    import flightRecorder
     start = datetime.datetime.now()
     global args
     args = CheckArgs()
-    acceptedLocusTree = getAcceptedLocusTree()
-    acceptedCoordinateList = getAcceptedCoordiateList()
-    acceptedCoordinateIndex = getAcceptedCoordinateIndex()
+    global recorder
+    recorder = flightRecorder.FlightRecorder("cylonRaider", args.tempdir, args.profile)
+    acceptedIndex = getAcceptedIndex()
+    if args.resultMatrix:
+        resultMatrix = colonialOne.ResultMatrix.open(args.resultMatrix, mode = 'r+')
     progress = 1
     filteredData = {}
     for file in args.fileList:
         if args.verbose and len(args.fileList) > 1:
             print("Processing file " + str(progress) + " of " + str(len(args.fileList)) + ".     ")
             progress += 1
-        filteredData[file.split(os.sep)[-1].split(".")[0]] = filterFile(file, acceptedLocusTree, acceptedCoordinateIndex)
-    filteredFileName = args.tempdir + os.sep + "filter2" + os.sep + file.split(os.sep)[-1]
-    filteredFile = open(filteredFileName, 'wb')
-    pickle.dump(filteredData, filteredFile)
-    filteredFile.close()
+        if args.resultMatrix:
+            writeMatrixColumn(file, acceptedIndex, resultMatrix)
+        elif args.sparse:
+            indexRows, ratios = matchSample(file, acceptedIndex)
+            sparseFileName = args.tempdir + os.sep + "filter2" + os.sep + file.split(os.sep)[-1].replace(colonialOne.sampleSuffix, colonialOne.sparseSuffix)
+            colonialOne.writeSparseColumn(sparseFileName, indexRows, ratios, args.quantizeRatios)
+            recorder.wroteFile(sparseFileName)
+        else:
+            filteredData[colonialOne.sampleName(file)] = filterFile(file, acceptedIndex)
+    if not args.resultMatrix and not args.sparse:
+        filteredFileName = args.tempdir + os.sep + "filter2" + os.sep + file.split(os.sep)[-1].replace(colonialOne.sampleSuffix, ".data.pkl")
+        filteredFile = open(filteredFileName + ".tmp", 'wb')
+        with recorder.timing("pickleDump"):
+            pickle.dump(filteredData, filteredFile)
+        filteredFile.close()
+        os.rename(filteredFileName + ".tmp", filteredFileName)  #only shows up under its real name once it is complete, so a resumed run never takes half a pickle as finished
+        recorder.wroteFile(filteredFileName)
+    recorder.finish()
     if args.verbose:
         runtime = datetime.datetime.now() - start
         print("Locus representation filtering completed in " + str(runtime))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#DRADIS decides what is worth tracking.  This module holds the locus filters (coverage, context, ratio range, contig lists, target regions) shared by viper and refinery.  The requested predicates are compiled once into a list of functions that each turn a whole parsed chunk into a boolean mask, and every rejected row is counted against the first predicate it failed.
+
+def contigList(rawList):  #comma separated contig names or fnmatch patterns (M, Un*, *_random) to a list, with chr dropped the same way the parsers drop it from contig names.  A pattern that was only chr and wildcards (chr*) would then match every contig, so it is refused rather than quietly keeping or dropping everything.
+    if not rawList:
+        return []
+    patterns = []
+    for item in rawList.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        pattern = item.replace("chr", "")
+        if pattern != item and not pattern.strip("*?"):
+            raise RuntimeError("Contig pattern " + item + " would match every contig, since contig names are matched with chr dropped (1, X, GL*).")
+        patterns.append(pattern)
+    return patterns
+
+def contigMatches(contig, patterns):
+    import fnmatch
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(contig, pattern):
+            return True
+    return False
+
+class RegionIndex(object):  #target regions as per-contig sorted, merged intervals.  Starts and ends are 1-based and inclusive, like the positions in a .ratio file.
+
+    def __init__(self, starts, ends):  #contig -> start array and contig -> end array, sorted and not overlapping
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def fromIntervals(cls, intervals):  #contig -> list of (start, end) in any order, overlaps allowed
+        import numpy
+        starts = {}
+        ends = {}
+        for contig in intervals:
+            intervalArray = numpy.array(intervals[contig], dtype = numpy.int64).reshape(-1, 2)
+            order = numpy.argsort(intervalArray[:, 0], kind = "stable")
+            contigStarts = intervalArray[order, 0]
+            contigEnds = intervalArray[order, 1]
+            reach = numpy.maximum.accumulate(contigEnds)  #furthest any interval so far gets
+            newRun = numpy.ones(len(contigStarts), dtype = bool)
+            newRun[1:] = contigStarts[1:] > reach[:-1] + 1  #overlapping or touching intervals merge into one
+            runStarts = numpy.flatnonzero(newRun)
+            starts[contig] = contigStarts[runStarts]
+            ends[contig] = numpy.maximum.reduceat(contigEnds, runStarts)
+        return cls(starts, ends)
+
+    @classmethod
+    def fromBed(cls, fileName):  #BED intervals are 0-based and half open, so [start, end) becomes start + 1 to end.  Plain or gzipped.
+        import tylium
+        intervals = {}
+        bedFile = tylium.openRatioFile(fileName)
+        lineNumber = 0
+        for line in bedFile:
+            lineNumber += 1
+            fields = line.split()
+            if not fields or fields[0].startswith("#") or fields[0] in ["track", "browser"]:
+                continue
+            try:
+                start = int(fields[1])
+                end = int(fields[2])
+            except (ValueError, IndexError):
+                bedFile.close()
+                raise RuntimeError("Unable to read an interval from line " + str(lineNumber) + " of " + fileName)
+            if end <= start:
+                continue  #empty interval
+            contig = fields[0].replace("chr", "")
+            if not contig in intervals:
+                intervals[contig] = []
+            intervals[contig].append((start + 1, end))
+        bedFile.close()
+        if not intervals:
+            raise RuntimeError("No intervals found in region file " + fileName)
+        return cls.fromIntervals(intervals)
+
+    def save(self, fileName):
+        import numpy
+        contigs = list(self.starts.keys())
+        arrays = {"contigs" : numpy.array(contigs, dtype = str)}
+        for i in range(0, len(contigs)):
+            arrays["starts" + str(i)] = self.starts[contigs[i]]
+            arrays["ends" + str(i)] = self.ends[contigs[i]]
+        output = open(fileName, 'wb')
+        numpy.savez(output, **arrays)
+        output.close()
+
+    @classmethod
+    def load(cls, fileName):  #a saved index (.npz) or a BED file
+        import numpy
+        if not fileName.endswith(".npz"):
+            return cls.fromBed(fileName)
+        data = numpy.load(fileName)
+        contigs = [str(contig) for contig in data["contigs"]]
+        starts = {}
+        ends = {}
+        for i in range(0, len(contigs)):
+            starts[contigs[i]] = data["starts" + str(i)]
+            ends[contigs[i]] = data["ends" + str(i)]
+        return cls(starts, ends)
+
+    def __len__(self):
+        return sum([len(self.starts[contig]) for contig in self.starts])
+
+    def coveredBases(self):
+        return int(sum([(self.ends[contig] - self.starts[contig] + 1).sum() for contig in self.starts]))
+
+    def contains(self, contig, positions):  #which positions on this contig fall inside an interval
+        import numpy
+        positions = numpy.asarray(positions)
+        if not contig in self.starts:
+            return numpy.zeros(len(positions), dtype = bool)
+        interval = numpy.searchsorted(self.starts[contig], positions, side = "right") - 1  #last interval starting at or before each position
+        return (interval >= 0) & (positions <= self.ends[contig][numpy.maximum(interval, 0)])
+
+class LocusFilter(object):
+
+    def __init__(self, minCoverage = 0, maxCoverage = 0, contextRequirement = [], contextExclusion = [], minRatio = None, maxRatio = None, contigAllow = [], contigDeny = [], regions = None):  #a maxCoverage of 0 means no ceiling, a ratio bound of None means no bound and regions is a RegionIndex
+        self.minCoverage = minCoverage
+        self.maxCoverage = maxCoverage
+        self.contextRequirement = contextRequirement
+        self.contextExclusion = contextExclusion
+        self.minRatio = minRatio
+        self.maxRatio = maxRatio
+        self.contigAllow = contigAllow
+        self.contigDeny = contigDeny
+        self.regions = regions
+        for item in contextRequirement:
+            if item in contextExclusion:
+                raise RuntimeError("Error, " + item + " is included in both the requirement and exclusion lists.")
+        for item in contigAllow:
+            if item in contigDeny:
+                raise RuntimeError("Error, contig " + item + " is included in both the allow and deny lists.")
+        if maxCoverage and maxCoverage < minCoverage:
+            raise RuntimeError("Maximum coverage (" + str(maxCoverage) + ") is below the minimum coverage (" + str(minCoverage) + ").")
+        if minRatio is not None and maxRatio is not None and maxRatio < minRatio:
+            raise RuntimeError("Maximum ratio (" + str(maxRatio) + ") is below the minimum ratio (" + str(minRatio) + ").")
+        self.predicates = self.compile()  #(rejection reason, function of a chunk returning the rows that pass), cheapest first
+        self.rejected = dict([(reason, 0) for reason in ["badLine"] + [predicate[0] for predicate in self.predicates]])
+        self.contigDecisions = {}  #contig name -> passes the contig lists, since a file only has a handful of names
+
+    def compile(self):
+        predicates = [("coverage", lambda chunk: chunk.coverage >= self.minCoverage)]  #always there, as it always has been
+        if self.maxCoverage:
+            predicates.append(("maxCoverage", lambda chunk: chunk.coverage <= self.maxCoverage))
+        if self.minRatio is not None or self.maxRatio is not None:
+            predicates.append(("ratioRange", self.ratioInRange))
+        if self.contigAllow or self.contigDeny:
+            predicates.append(("contig", self.contigPasses))
+        if self.regions is not None:
+            predicates.append(("region", self.inRegions))
+        if self.contextRequirement:
+            predicates.append(("context", lambda chunk: self.contextIn(chunk, self.contextRequirement)))
+        if self.contextExclusion:
+            predicates.append(("contextExclusion", lambda chunk: ~self.contextIn(chunk, self.contextExclusion)))
+        return predicates
+
+    def ratioInRange(self, chunk):
+        import numpy
+        passes = numpy.ones(len(chunk), dtype = bool)
+        if self.minRatio is not None:
+            passes &= chunk.ratio >= self.minRatio
+        if self.maxRatio is not None:
+            passes &= chunk.ratio <= self.maxRatio
+        return passes
+
+    def contigPasses(self, chunk):  #decides once per distinct contig name and spreads the answers back over the rows
+        import numpy
+        import pandas
+        codes, names = pandas.factorize(chunk.contig)
+        decisions = numpy.zeros(len(names), dtype = bool)
+        for i in range(0, len(names)):
+            name = str(names[i])
+            if not name in self.contigDecisions:
+                self.contigDecisions[name] = (not self.contigAllow or contigMatches(name, self.contigAllow)) and not contigMatches(name, self.contigDeny)
+            decisions[i] = self.contigDecisions[name]
+        return decisions[codes]
+
+    def inRegions(self, chunk):  #groups the rows by contig and does one searchsorted per contig present in the chunk
+        import numpy
+        import pandas
+        codes, names = pandas.factorize(chunk.contig)
+        order = numpy.argsort(codes, kind = "stable")
+        bounds = numpy.searchsorted(codes[order], numpy.arange(len(names) + 1))
+        inside = numpy.zeros(len(chunk), dtype = bool)
+        for i in range(0, len(names)):
+            rows = order[bounds[i]:bounds[i + 1]]
+            inside[rows] = self.regions.contains(str(names[i]), chunk.position[rows])
+        return inside
+
+    def contextIn(self, chunk, contexts):
+        import numpy
+        return numpy.isin(chunk.context, contexts)
+
+    def mask(self, chunk):  #rows of a tylium.RatioChunk that pass every predicate
+        import numpy
+        self.rejected["badLine"] += chunk.badLines
+        accepted = numpy.ones(len(chunk), dtype = bool)
+        for reason, predicate in self.predicates:
+            passes = predicate(chunk)
+            self.rejected[reason] += int(numpy.count_nonzero(accepted & ~passes))
+            accepted &= passes
+        return accepted
+
+    def apply(self, chunk):
+        return chunk.subset(self.mask(chunk))
+
+    def reportTo(self, recorder):  #hands the rejection counts to a flight recorder and starts counting again
+        for reason in self.rejected:
+            if self.rejected[reason]:
+                recorder.reject(reason, self.rejected[reason])
+            self.rejected[reason] = 0
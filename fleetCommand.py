@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#Fleet command decides where the jobs actually run.  Every stage hands its list of job argument strings to an executor, which either submits them as an SGE array job or runs them on a local pool of processes.
+
+defaultSGEInterpreter = "/u/local/apps/python/3.4.3/bin/python3"
+
+def scriptDirectory():  #the stage scripts live next to this file, so we can find them no matter where we were started from
+    import os
+    return os.path.dirname(os.path.abspath(__file__))
+
+def defaultInterpreter():
+    import os
+    import sys
+    if os.path.isfile(defaultSGEInterpreter):
+        return defaultSGEInterpreter
+    return sys.executable
+
+def makeArgumentString(arguments):  #turns a dictionary of flag -> value into a command line string, leaving out any flag without a value.  A value of True is a switch with nothing after it.
+    argumentList = []
+    for key in list(arguments.keys()):
+        if arguments[key] is True:
+            argumentList.append(key)
+        elif arguments[key]:
+            argumentList.append(key + " " + arguments[key])
+    return " ".join(argumentList)
+
+def detectCores():
+    import os
+    try:
+        return len(os.sched_getaffinity(0))  #respects any CPU restrictions placed on us
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def detectMemoryGB():
+    import os
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1000000000
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+def clockOutFlush(clockOutDir):
+    import os
+    import shutil
+    if os.path.isdir(clockOutDir):
+        shutil.rmtree(clockOutDir)
+    os.mkdir(clockOutDir)
+
+def packBySize(items, costs, binCount):  #longest processing time first: hand out the biggest items first, each to whichever bin has the least work so far.  Returns (bins, binCosts).
+    import heapq
+    if not items:
+        return ([], [])
+    binCount = max(1, min(binCount, len(items)))
+    bins = []
+    for i in range(0, binCount):
+        bins.append([])
+    binCosts = [0] * binCount
+    heap = [(0, i) for i in range(0, binCount)]
+    order = sorted(range(0, len(items)), key = lambda i: costs[i], reverse = True)
+    for i in order:
+        load, binNumber = heapq.heappop(heap)
+        bins[binNumber].append(items[i])
+        binCosts[binNumber] = load + costs[i]
+        heapq.heappush(heap, (binCosts[binNumber], binNumber))
+    return (bins, binCosts)
+
+filter1BaseGB = 0.5  #interpreter, numpy and pandas before we read anything
+filter1ExpansionFactor = 8  #a .ratio row takes roughly this many times its text size while it is being parsed
+
+def estimateFilter1MemoryGB(fileBytes, ceilingGB):  #what a filter 1 job needs for its largest file, never more than the ceiling since viper streams anything bigger under the ceiling
+    import math
+    estimate = int(math.ceil(filter1BaseGB + fileBytes * filter1ExpansionFactor / 1000000000))
+    return max(1, min(estimate, ceilingGB))
+
+def orderForArrayJob(jobs, memoryList):  #puts the lightest job first (it runs on the head node) and the rest in descending memory order, so tasks that need the same memory have contiguous task numbers
+    order = sorted(range(0, len(jobs)), key = lambda i: memoryList[i], reverse = True)
+    if order:
+        order = [order[-1]] + order[:-1]
+    return ([jobs[i] for i in order], [memoryList[i] for i in order])
+
+def memoryTiers(memoryList):  #groups array task numbers 1 to n-1 into (first, last, memoryGB) runs of equal memory
+    tiers = []
+    for task in range(1, len(memoryList)):
+        if tiers and tiers[-1][2] == memoryList[task] and tiers[-1][1] == task - 1:
+            tiers[-1][1] = task
+        else:
+            tiers.append([task, task, memoryList[task]])
+    return [tuple(tier) for tier in tiers]
+
+def treeReduce(executor, jobName, script, partialFiles, outputDirectory, suffix, clockOutName, fanIn = 8, memoryGB = 4, extraArguments = False):  #merges partial results fanIn at a time in parallel rounds until no more than fanIn are left, then hands those back for the head node to finish.  Rounds grow with the log of the number of partials.
+    import os
+    if fanIn < 2:
+        raise RuntimeError("Reduction fan in must be at least 2.  We got: " + str(fanIn))
+    partialFiles = list(partialFiles)
+    reductionRound = 0
+    while len(partialFiles) > fanIn:
+        reductionRound += 1
+        outputs = []
+        argumentStrings = []
+        consumed = []
+        for i in range(0, len(partialFiles), fanIn):
+            group = partialFiles[i:i + fanIn]
+            if len(group) == 1:  #nothing to merge it with this round
+                outputs.append(group[0])
+                continue
+            outputFile = outputDirectory + os.sep + "reduce.round" + str(reductionRound) + "." + str(len(outputs)) + suffix
+            arguments = {"--fileList" : ",".join(group),
+                         "--output" : outputFile}
+            if extraArguments:
+                arguments.update(extraArguments)
+            argumentStrings.append(makeArgumentString(arguments))
+            outputs.append(outputFile)
+            consumed += group
+        if executor.verbose:
+            print("Reduction round " + str(reductionRound) + ": merging " + str(len(partialFiles)) + " partials in " + str(len(argumentStrings)) + " jobs.")
+        executor.runJobs(jobName + str(reductionRound), script, argumentStrings, clockOutName, memoryGB)
+        for fileName in consumed:  #already folded into the next round
+            os.remove(fileName)
+        partialFiles = outputs
+    return partialFiles
+
+queueHeartbeatSeconds = 60  #how often a worker touches the claim file of the task it is running
+queueLeaseSeconds = 600  #a claim whose file has not changed for this long (by the waiting node's own clock) belongs to a dead worker
+queueRequeues = 1  #how many times a task abandoned by a dead worker gets put back before it counts as failed
+
+class TaskQueue(object):  #a directory of task files.  Workers claim a task by renaming it out of pending, which is atomic, so every task runs exactly once and fast workers simply end up taking more of them.  A worker killed mid task leaves its claim behind, so the node waiting on the queue puts stale claims back (or fails them) instead of waiting forever.
+
+    def __init__(self, queueDirectory):
+        import os
+        self.queueDirectory = queueDirectory
+        self.pending = queueDirectory + os.sep + "pending"
+        self.claimed = queueDirectory + os.sep + "claimed"
+        self.done = queueDirectory + os.sep + "done"
+        self.failed = queueDirectory + os.sep + "failed"
+        self.candidates = []  #pending task names this worker has not tried yet, listed once and walked in order instead of listing the directory for every claim
+
+    @classmethod
+    def create(cls, queueDirectory, commands):  #commands should already be in the order we want them taken (biggest first works best)
+        import os
+        import shutil
+        queue = cls(queueDirectory)
+        if os.path.isdir(queueDirectory):
+            shutil.rmtree(queueDirectory)
+        os.mkdir(queueDirectory)
+        for directory in [queue.pending + ".tmp", queue.claimed, queue.done, queue.failed]:
+            os.mkdir(directory)
+        for i in range(0, len(commands)):
+            taskFile = open(queue.pending + ".tmp" + os.sep + "%08d.task" % i, 'w')
+            taskFile.write(commands[i] + "\n")
+            taskFile.close()
+        os.rename(queue.pending + ".tmp", queue.pending)  #all of the tasks appear at once
+        return queue
+
+    def claim(self):  #returns (claimed task file, command) or None once the queue is empty
+        import os
+        import socket
+        if not os.path.isdir(self.pending):
+            return None
+        if not self.candidates:  #only list again once we have been through everything we saw last time, which also picks up requeued tasks
+            self.candidates = sorted(os.listdir(self.pending), reverse = True)  #popped from the end, so lowest task number first
+        while self.candidates:
+            name = self.candidates.pop()
+            claimedPath = self.claimed + os.sep + name + "." + socket.gethostname() + "." + str(os.getpid())
+            try:
+                os.rename(self.pending + os.sep + name, claimedPath)
+            except OSError:  #somebody else got it first
+                continue
+            taskFile = open(claimedPath, 'r')
+            command = taskFile.read().strip()
+            taskFile.close()
+            return (claimedPath, command)
+        return None
+
+    def finish(self, claimedPath, status):
+        import os
+        if status == 0:
+            os.rename(claimedPath, self.done + os.sep + os.path.basename(claimedPath))
+        else:
+            os.rename(claimedPath, self.failed + os.sep + os.path.basename(claimedPath))
+
+    def finishedCount(self):
+        import os
+        return len(os.listdir(self.done)) + len(os.listdir(self.failed))
+
+    def failures(self):
+        import os
+        return sorted(os.listdir(self.failed))
+
+    @staticmethod
+    def claimIsAlive(name):  #False if the claim was made on this host by a process that is gone.  Claims from other hosts can only be judged by their heartbeat.
+        import os
+        import socket
+        taskName, host, pid = name.rsplit(".", 2)
+        if host != socket.gethostname() or not pid.isdigit():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except OSError:  #exists but belongs to someone else
+            return True
+        return True
+
+    def recoverStaleClaims(self, lastSeen, requeues, leaseSeconds = queueLeaseSeconds, maxRequeues = queueRequeues):  #puts claims from dead workers back in pending, or fails them once they have been put back too often.  lastSeen maps claim name -> (mtime, when we first saw that mtime) and is only ever compared against our own clock.  Returns how many tasks went back in pending.
+        import os
+        import time
+        now = time.time()
+        requeued = 0
+        claims = os.listdir(self.claimed)
+        for name in list(lastSeen.keys()):
+            if not name in claims:
+                del lastSeen[name]
+        for name in claims:
+            try:
+                mtime = os.stat(self.claimed + os.sep + name).st_mtime_ns
+            except OSError:  #finished while we were looking
+                continue
+            if not name in lastSeen or lastSeen[name][0] != mtime:
+                lastSeen[name] = (mtime, now)
+            if self.claimIsAlive(name) and now - lastSeen[name][1] < leaseSeconds:
+                continue
+            taskName = name.rsplit(".", 2)[0]
+            requeues[taskName] = requeues.get(taskName, 0) + 1
+            try:
+                if requeues[taskName] > maxRequeues:
+                    os.rename(self.claimed + os.sep + name, self.failed + os.sep + name)
+                else:
+                    os.rename(self.claimed + os.sep + name, self.pending + os.sep + taskName)
+                    requeued += 1
+            except OSError:  #the worker finished it after all
+                continue
+            del lastSeen[name]
+        return requeued
+
+    def waitForTasks(self, taskCount, verbose = False, minimumWait = 0.05, maximumWait = 5, leaseSeconds = queueLeaseSeconds):  #waits until every task is done or failed, scanning with a backoff.  Tasks abandoned by dead workers are put back and worked here, since the other workers may all have exited by then.
+        import os
+        import time
+        delay = minimumWait
+        lastCount = -1
+        lastSeen = {}
+        requeues = {}
+        while True:
+            finished = self.finishedCount()
+            if verbose:
+                print("Completed " + str(finished) + " of " + str(taskCount) + " tasks.       ", end = "\r")
+            if finished >= taskCount:
+                break
+            if self.recoverStaleClaims(lastSeen, requeues, leaseSeconds):
+                if verbose:
+                    print("Rerunning tasks abandoned by workers that stopped.")
+                runQueueWorker(self.queueDirectory)
+                continue
+            if not os.listdir(self.pending) and not os.listdir(self.claimed) and self.finishedCount() < taskCount:  #no worker holds anything and there is nothing left to take, so nothing more will ever finish
+                raise RuntimeError("Task queue " + self.queueDirectory + " has " + str(taskCount - self.finishedCount()) + " task(s) that are neither pending, running nor finished.")
+            if finished > lastCount:
+                delay = minimumWait
+            else:
+                delay = min(delay * 2, maximumWait)
+            lastCount = finished
+            time.sleep(delay)
+        if verbose:
+            print("Completed " + str(taskCount) + " of " + str(taskCount) + " tasks.       ")
+
+def runQueueWorker(queueDirectory, heartbeatSeconds = queueHeartbeatSeconds):  #keeps claiming and running tasks until the queue is empty, touching the claim file while each task runs so the waiting node can tell we are alive.  Returns 0 if every task this worker ran succeeded.
+    import os
+    import subprocess
+    queue = TaskQueue(queueDirectory)
+    worstStatus = 0
+    task = queue.claim()
+    while task:
+        claimedPath, command = task
+        process = subprocess.Popen(command, shell = True)
+        while True:
+            try:
+                status = process.wait(timeout = heartbeatSeconds)
+                break
+            except subprocess.TimeoutExpired:
+                os.utime(claimedPath)
+        queue.finish(claimedPath, status)
+        if status != 0:
+            worstStatus = status
+        task = queue.claim()
+    return worstStatus
+
+class Executor(object):  #shared pieces for the executors
+
+    def __init__(self, tempdir, pythonInterpreter = False, verbose = False, profile = False):
+        self.tempdir = tempdir
+        self.pythonInterpreter = pythonInterpreter or defaultInterpreter()
+        self.verbose = verbose
+        self.profile = profile  #False, "cpu" or "memory".  Every stage script takes the same switch, so it rides along on every command.
+
+    def command(self, script, argumentString):
+        import os
+        command = self.pythonInterpreter + " " + scriptDirectory() + os.sep + script + " " + argumentString
+        if self.profile:
+            command += " --profile " + self.profile
+        return command
+
+    def runHere(self, script, argumentString):  #runs a single job on this node and waits for it
+        import os
+        command = self.command(script, argumentString)
+        if self.verbose:
+            command += " -v"
+            print("BASH " + command)
+        status = os.system(command)
+        if status != 0:
+            raise RuntimeError("Job failed with exit status " + str(status) + ": " + command)
+
+    def runQueue(self, jobName, script, argumentStrings, clockOutName, workers, memoryGB = 4):  #each argument string is one small task, and workers pull tasks until they run out.  A local pool already hands out work that way.
+        self.runJobs(jobName, script, argumentStrings, clockOutName, memoryGB)
+
+class SGEExecutor(Executor):  #the original way of doing things: one array job per stage, with this node taking the first job
+
+    name = "sge"
+
+    def __init__(self, tempdir, pythonInterpreter = False, verbose = False, schedulerOutput = "schedulerOutput", profile = False):
+        Executor.__init__(self, tempdir, pythonInterpreter, verbose, profile)
+        self.schedulerOutput = schedulerOutput
+
+    def runJobs(self, jobName, script, argumentStrings, clockOutName, memoryGB = 4):  #argumentStrings has one entry per job, memoryGB is either one value for all of them or a list with one per job
+        import os
+        if not argumentStrings:
+            return
+        if not os.path.isdir(self.schedulerOutput):  #if there is no directory for grabbing the scheduler output
+            os.mkdir(self.schedulerOutput)  #create one
+        clockOutDir = self.tempdir + os.sep + clockOutName
+        wrapperRunnerName = self.tempdir + os.sep + "bashFiles" + os.sep + "wrapper.sh"  #define a filename for running the parallel job wrapper
+        wrapperRunner = open(wrapperRunnerName, 'w')
+        wrapperRunner.write("#!/bin/bash\n")
+        wrapperRunner.write(self.pythonInterpreter + " " + scriptDirectory() + os.sep + "raptor.py " + "--tempdir " + self.tempdir + " --clockOutDir " + clockOutDir)
+        wrapperRunner.close()
+        clockOutFlush(clockOutDir)  #make sure that there are no pre-existing clock out files in the clockout directory
+        listener = False
+        if len(argumentStrings) > 1:
+            try:
+                listener = CompletionListener(clockOutDir)  #set up before submitting so that no task can finish before we are listening
+            except OSError:
+                listener = False
+        for i in range(1, len(argumentStrings)):  #job 0 runs on this node, the rest get bash files for the array tasks
+            bashFileName = self.tempdir + os.sep + "bashFiles" + os.sep + str(i) + ".sh"
+            bashFile = open(bashFileName, 'w')
+            bashFile.write("#!/bin/bash\n")
+            bashFile.write(self.command(script, argumentStrings[i]))
+            bashFile.close()
+        if isinstance(memoryGB, list):  #one memory request per job, so submit one array job for each run of tasks needing the same amount
+            tiers = memoryTiers(memoryGB)
+        else:
+            tiers = [(1, len(argumentStrings) - 1, memoryGB)]
+        for first, last, tierMemoryGB in tiers:
+            if last < first:
+                continue
+            jobRange = str(first) + "-" + str(last) + " "
+            command = "qsub -cwd -V -N " + jobName + " -l h_data=" + str(tierMemoryGB) + "G,time=23:59:00 -e " + os.getcwd() + "/" + self.schedulerOutput + "/ -o " + os.getcwd() + "/" + self.schedulerOutput + "/ " + "-t " + jobRange + wrapperRunnerName  #create a command line to submit an array job to SGE
+            if self.verbose:
+                print("BASH " + command)
+            os.system(command)
+        if self.verbose:
+            print("Starting the job on this node.")
+        self.runHere(script, argumentStrings[0])
+        if len(argumentStrings) > 1:
+            if self.verbose:
+                print("Monitoring " + jobName + " jobs on other nodes.")
+            try:
+                self.monitorJobs(clockOutDir, len(argumentStrings), listener)
+            finally:
+                if listener:
+                    listener.close()
+
+    def runQueue(self, jobName, script, argumentStrings, clockOutName, workers, memoryGB = 4):  #array tasks run raptor.py as queue workers, and this node works the queue too until it is empty
+        import os
+        if not argumentStrings:
+            return
+        if isinstance(memoryGB, list):
+            memoryGB = max(memoryGB)  #any worker might end up with the biggest task
+        commands = [self.command(script, argumentString) for argumentString in argumentStrings]
+        if not os.path.isdir(self.tempdir + os.sep + "taskQueues"):
+            os.mkdir(self.tempdir + os.sep + "taskQueues")
+        queueDirectory = self.tempdir + os.sep + "taskQueues" + os.sep + jobName
+        queue = TaskQueue.create(queueDirectory, commands)
+        workers = max(1, min(workers, len(commands)))
+        if not os.path.isdir(self.schedulerOutput):
+            os.mkdir(self.schedulerOutput)
+        clockOutDir = self.tempdir + os.sep + clockOutName
+        clockOutFlush(clockOutDir)
+        if workers > 1:
+            wrapperRunnerName = self.tempdir + os.sep + "bashFiles" + os.sep + "queueWrapper.sh"
+            wrapperRunner = open(wrapperRunnerName, 'w')
+            wrapperRunner.write("#!/bin/bash\n")
+            wrapperRunner.write(self.pythonInterpreter + " " + scriptDirectory() + os.sep + "raptor.py " + "--tempdir " + self.tempdir + " --clockOutDir " + clockOutDir + " --taskQueue " + queueDirectory)
+            wrapperRunner.close()
+            command = "qsub -cwd -V -N " + jobName + " -l h_data=" + str(memoryGB) + "G,time=23:59:00 -e " + os.getcwd() + "/" + self.schedulerOutput + "/ -o " + os.getcwd() + "/" + self.schedulerOutput + "/ " + "-t 1-" + str(workers - 1) + " " + wrapperRunnerName
+            if self.verbose:
+                print("BASH " + command)
+            os.system(command)
+        if self.verbose:
+            print("Working the " + jobName + " task queue on this node.")
+        runQueueWorker(queueDirectory)
+        if self.verbose:
+            print("Waiting on " + jobName + " tasks claimed by other nodes.")
+        queue.waitForTasks(len(commands), self.verbose)  #done when every task is accounted for, even if some array workers never got to start
+        failures = queue.failures()
+        if failures:
+            raise RuntimeError(str(len(failures)) + " " + jobName + " task(s) failed.  First failure: " + failures[0])
+
+    def monitorJobs(self, clockOutDirectory, jobCount, listener = False):  #waits for jobs 1 to jobCount - 1 (job 0 ran here)
+        waiting = set(range(1, jobCount))
+        if listener:
+            listener.wait(waiting, jobCount, self.verbose)
+        else:
+            CompletionListener.waitOnDirectory(clockOutDirectory, waiting, jobCount, self.verbose)
+
+listenerFileName = ".listener"  #lives in the clock out directory and tells the wrappers where to send their completion messages
+
+def clockedOutJobs(clockOutDirectory):  #one directory listing instead of checking every job's file
+    import os
+    jobs = set()
+    for name in os.listdir(clockOutDirectory):
+        if name.isdigit():
+            jobs.add(int(name))
+    return jobs
+
+class CompletionListener(object):  #raptor.py pushes a message here as each task finishes, so we wake up the moment the last one is done instead of polling every file each second.  The clock out files are still written and get scanned with a backoff in case a message never arrives (firewalls and such).
+
+    def __init__(self, clockOutDirectory):
+        import os
+        import socket
+        self.clockOutDirectory = clockOutDirectory
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("", 0))
+        self.server.listen(128)
+        port = self.server.getsockname()[1]
+        listenerFile = open(clockOutDirectory + os.sep + listenerFileName + ".tmp", 'w')
+        listenerFile.write(socket.getfqdn() + " " + str(port) + "\n")
+        listenerFile.close()
+        os.rename(clockOutDirectory + os.sep + listenerFileName + ".tmp", clockOutDirectory + os.sep + listenerFileName)
+
+    def receive(self):  #accepts one connection and returns the job number it reported, or None if it made no sense
+        connection, address = self.server.accept()
+        connection.settimeout(5)
+        try:
+            message = connection.recv(64).decode().strip()
+        except OSError:
+            message = ""
+        connection.close()
+        if message.isdigit():
+            return int(message)
+        return None
+
+    def wait(self, waiting, jobCount, verbose = False, minimumWait = 0.05, maximumWait = 5):
+        import select
+        import time
+        waiting = set(waiting)
+        delay = minimumWait
+        nextScan = time.time()
+        while waiting:
+            if time.time() >= nextScan:  #fallback scan of the clock out directory, backing off while nothing is changing
+                finished = clockedOutJobs(self.clockOutDirectory) & waiting
+                waiting -= finished
+                if finished:
+                    delay = minimumWait
+                else:
+                    delay = min(delay * 2, maximumWait)
+                nextScan = time.time() + delay
+                if verbose:
+                    print("Completed " + str(jobCount - len(waiting)) + " of " + str(jobCount) + " jobs.       ", end = "\r")
+                if not waiting:
+                    break
+            ready = select.select([self.server], [], [], max(0, nextScan - time.time()))[0]
+            if ready:
+                job = self.receive()
+                if job in waiting:
+                    waiting.discard(job)
+                    if verbose:
+                        print("Completed " + str(jobCount - len(waiting)) + " of " + str(jobCount) + " jobs.       ", end = "\r")
+        if verbose:
+            print("Completed " + str(jobCount) + " of " + str(jobCount) + " jobs.       ")
+
+    @staticmethod
+    def waitOnDirectory(clockOutDirectory, waiting, jobCount, verbose = False, minimumWait = 0.05, maximumWait = 5):  #no listener, just scan the directory with a backoff
+        import time
+        waiting = set(waiting)
+        delay = minimumWait
+        while waiting:
+            finished = clockedOutJobs(clockOutDirectory) & waiting
+            waiting -= finished
+            if verbose:
+                print("Completed " + str(jobCount - len(waiting)) + " of " + str(jobCount) + " jobs.       ", end = "\r")
+            if not waiting:
+                break
+            if finished:
+                delay = minimumWait
+            else:
+                delay = min(delay * 2, maximumWait)
+            time.sleep(delay)
+        if verbose:
+            print("Completed " + str(jobCount) + " of " + str(jobCount) + " jobs.       ")
+
+    def close(self):
+        import os
+        self.server.close()
+        if os.path.isfile(self.clockOutDirectory + os.sep + listenerFileName):
+            os.remove(self.clockOutDirectory + os.sep + listenerFileName)
+
+def notifyListener(clockOutDirectory, job):  #called by raptor.py after it clocks out.  Never fatal, since the clock out file is already there.
+    import os
+    import socket
+    listenerFilePath = clockOutDirectory + os.sep + listenerFileName
+    if not os.path.isfile(listenerFilePath):
+        return False
+    try:
+        listenerFile = open(listenerFilePath, 'r')
+        host, port = listenerFile.read().split()
+        listenerFile.close()
+        connection = socket.create_connection((host, int(port)), timeout = 5)
+        connection.sendall((str(job) + "\n").encode())
+        connection.close()
+    except (OSError, ValueError):
+        return False
+    return True
+
+class LocalExecutor(Executor):  #runs every job as its own process on this machine, as many at a time as the cores and memory allow
+
+    name = "local"
+
+    def __init__(self, tempdir, pythonInterpreter = False, verbose = False, workers = 0, memoryGB = 0, profile = False):
+        Executor.__init__(self, tempdir, pythonInterpreter, verbose, profile)
+        self.cores = workers or detectCores()
+        self.memoryGB = memoryGB or detectMemoryGB()
+
+    def workerCount(self, jobCount, memoryGB):  #no more workers than cores, jobs, or what fits in memory
+        workers = min(self.cores, jobCount)
+        if memoryGB and self.memoryGB:
+            workers = min(workers, max(1, int(self.memoryGB // memoryGB)))
+        return max(1, workers)
+
+    def runJobs(self, jobName, script, argumentStrings, clockOutName, memoryGB = 4):
+        import threading
+        import subprocess
+        import concurrent.futures
+        if not argumentStrings:
+            return
+        commands = [self.command(script, argumentString) for argumentString in argumentStrings]
+        if self.verbose:
+            commands[0] += " -v"  #same as on the cluster, only the first job gets to talk
+        if isinstance(memoryGB, list):
+            memoryList = memoryGB
+        else:
+            memoryList = [memoryGB] * len(commands)
+        workers = self.workerCount(len(commands), min(memoryList))
+        if self.verbose:
+            print("Running " + str(len(commands)) + " " + jobName + " jobs on up to " + str(workers) + " local worker(s).")
+        budget = {"free" : self.memoryGB or sum(memoryList)}
+        budgetChanged = threading.Condition()
+
+        def runWithinBudget(command, jobMemoryGB):  #waits until there is memory for this job, so a few big jobs cannot push us into swap
+            jobMemoryGB = min(jobMemoryGB, self.memoryGB or jobMemoryGB)  #a job bigger than the whole machine still gets to run, just alone
+            with budgetChanged:
+                while budget["free"] < jobMemoryGB:
+                    budgetChanged.wait()
+                budget["free"] -= jobMemoryGB
+            try:
+                return subprocess.call(command, shell = True)
+            finally:
+                with budgetChanged:
+                    budget["free"] += jobMemoryGB
+                    budgetChanged.notify_all()
+
+        failures = []
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)  #each thread just launches and waits on one job process
+        futures = {}
+        for i in range(0, len(commands)):
+            futures[pool.submit(runWithinBudget, commands[i], memoryList[i])] = commands[i]
+        completed = 0
+        for future in concurrent.futures.as_completed(futures):
+            completed += 1
+            if future.result() != 0:
+                failures.append(futures[future])
+            if self.verbose:
+                print("Completed " + str(completed) + " of " + str(len(commands)) + " jobs.       ", end = "\r")
+        pool.shutdown()
+        if self.verbose:
+            print("Completed " + str(completed) + " of " + str(len(commands)) + " jobs.       ")
+        if failures:
+            raise RuntimeError(str(len(failures)) + " " + jobName + " job(s) failed.  First failure: " + failures[0])
+
+executorTypes = {"sge" : SGEExecutor, "local" : LocalExecutor}
+
+def makeExecutor(name, tempdir, pythonInterpreter = False, verbose = False, workers = 0, profile = False):
+    if name == "local":
+        return LocalExecutor(tempdir, pythonInterpreter, verbose, workers, profile = profile)
+    if name == "sge":
+        return SGEExecutor(tempdir, pythonInterpreter, verbose, profile = profile)
+    raise RuntimeError("Unknown executor: " + str(name) + ".  Choose from " + ", ".join(sorted(executorTypes.keys())))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#Every ship keeps a flight recorder.  This module lets each worker write a small JSON record of what it did (time, rows, rejections by reason, bytes, peak memory, pickle time, host) into the temporary directory, and lets battleStar gather those records into a per-stage report of throughput, skew and the slowest tasks.  Run with --profile, the recorder also keeps the worker's cProfile stats (and tracemalloc's view of memory), and battleStar merges them per stage.
+
+metricsDirectoryName = "metrics"
+profileDirectoryName = "profiles"
+memoryLines = 25  #allocation sites kept from each worker's tracemalloc snapshot
+
+class StopWatch(object):  #adds the time spent inside a with block to one of the recorder's timers
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        import time
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        import time
+        self.recorder.timers[self.name] = self.recorder.timers.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+class FlightRecorder(object):  #one per worker process.  Counting is just adding to a dictionary, so it costs nothing next to the work being counted.
+
+    def __init__(self, stage, tempdir, profile = False):  #profile is False, "cpu" or "memory"
+        import os
+        import socket
+        import time
+        self.stage = stage
+        self.tempdir = tempdir
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.startClock = time.perf_counter()
+        self.startTimes = os.times()
+        self.counters = {"rowsRead" : 0, "rowsAccepted" : 0}
+        self.rejected = {}  #filter reason -> rows rejected for it
+        self.timers = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.inputs = []
+        self.profile = profile
+        self.profiler = None
+        if profile:
+            self.startProfiling()
+
+    def count(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def reject(self, reason, amount = 1):
+        self.rejected[reason] = self.rejected.get(reason, 0) + int(amount)
+
+    def timing(self, name):  #use as: with recorder.timing("pickleLoad"):
+        return StopWatch(self, name)
+
+    def readFile(self, fileName):
+        import os
+        self.inputs.append(fileName.split(os.sep)[-1])
+        if os.path.isfile(fileName):
+            self.bytesIn += os.path.getsize(fileName)
+
+    def wroteFile(self, fileName):
+        import os
+        if os.path.isfile(fileName):
+            self.bytesOut += os.path.getsize(fileName)
+
+    def startProfiling(self):  #nothing here is touched unless profiling was asked for, so a normal run pays nothing for it
+        import cProfile
+        import tracemalloc
+        if self.profile == "memory":
+            tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def writeProfile(self, baseName):  #stops the profiler and leaves its stats (and the memory snapshot) next to the other workers' for this stage
+        import cProfile
+        import json
+        import os
+        import tracemalloc
+        self.profiler.disable()
+        directory = self.tempdir + os.sep + profileDirectoryName
+        makeDirectory(directory)
+        if tracemalloc.is_tracing():  #snapshot first, so writing the cpu stats does not show up in it
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, cProfile.__file__), tracemalloc.Filter(False, tracemalloc.__file__)])  #the profiler's own bookkeeping is not the worker's
+            sites = snapshot.statistics("lineno")[:memoryLines]
+            tracemalloc.stop()
+        self.profiler.dump_stats(directory + os.sep + baseName + ".prof.tmp")
+        os.rename(directory + os.sep + baseName + ".prof.tmp", directory + os.sep + baseName + ".prof")
+        if self.profile != "memory":
+            return
+        memory = {"stage" : self.stage,
+                  "tracedPeak" : peak,
+                  "tracedAtFinish" : current,
+                  "sites" : [[str(site.traceback[0]), site.size, site.count] for site in sites]}  #what was still allocated when the worker finished, biggest first
+        memoryFile = open(directory + os.sep + baseName + ".memory.json.tmp", 'w')
+        json.dump(memory, memoryFile)
+        memoryFile.close()
+        os.rename(directory + os.sep + baseName + ".memory.json.tmp", directory + os.sep + baseName + ".memory.json")
+
+    def record(self):
+        import os
+        import resource
+        import time
+        endTimes = os.times()
+        return {"stage" : self.stage,
+                "host" : self.host,
+                "pid" : self.pid,
+                "started" : self.started,
+                "wallSeconds" : time.perf_counter() - self.startClock,
+                "cpuSeconds" : (endTimes.user - self.startTimes.user) + (endTimes.system - self.startTimes.system),
+                "peakRSS" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  #Linux reports kilobytes
+                "counters" : self.counters,
+                "rejected" : self.rejected,
+                "timers" : self.timers,
+                "bytesIn" : self.bytesIn,
+                "bytesOut" : self.bytesOut,
+                "inputs" : self.inputs}
+
+    def finish(self):  #writes the record under a name no other worker can have.  Workers run without a temporary directory keep nothing.
+        import json
+        import os
+        if not self.tempdir:
+            return False
+        baseName = ".".join([self.stage, self.host, str(self.pid), str(int(self.started * 1000))])
+        if self.profiler:
+            self.writeProfile(baseName)
+        directory = self.tempdir + os.sep + metricsDirectoryName
+        makeDirectory(directory)
+        fileName = directory + os.sep + baseName + ".json"
+        recordFile = open(fileName + ".tmp", 'w')
+        json.dump(self.record(), recordFile)
+        recordFile.close()
+        os.rename(fileName + ".tmp", fileName)
+        return fileName
+
+def makeDirectory(directory):
+    import os
+    if not os.path.isdir(directory):
+        try:
+            os.mkdir(directory)
+        except FileExistsError:  #another worker beat us to it
+            pass
+
+def loadRecords(tempdir):  #every worker record in the temporary directory, oldest first
+    import json
+    import os
+    directory = tempdir + os.sep + metricsDirectoryName
+    if not os.path.isdir(directory):
+        return []
+    records = []
+    for file in os.listdir(directory):
+        if not file.endswith(".json"):
+            continue
+        recordFile = open(directory + os.sep + file, 'r')
+        records.append(json.load(recordFile))
+        recordFile.close()
+    return sorted(records, key = lambda record: record["started"])
+
+def stageSummaries(records):  #one summary per stage, in the order the stages started
+    summaries = []
+    byStage = {}
+    for record in records:
+        if not record["stage"] in byStage:
+            byStage[record["stage"]] = []
+            summaries.append(record["stage"])
+        byStage[record["stage"]].append(record)
+    for i in range(0, len(summaries)):
+        stageRecords = byStage[summaries[i]]
+        walls = [record["wallSeconds"] for record in stageRecords]
+        meanWall = sum(walls) / len(walls)
+        rowsRead = sum([record["counters"].get("rowsRead", 0) for record in stageRecords])
+        rejected = {}
+        timers = {}
+        for record in stageRecords:
+            for reason in record["rejected"]:
+                rejected[reason] = rejected.get(reason, 0) + record["rejected"][reason]
+            for name in record["timers"]:
+                timers[name] = timers.get(name, 0.0) + record["timers"][name]
+        summaries[i] = {"stage" : summaries[i],
+                        "tasks" : len(stageRecords),
+                        "hosts" : len(set([record["host"] for record in stageRecords])),
+                        "wallSeconds" : sum(walls),
+                        "longestTaskSeconds" : max(walls),
+                        "skew" : max(walls) / meanWall if meanWall else 1.0,  #longest task over the mean task.  1.0 is perfectly even.
+                        "cpuSeconds" : sum([record["cpuSeconds"] for record in stageRecords]),
+                        "rowsRead" : rowsRead,
+                        "rowsAccepted" : sum([record["counters"].get("rowsAccepted", 0) for record in stageRecords]),
+                        "rowsPerTaskSecond" : rowsRead / sum(walls) if sum(walls) else 0.0,
+                        "rejected" : rejected,
+                        "timers" : timers,
+                        "bytesIn" : sum([record["bytesIn"] for record in stageRecords]),
+                        "bytesOut" : sum([record["bytesOut"] for record in stageRecords]),
+                        "peakRSS" : max([record["peakRSS"] for record in stageRecords])}
+    return summaries
+
+def buildReport(tempdir, slowestCount = 10):
+    records = loadRecords(tempdir)
+    slowest = sorted(records, key = lambda record: record["wallSeconds"], reverse = True)[:slowestCount]
+    return {"records" : len(records),
+            "stages" : stageSummaries(records),
+            "slowestTasks" : [dict([(key, record[key]) for key in ["stage", "host", "pid", "wallSeconds", "cpuSeconds", "peakRSS", "inputs"]]) for record in slowest]}
+
+def writeReport(report, fileName):
+    import json
+    import os
+    reportFile = open(fileName + ".tmp", 'w')
+    json.dump(report, reportFile, indent = 1)
+    reportFile.close()
+    os.rename(fileName + ".tmp", fileName)
+
+def printReport(report):
+    print("Stage              Tasks  Task hours  Longest (s)   Skew     Rows read  Rows/task-s  Peak RSS (MB)  MB in  MB out")
+    for stage in report["stages"]:
+        print(stage["stage"].ljust(18) + str(stage["tasks"]).rjust(6) + ("%.3f" % (stage["wallSeconds"] / 3600)).rjust(12) + ("%.1f" % stage["longestTaskSeconds"]).rjust(13) + ("%.2f" % stage["skew"]).rjust(7) + str(stage["rowsRead"]).rjust(14) + ("%.0f" % stage["rowsPerTaskSecond"]).rjust(13) + ("%.1f" % (stage["peakRSS"] / 1000000)).rjust(15) + ("%.1f" % (stage["bytesIn"] / 1000000)).rjust(7) + ("%.1f" % (stage["bytesOut"] / 1000000)).rjust(8))
+        if stage["rejected"]:
+            print("    rejected: " + ", ".join([reason + " " + str(stage["rejected"][reason]) for reason in sorted(stage["rejected"])]))
+        if stage["timers"]:
+            print("    time in: " + ", ".join([name + " " + ("%.2fs" % stage["timers"][name]) for name in sorted(stage["timers"])]))
+    if report["slowestTasks"]:
+        print("Slowest tasks:")
+        for task in report["slowestTasks"]:
+            print("    " + task["stage"] + " on " + task["host"] + ": " + ("%.1f" % task["wallSeconds"]) + "s  " + ",".join(task["inputs"][:3]) + ("..." if len(task["inputs"]) > 3 else ""))
+
+def mergeProfiles(tempdir, outputDirectory, lineCount = 40):  #one cumulative-time report (and a .prof file for pstats or a viewer) per stage, plus a memory report for stages traced with tracemalloc.  Returns the stages merged.
+    import json
+    import os
+    import pstats
+    directory = tempdir + os.sep + profileDirectoryName
+    if not os.path.isdir(directory):
+        return []
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    profiles = {}
+    memories = {}
+    for file in sorted(os.listdir(directory)):
+        stage = file.split(".")[0]
+        if file.endswith(".prof"):
+            profiles[stage] = profiles.get(stage, []) + [directory + os.sep + file]
+        elif file.endswith(".memory.json"):
+            memories[stage] = memories.get(stage, []) + [directory + os.sep + file]
+    for stage in profiles:
+        reportFile = open(outputDirectory + os.sep + stage + ".profile.txt", 'w')
+        reportFile.write(stage + ": " + str(len(profiles[stage])) + " worker(s)\n")
+        stats = pstats.Stats(*profiles[stage], stream = reportFile)
+        stats.dump_stats(outputDirectory + os.sep + stage + ".prof")
+        stats.strip_dirs().sort_stats("cumulative").print_stats(lineCount)
+        reportFile.close()
+    for stage in memories:
+        peaks = []
+        sites = {}  #allocation site -> [bytes, blocks] over every worker
+        for fileName in memories[stage]:
+            memoryFile = open(fileName, 'r')
+            memory = json.load(memoryFile)
+            memoryFile.close()
+            peaks.append(memory["tracedPeak"])
+            for site, size, count in memory["sites"]:
+                if not site in sites:
+                    sites[site] = [0, 0]
+                sites[site][0] += size
+                sites[site][1] += count
+        reportFile = open(outputDirectory + os.sep + stage + ".memory.txt", 'w')
+        reportFile.write(stage + ": " + str(len(peaks)) + " worker(s), largest traced peak " + ("%.1f" % (max(peaks) / 1000000)) + " MB, mean traced peak " + ("%.1f" % (sum(peaks) / len(peaks) / 1000000)) + " MB\n")
+        reportFile.write("Still allocated when the workers finished, summed over workers:\n")
+        for site in sorted(sites, key = lambda site: sites[site][0], reverse = True)[:lineCount]:
+            reportFile.write(("%.1f" % (sites[site][0] / 1000000)).rjust(10) + " MB" + str(sites[site][1]).rjust(12) + " blocks  " + site + "\n")
+        reportFile.close()
+    return sorted(set(list(profiles.keys()) + list(memories.keys())))
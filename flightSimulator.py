@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#Pilots train in the simulator before anyone lets them near a real Viper.  This script makes a synthetic cohort of .ratio files and flies it through every stage of the pipeline on the local executor, timing each stage and reporting rows per second, peak memory and bytes written, so that speedups can be proven and regressions caught without real data.
+
+class CheckArgs():  #class that checks arguments and ultimately returns a validated set of arguments to the main program
+
+    def __init__(self):
+        import argparse
+        import os
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-d", "--directory", help = "Working directory for the generated data, the temporary directory and the report", default = "flightSimulator")
+        parser.add_argument("-n", "--samples", help = "Number of synthetic samples to generate", default = 8, type = int)
+        parser.add_argument("-l", "--loci", help = "Loci reported by each sample", default = 200000, type = int)
+        parser.add_argument("-f", "--overlap", help = "Fraction of each sample's loci drawn from a set shared by every sample.  The rest are private to the sample.", default = 0.8, type = float)
+        parser.add_argument("--fileSize", help = "Target size of each generated file in MB.  Overrides the loci per sample.", default = 0, type = float)
+        parser.add_argument("--contigs", help = "Number of numbered contigs to spread loci over (chrX and chrM are always added)", default = 22, type = int)
+        parser.add_argument("--meanCoverage", help = "Mean read coverage of a generated locus", default = 15, type = float)
+        parser.add_argument("--seed", help = "Random seed, so the same parameters always give the same files", default = 1, type = int)
+        parser.add_argument("-i", "--inputDirectory", help = "Benchmark these .ratio files instead of generating a cohort")
+        parser.add_argument("-c", "--minCoverage", help = "Minimum coverage passed to the filters", default = 10, type = int)
+        parser.add_argument("-r", "--minRepresentation", help = "Minimum percent representation passed to the count", default = 75, type = int)
+        parser.add_argument("-s", "--contextRequirement", help = "Context requirement passed to the filters (multiples separated by commas)")
+        parser.add_argument("--localWorkers", help = "Maximum number of processes for the local executor (default: detected from cores and memory)", default = 0, type = int)
+        parser.add_argument("--pythonInterpreter", help = "Python interpreter used to launch each stage (default: the cluster python if present, otherwise this one)")
+        parser.add_argument("--generateOnly", help = "Write the synthetic cohort and stop", action = 'store_true')
+        parser.add_argument("-o", "--report", help = "Write the benchmark report here as JSON (default: benchmark.json in the working directory)")
+        parser.add_argument("-b", "--baseline", help = "Earlier report to compare against.  Stages that got slower by more than the tolerance are reported as regressions.")
+        parser.add_argument("--tolerance", help = "Fraction of rows per second a stage may lose against the baseline before it counts as a regression", default = 0.2, type = float)
+        parser.add_argument("--buildAcceptedIndex", help = argparse.SUPPRESS)  #internal: runs just the accepted index step in this temporary directory, so it can be measured as its own process
+        parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
+        rawArgs = parser.parse_args()
+        self.buildAcceptedIndex = rawArgs.buildAcceptedIndex
+        if self.buildAcceptedIndex:
+            return
+        self.directory = os.path.abspath(rawArgs.directory)
+        if rawArgs.samples < 1:
+            raise RuntimeError("At least one sample is needed.  We got: " + str(rawArgs.samples))
+        self.samples = rawArgs.samples
+        if rawArgs.loci < 1:
+            raise RuntimeError("Each sample needs at least one locus.  We got: " + str(rawArgs.loci))
+        self.loci = rawArgs.loci
+        if rawArgs.overlap < 0 or rawArgs.overlap > 1:
+            raise RuntimeError("Overlap must be a fraction between 0 and 1.  We got: " + str(rawArgs.overlap))
+        self.overlap = rawArgs.overlap
+        if rawArgs.fileSize < 0:
+            raise RuntimeError("File size cannot be negative.  We got: " + str(rawArgs.fileSize))
+        self.fileSize = int(rawArgs.fileSize * 1000000)
+        if rawArgs.contigs < 1:
+            raise RuntimeError("At least one numbered contig is needed.  We got: " + str(rawArgs.contigs))
+        self.contigs = rawArgs.contigs
+        self.meanCoverage = rawArgs.meanCoverage
+        self.seed = rawArgs.seed
+        if rawArgs.inputDirectory and not os.path.isdir(rawArgs.inputDirectory):
+            raise RuntimeError("Input directory not found: " + rawArgs.inputDirectory)
+        self.inputDirectory = rawArgs.inputDirectory
+        if rawArgs.inputDirectory and rawArgs.generateOnly:
+            raise RuntimeError("Nothing to generate when benchmarking an existing input directory.")
+        self.minCoverage = rawArgs.minCoverage
+        self.minRepresentation = rawArgs.minRepresentation
+        if rawArgs.contextRequirement:
+            self.contextRequirement = [item.upper() for item in rawArgs.contextRequirement.split(",")]
+        else:
+            self.contextRequirement = []
+        if rawArgs.localWorkers < 0:
+            raise RuntimeError("Local worker count cannot be negative.  We got: " + str(rawArgs.localWorkers))
+        self.localWorkers = rawArgs.localWorkers
+        if rawArgs.pythonInterpreter and not os.path.isfile(rawArgs.pythonInterpreter):
+            raise RuntimeError("Specified python interpreter was not found: " + rawArgs.pythonInterpreter)
+        self.pythonInterpreter = rawArgs.pythonInterpreter
+        self.generateOnly = rawArgs.generateOnly
+        self.report = rawArgs.report or self.directory + os.sep + "benchmark.json"
+        if rawArgs.baseline and not os.path.isfile(rawArgs.baseline):
+            raise RuntimeError("Baseline report not found: " + rawArgs.baseline)
+        self.baseline = rawArgs.baseline
+        if rawArgs.tolerance < 0:
+            raise RuntimeError("Tolerance cannot be negative.  We got: " + str(rawArgs.tolerance))
+        self.tolerance = rawArgs.tolerance
+        self.verbose = rawArgs.verbose
+
+ratioColumns = ["chr", "pos", "strand", "context", "ratio", "eff_CT_count", "C_count", "CT_count", "rev_G_count", "rev_GA_count"]  #what viper and refinery look up by name, plus the strand column real files carry
+contexts = ["CG", "CHG", "CHH"]
+contextWeights = [0.7, 0.15, 0.15]
+tempSubdirectories = ["filter1", "filter2", "loci", "lociGather", "lociClockOut", "filter1ClockOut", "filter2ClockOut", "bashFiles", "finalParts", "finalPartsClockOut", "prefilter", "prefilterClockOut", "metrics", "profiles"]  #the same layout battleStar makes
+
+def contigLengths(numberedContigs):  #roughly human sized: numbered contigs shrinking from 250Mb, then chrX and chrM
+    lengths = {}
+    for i in range(1, numberedContigs + 1):
+        lengths["chr" + str(i)] = int(250000000 * (1 - 0.8 * (i - 1) / max(numberedContigs, 1)))
+    lengths["chrX"] = 156000000
+    lengths["chrM"] = 16569
+    return lengths
+
+def drawLoci(rng, count, lengths):  #(contig codes, positions, methylation levels, context codes) for count random loci, spread in proportion to contig length
+    import numpy
+    names = list(lengths.keys())
+    sizes = numpy.array([lengths[name] for name in names], dtype = numpy.float64)
+    codes = rng.choice(len(names), size = count, p = sizes / sizes.sum()).astype(numpy.int64)
+    positions = (rng.random(count) * sizes[codes]).astype(numpy.int64) + 1
+    levels = rng.beta(0.4, 0.4, size = count)  #mostly near fully methylated or unmethylated, like real CpGs
+    contextCodes = rng.choice(len(contexts), size = count, p = contextWeights)
+    return (codes, positions, levels, contextCodes)
+
+def sampleTable(sampleNumber, loci, lengths):  #one sample's rows as a data frame, sorted by contig and position
+    import numpy
+    import pandas
+    names = list(lengths.keys())
+    sharedCount = int(round(loci * args.overlap))
+    shared = drawLoci(numpy.random.default_rng([args.seed, 0]), sharedCount, lengths)  #same seed for every sample, so these loci are the same everywhere
+    rng = numpy.random.default_rng([args.seed, sampleNumber + 1])
+    private = drawLoci(rng, loci - sharedCount, lengths)
+    codes, positions, levels, contextCodes = [numpy.concatenate([shared[i], private[i]]) for i in range(0, 4)]
+    keys, keep = numpy.unique(codes * 4294967296 + positions, return_index = True)  #one row per locus, in contig then position order
+    codes = codes[keep]
+    positions = positions[keep]
+    levels = levels[keep]
+    contextCodes = contextCodes[keep]
+    coverage = rng.poisson(args.meanCoverage, size = len(keys))
+    methylated = rng.binomial(coverage, levels)
+    reverseCoverage = rng.poisson(args.meanCoverage, size = len(keys))
+    return pandas.DataFrame({"chr" : numpy.array(names, dtype = object)[codes],
+                             "pos" : positions,
+                             "strand" : numpy.where(rng.random(len(keys)) < 0.5, "+", "-"),
+                             "context" : numpy.array(contexts, dtype = object)[contextCodes],
+                             "ratio" : methylated / numpy.maximum(coverage, 1),
+                             "eff_CT_count" : coverage,
+                             "C_count" : methylated,
+                             "CT_count" : coverage,
+                             "rev_G_count" : reverseCoverage,
+                             "rev_GA_count" : rng.binomial(reverseCoverage, 0.01)}, columns = ratioColumns)
+
+def lociForFileSize(lengths):  #how many loci make a file of about the requested size, measured on a small trial sample
+    import io
+    trialLoci = 20000
+    text = io.StringIO()
+    sampleTable(0, trialLoci, lengths).to_csv(text, sep = "\t", index = False, float_format = "%.3f")
+    return max(1, int(args.fileSize / (len(text.getvalue()) / trialLoci)))
+
+def generateCohort(dataDirectory):  #writes sample<n>.ratio files and returns their names
+    import os
+    lengths = contigLengths(args.contigs)
+    loci = args.loci
+    if args.fileSize:
+        loci = lociForFileSize(lengths)
+        if args.verbose:
+            print("Using " + str(loci) + " loci per sample to reach about " + str(args.fileSize // 1000000) + "MB per file.")
+    if not os.path.isdir(dataDirectory):
+        os.makedirs(dataDirectory)
+    fileNames = []
+    for sampleNumber in range(0, args.samples):
+        fileName = dataDirectory + os.sep + "sample" + str(sampleNumber).zfill(len(str(args.samples))) + ".ratio"
+        if args.verbose:
+            print("Generating sample " + str(sampleNumber + 1) + " of " + str(args.samples) + ".       ", end = "\r")
+        sampleTable(sampleNumber, loci, lengths).to_csv(fileName + ".tmp", sep = "\t", index = False, float_format = "%.3f")
+        os.rename(fileName + ".tmp", fileName)
+        fileNames.append(fileName)
+    if args.verbose:
+        print("Generated " + str(args.samples) + " samples in " + dataDirectory + ".       ")
+    return fileNames
+
+def countDataLines(fileName):  #lines after the header
+    lines = 0
+    file = open(fileName, 'rb')
+    block = file.read(16777216)
+    while block:
+        lines += block.count(b"\n")
+        block = file.read(16777216)
+    file.close()
+    return max(lines - 1, 0)
+
+def bytesUnder(paths):  #total size of the files at or under these paths
+    import os
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for folder, subfolders, files in os.walk(path):
+                for file in files:
+                    try:
+                        total += os.path.getsize(folder + os.sep + file)
+                    except OSError:  #a job cleaned it up while we were looking
+                        pass
+    return total
+
+def runMeasured(command):  #runs one job and returns (exit status, peak RSS in bytes).  The rusage from wait4 covers the job and any processes it waited on.
+    import os
+    import subprocess
+    process = subprocess.Popen(command, shell = True)
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return (process.returncode, usage.ru_maxrss * 1024)  #Linux reports kilobytes
+
+def runStage(stage, executor, script, argumentStrings, rows, outputPaths):  #times one stage's jobs through the local executor's worker limit and returns its report line
+    import time
+    import concurrent.futures
+    commands = [executor.command(script, argumentString) for argumentString in argumentStrings]
+    workers = executor.workerCount(len(commands), 0)
+    if args.verbose:
+        print("Running " + stage + ": " + str(len(commands)) + " job(s) on up to " + str(workers) + " worker(s).")
+    bytesBefore = bytesUnder(outputPaths)
+    start = time.perf_counter()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+    results = list(pool.map(runMeasured, commands))
+    pool.shutdown()
+    seconds = time.perf_counter() - start
+    failures = [commands[i] for i in range(0, len(commands)) if results[i][0] != 0]
+    if failures:
+        raise RuntimeError(str(len(failures)) + " " + stage + " job(s) failed.  First failure: " + failures[0])
+    return {"stage" : stage,
+            "jobs" : len(commands),
+            "seconds" : seconds,
+            "rows" : rows,
+            "rowsPerSecond" : rows / seconds if seconds else 0.0,
+            "peakRSS" : max([result[1] for result in results] + [0]),
+            "bytesWritten" : max(bytesUnder(outputPaths) - bytesBefore, 0)}
+
+def filterArguments(fileName, tempdir):
+    import fleetCommand
+    return fleetCommand.makeArgumentString({"--fileList" : fileName,
+                                            "--minCoverage" : str(args.minCoverage),
+                                            "--tempdir" : tempdir,
+                                            "--contextRequirement" : ",".join(args.contextRequirement)})
+
+def executorArguments(executor):
+    return {"--executor" : "local",
+            "--localWorkers" : str(args.localWorkers),
+            "--pythonInterpreter" : executor.pythonInterpreter}
+
+def buildAcceptedIndex(tempdir):  #what battleStar does between the count and filter 2, without the run manifest
+    import os
+    import colonialOne
+    acceptedLoci = colonialOne.loadAcceptedLoci(tempdir + os.sep + "loci" + os.sep + "acceptedLoci.npz")
+    acceptedIndex = colonialOne.AcceptedIndex.fromAcceptedLoci(acceptedLoci, colonialOne.orderContigs(list(acceptedLoci.keys())))
+    acceptedIndex.save(tempdir + os.sep + "loci" + os.sep + "acceptedIndex")
+
+def filter1Rows(tempdir):
+    import os
+    import colonialOne
+    folder = tempdir + os.sep + "filter1"
+    return sum([len(colonialOne.SampleData(folder + os.sep + file)) for file in os.listdir(folder) if file.endswith(colonialOne.sampleSuffix)])
+
+def acceptedLocusCount(tempdir):
+    import os
+    import colonialOne
+    return len(colonialOne.AcceptedIndex.load(tempdir + os.sep + "loci" + os.sep + "acceptedIndex"))
+
+def runPipeline(fileNames, tempdir, outputFileName):  #every stage in the order battleStar runs them, each measured on its own
+    import os
+    import fleetCommand
+    import colonialOne
+    executor = fleetCommand.makeExecutor("local", tempdir, args.pythonInterpreter, False, args.localWorkers)
+    inputRows = sum([countDataLines(fileName) for fileName in fileNames])
+    stages = []
+    stages.append(runStage("refinery", executor, "refinery.py", [filterArguments(fileName, tempdir) for fileName in fileNames], inputRows, [tempdir + os.sep + "prefilter"]))
+    stages.append(runStage("viper", executor, "viper.py", [filterArguments(fileName, tempdir) for fileName in fileNames], inputRows, [tempdir + os.sep + "filter1"]))
+    arguments = {"--minRepresentation" : str(args.minRepresentation),
+                 "--tempdir" : tempdir}
+    arguments.update(executorArguments(executor))
+    stages.append(runStage("blackbird/toaster", executor, "blackbird.py", [fleetCommand.makeArgumentString(arguments)], filter1Rows(tempdir), [tempdir + os.sep + "loci", tempdir + os.sep + "lociGather"]))
+    acceptedLoci = colonialOne.loadAcceptedLoci(tempdir + os.sep + "loci" + os.sep + "acceptedLoci.npz")
+    stages.append(runStage("getAcceptedCoordinateList", executor, "flightSimulator.py", ["--buildAcceptedIndex " + tempdir], sum([len(acceptedLoci[contig]) for contig in acceptedLoci]), [tempdir + os.sep + "loci" + os.sep + "acceptedIndex.npy", tempdir + os.sep + "loci" + os.sep + "acceptedIndex.json"]))
+    sampleFiles = sorted([tempdir + os.sep + "filter1" + os.sep + file for file in os.listdir(tempdir + os.sep + "filter1") if file.endswith(colonialOne.sampleSuffix)])
+    stages.append(runStage("cylonRaider", executor, "cylonRaider.py", [fleetCommand.makeArgumentString({"--fileList" : file, "--tempdir" : tempdir}) for file in sampleFiles], filter1Rows(tempdir), [tempdir + os.sep + "filter2"]))
+    arguments = {"--outputFile" : outputFileName,
+                 "--tempdir" : tempdir}
+    arguments.update(executorArguments(executor))
+    stages.append(runStage("resurrectionShip", executor, "resurrectionShip.py", [fleetCommand.makeArgumentString(arguments)], acceptedLocusCount(tempdir), [outputFileName, tempdir + os.sep + "finalParts"]))
+    return stages
+
+def printReport(stages, baseline = False):
+    print("Stage                        Jobs   Seconds        Rows     Rows/sec  Peak RSS (MB)    MB written" + ("   vs baseline" if baseline else ""))
+    for stage in stages:
+        line = stage["stage"].ljust(27) + str(stage["jobs"]).rjust(6) + ("%.2f" % stage["seconds"]).rjust(10) + str(stage["rows"]).rjust(12) + ("%.0f" % stage["rowsPerSecond"]).rjust(13) + ("%.1f" % (stage["peakRSS"] / 1000000)).rjust(15) + ("%.1f" % (stage["bytesWritten"] / 1000000)).rjust(14)
+        if baseline and stage["stage"] in baseline and baseline[stage["stage"]]["rowsPerSecond"]:
+            line += ("%.2fx" % (stage["rowsPerSecond"] / baseline[stage["stage"]]["rowsPerSecond"])).rjust(14)
+        print(line)
+
+def findRegressions(stages, baseline):  #stages whose rows per second dropped more than the tolerance below the baseline
+    regressions = []
+    for stage in stages:
+        if not stage["stage"] in baseline or not baseline[stage["stage"]]["rowsPerSecond"]:
+            continue
+        if stage["rowsPerSecond"] < baseline[stage["stage"]]["rowsPerSecond"] * (1 - args.tolerance):
+            regressions.append(stage["stage"])
+    return regressions
+
+def loadBaseline(fileName):  #stage name -> report line
+    import json
+    reportFile = open(fileName, 'r')
+    report = json.load(reportFile)
+    reportFile.close()
+    return dict([(stage["stage"], stage) for stage in report["stages"]])
+
+def main():
+    import datetime
+    import json
+    import os
+    import shutil
+    import tylium
+    start = datetime.datetime.now()
+    global args
+    args = CheckArgs()
+    if args.buildAcceptedIndex:
+        buildAcceptedIndex(args.buildAcceptedIndex)
+        return
+    if args.inputDirectory:
+        fileNames = sorted([os.path.abspath(args.inputDirectory) + os.sep + file for file in os.listdir(args.inputDirectory) if tylium.isRatioFile(file)])
+        if not fileNames:
+            raise RuntimeError("No .ratio files found in " + args.inputDirectory)
+    else:
+        fileNames = generateCohort(args.directory + os.sep + "data")
+    if args.generateOnly:
+        return
+    tempdir = args.directory + os.sep + "benchmarkTemp"
+    if os.path.isdir(tempdir):  #every stage starts from nothing, so earlier runs cannot make it look faster
+        shutil.rmtree(tempdir)
+    os.makedirs(tempdir)
+    for subdirectory in tempSubdirectories:
+        os.mkdir(tempdir + os.sep + subdirectory)
+    outputFileName = args.directory + os.sep + "output.txt"
+    if os.path.isfile(outputFileName):
+        os.remove(outputFileName)
+    stages = runPipeline(fileNames, tempdir, outputFileName)
+    report = {"started" : start.isoformat(),
+              "parameters" : {"samples" : len(fileNames),
+                              "inputBytes" : sum([os.path.getsize(fileName) for fileName in fileNames]),
+                              "loci" : args.loci,
+                              "overlap" : args.overlap,
+                              "fileSize" : args.fileSize,
+                              "seed" : args.seed,
+                              "inputDirectory" : args.inputDirectory,
+                              "minCoverage" : args.minCoverage,
+                              "minRepresentation" : args.minRepresentation,
+                              "contextRequirement" : args.contextRequirement,
+                              "localWorkers" : args.localWorkers},
+              "stages" : stages}
+    reportFile = open(args.report + ".tmp", 'w')
+    json.dump(report, reportFile, indent = 1)
+    reportFile.close()
+    os.rename(args.report + ".tmp", args.report)
+    baseline = loadBaseline(args.baseline) if args.baseline else False
+    printReport(stages, baseline)
+    shutil.rmtree(tempdir)
+    print("Report written to " + args.report + ".  Benchmark completed in " + str(datetime.datetime.now() - start))
+    if baseline:
+        regressions = findRegressions(stages, baseline)
+        if regressions:
+            raise RuntimeError("Performance regression beyond " + str(round(args.tolerance * 100)) + "% in: " + ", ".join(regressions))
+
+main()
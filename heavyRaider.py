@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+class CheckArgs():  #class that checks arguments and ultimately returns a validated set of arguments to the main program
+
+    def __init__(self):
+        import argparse
+        import os
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-g", "--groups", help = "Contig megabase groups (contig.group) for this shard, separated by a comma and in output order.")
+        parser.add_argument("-n", "--shardNumber", help = "Which piece of the final table this is.  Shard 0 carries the header line.", type = int)
+        parser.add_argument("-t", "--tempdir", help = "Holds the name of the temporary directory we are using.")
+        parser.add_argument("-c", "--columnNames", help = "JSON file with the sample column order and the header names to print for them")
+        parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
+        parser.add_argument("-m", "--emptyCellMarker", help = "Marker for blank cells in text output.", default = "")
+        parser.add_argument("-k", "--pickleOut", help = "Write the shard as a pickled data frame instead of text.", action = 'store_true')
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
+        rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
+        if rawArgs.tempdir:
+            if os.path.isdir(rawArgs.tempdir):
+                self.tempdir = rawArgs.tempdir
+            else:
+                raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
+        else:
+            raise RuntimeError("No temporary directory specified.  This is not designed to run without one.")
+        if rawArgs.shardNumber is None or rawArgs.shardNumber < 0:
+            raise RuntimeError("A shard number must be specified.")
+        self.shardNumber = rawArgs.shardNumber
+        if rawArgs.groups:
+            self.groups = rawArgs.groups.split(",")
+        else:
+            self.groups = []  #no accepted loci at all, but shard 0 still writes the header
+        if not rawArgs.columnNames or not os.path.isfile(rawArgs.columnNames):
+            raise RuntimeError("Column name file not found: " + str(rawArgs.columnNames))
+        self.columnNames = rawArgs.columnNames
+        self.verbose = rawArgs.verbose
+        self.emptyCellMarker = rawArgs.emptyCellMarker
+        self.pickleOut = rawArgs.pickleOut
+
+def shardFileName(tempdir, shardNumber, pickleOut):  #battleStar looks for the pieces under the same names
+    import os
+    if pickleOut:
+        return tempdir + os.sep + "finalParts" + os.sep + str(shardNumber) + ".data.pkl"
+    return tempdir + os.sep + "finalParts" + os.sep + str(shardNumber) + ".data.txt"
+
+def groupRows(acceptedIndex, groups):  #(first row, last row + 1) in the accepted index covered by these groups.  Groups are handed out in index order, so a shard is one run of rows.
+    import numpy
+    start = len(acceptedIndex)
+    end = 0
+    for group in groups:
+        contig, megabase = group.rsplit(".", 1)
+        megabase = int(megabase)
+        if not contig in acceptedIndex.contigNumbers:
+            raise RuntimeError("Contig " + contig + " from group " + group + " is not in the accepted index.")
+        positions = numpy.asarray(acceptedIndex.contigPositions(contig))
+        offset = acceptedIndex.offsets[acceptedIndex.contigNumbers[contig]]
+        first = offset + int(numpy.searchsorted(positions, megabase * 1000000, side = 'left'))
+        last = offset + int(numpy.searchsorted(positions, (megabase + 1) * 1000000, side = 'left'))
+        if last > first:
+            start = min(start, first)
+            end = max(end, last)
+    if end <= start:
+        return (0, 0)
+    return (start, end)
+
+def getSampleFiles():  #sample name -> filter 1 sample file
+    import os
+    import colonialOne
+    sampleFileDirectory = args.tempdir + os.sep + "filter1" + os.sep
+    sampleFiles = {}
+    for file in os.listdir(sampleFileDirectory):
+        if file.endswith(colonialOne.sampleSuffix):
+            sampleFiles[colonialOne.sampleName(file)] = sampleFileDirectory + file
+    return sampleFiles
+
+def fillShardColumn(shard, column, sample, acceptedIndex, start, end):  #looks up only the sample's rows on contigs and positions this shard covers.  A locus reported twice keeps the last value, same as filter 2.
+    import numpy
+    import colonialOne
+    positions = sample.positions()
+    codes = False
+    for code in range(0, len(sample.contigNames)):
+        contig = sample.contigNames[code]
+        if not contig in acceptedIndex.contigNumbers:
+            continue
+        number = acceptedIndex.contigNumbers[contig]
+        first = max(start, acceptedIndex.offsets[number])
+        last = min(end, acceptedIndex.offsets[number + 1])
+        if last <= first:
+            continue
+        lowest = acceptedIndex.positions[first]
+        highest = acceptedIndex.positions[last - 1]
+        contigRows = sample.contigRows(code)
+        if contigRows:  #sorted file, so two binary searches find the rows without reading the rest of it
+            first, last = contigRows
+            rows = first + numpy.arange(numpy.searchsorted(positions[first:last], lowest, side = 'left'), numpy.searchsorted(positions[first:last], highest, side = 'right'))
+        else:  #no row table, so scan the whole file
+            if codes is False:
+                codes = numpy.asarray(sample.contigCodes())
+            rows = numpy.flatnonzero((codes == code) & (positions >= lowest) & (positions <= highest))
+        found, matches = acceptedIndex.lookup(contig, numpy.asarray(positions[rows]))
+        shard[matches - start, column] = colonialOne.decodeRatios(numpy.asarray(sample.records["ratio"][rows[found]]))
+
+def buildShard(acceptedIndex, samples, start, end):  #rows start to end for every sample, and whether any of them had quantized ratios
+    import numpy
+    import colonialOne
+    sampleFiles = getSampleFiles()
+    shard = numpy.full((end - start, len(samples)), numpy.nan, dtype = numpy.float32)
+    quantized = False
+    if end <= start:
+        return (shard, quantized)
+    for column in range(0, len(samples)):
+        if not samples[column] in sampleFiles:
+            raise RuntimeError("No filter 1 results found for sample " + samples[column])
+        if args.verbose:
+            print("Collecting sample " + str(column + 1) + " of " + str(len(samples)) + ".       ", end = "\r")
+        sample = colonialOne.SampleData(sampleFiles[samples[column]])
+        recorder.readFile(sampleFiles[samples[column]])
+        recorder.count("rowsRead", len(sample))
+        fillShardColumn(shard, column, sample, acceptedIndex, start, end)
+        quantized = quantized or colonialOne.ratioEncodingOf(sample.records["ratio"].dtype) == "uint16"
+    return (shard, quantized)
+
+def main():
+    import datetime
+    import json
+    import os
+    import pandas
+    import colonialOne
+    import flightRecorder
+    start = datetime.datetime.now()
+    global args
+    args = CheckArgs()
+    global recorder
+    recorder = flightRecorder.FlightRecorder("heavyRaider", args.tempdir, args.profile)
+    columnNameFile = open(args.columnNames, 'r')
+    columnNames = json.load(columnNameFile)
+    columnNameFile.close()
+    acceptedIndex = colonialOne.AcceptedIndex.load(args.tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')
+    firstRow, lastRow = groupRows(acceptedIndex, args.groups)
+    if args.verbose:
+        print("Shard " + str(args.shardNumber) + " covers " + str(lastRow - firstRow) + " loci in " + str(len(args.groups)) + " groups.")
+    values, quantized = buildShard(acceptedIndex, columnNames["samples"], firstRow, lastRow)
+    if quantized and not args.pickleOut:  #dequantized ratios print to the precision they were kept at
+        values = colonialOne.roundRatios(values)
+    shard = pandas.DataFrame(values, index = acceptedIndex.rowLabels(firstRow, lastRow), columns = columnNames["headers"])
+    outputFileName = shardFileName(args.tempdir, args.shardNumber, args.pickleOut)
+    if args.pickleOut:
+        with recorder.timing("pickleDump"):
+            shard.to_pickle(outputFileName + ".tmp")
+    else:
+        with recorder.timing("tableWrite"):
+            shard.to_csv(outputFileName + ".tmp", sep = "\t", na_rep = args.emptyCellMarker, header = args.shardNumber == 0)
+    os.rename(outputFileName + ".tmp", outputFileName)
+    recorder.count("rowsAccepted", len(shard))
+    recorder.wroteFile(outputFileName)
+    recorder.finish()
+    if args.verbose:
+        runtime = datetime.datetime.now() - start
+        print("Shard " + str(args.shardNumber) + " completed in " + str(runtime) + ".                  ")
+
+main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#Kobol is where everything was written down.  This module is the chunked output store: the final matrix saved as per-contig blocks of sample columns with a locus index and sample list, and a reader that memory maps only the blocks a region needs, so that nobody has to load the whole table to look at a piece of it.
+
+storeFileName = "store.json"
+storeFormat = "battlestar-store"
+storeVersion = 1
+
+def safeContigName(contig):  #contig names become directory names
+    import re
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', contig)
+
+def writeStore(directory, resultMatrix, acceptedIndex, samples = False, headers = False, blockRows = 1000000, verbose = False):  #writes the store from a result matrix.  Built under a temporary name and moved into place whole.
+    import json
+    import os
+    import shutil
+    import numpy
+    import colonialOne
+    if not samples:
+        samples = resultMatrix.sampleNames
+    if not headers:
+        headers = samples
+    columnNumbers = [resultMatrix.columnNumber(name) for name in samples]
+    buildDirectory = directory + ".tmp"
+    if os.path.isdir(buildDirectory):
+        shutil.rmtree(buildDirectory)
+    os.mkdir(buildDirectory)
+    blocks = {}
+    for contig in acceptedIndex.contigs:
+        number = acceptedIndex.contigNumbers[contig]
+        first = acceptedIndex.offsets[number]
+        last = acceptedIndex.offsets[number + 1]
+        contigDirectory = buildDirectory + os.sep + safeContigName(contig)
+        os.mkdir(contigDirectory)
+        blocks[contig] = []
+        for start in range(first, last, blockRows):
+            end = min(start + blockRows, last)
+            block = numpy.ascontiguousarray(resultMatrix.block(start, end)[:, columnNumbers].T)  #samples x rows, so one sample's values in a block sit together.  Kept in the matrix encoding, so a quantized matrix makes a store half the size.
+            blockFileName = safeContigName(contig) + os.sep + str(len(blocks[contig])) + ".npy"
+            numpy.save(buildDirectory + os.sep + blockFileName, block)
+            blocks[contig].append([start - first, end - first, blockFileName])
+        if verbose:
+            print("Stored contig " + contig + " in " + str(len(blocks[contig])) + " block(s).       ", end = "\r")
+    numpy.save(buildDirectory + os.sep + "loci.npy", numpy.asarray(acceptedIndex.positions))
+    header = {"format" : storeFormat,
+              "version" : storeVersion,
+              "samples" : list(headers),
+              "contigs" : acceptedIndex.contigs,
+              "offsets" : acceptedIndex.offsets,
+              "blocks" : blocks,
+              "dataType" : resultMatrix.dataType.str,
+              "ratioEncoding" : colonialOne.ratioEncodingOf(resultMatrix.dataType)}
+    headerFile = open(buildDirectory + os.sep + storeFileName, 'w')
+    json.dump(header, headerFile)
+    headerFile.close()
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.rename(buildDirectory, directory)
+    if verbose:
+        print("Stored " + str(len(acceptedIndex)) + " loci for " + str(len(samples)) + " samples in " + directory + ".                  ")
+
+class OutputStore(object):  #reader for a store directory.  Nothing is loaded until a region is asked for, and then only the blocks that overlap it.
+
+    def __init__(self, directory):
+        import json
+        import os
+        import numpy
+        if not os.path.isfile(directory + os.sep + storeFileName):
+            raise RuntimeError("No output store found in " + directory)
+        headerFile = open(directory + os.sep + storeFileName, 'r')
+        header = json.load(headerFile)
+        headerFile.close()
+        if header.get("format") != storeFormat or header.get("version", 0) > storeVersion:
+            raise RuntimeError("Unrecognized output store header in " + directory)
+        self.directory = directory
+        self.samples = header["samples"]
+        self.contigs = header["contigs"]
+        self.offsets = header["offsets"]
+        self.blocks = header["blocks"]
+        self.dataType = numpy.dtype(header["dataType"])
+        self.sampleNumbers = {}
+        for i in range(0, len(self.samples)):
+            self.sampleNumbers[self.samples[i]] = i
+        if self.offsets[-1]:
+            self.positions = numpy.load(directory + os.sep + "loci.npy", mmap_mode = 'r')
+        else:
+            self.positions = numpy.zeros(0, dtype = numpy.int32)
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def contigPositions(self, contig):
+        if not contig in self.contigs:
+            raise RuntimeError("Contig " + str(contig) + " is not in this store.")
+        number = self.contigs.index(contig)
+        return self.positions[self.offsets[number]:self.offsets[number + 1]]
+
+    def sampleColumns(self, samples):
+        if samples is None:
+            return list(range(0, len(self.samples)))
+        if isinstance(samples, str):
+            samples = [samples]
+        columns = []
+        for name in samples:
+            if not name in self.sampleNumbers:
+                raise RuntimeError("Sample " + str(name) + " is not in this store.")
+            columns.append(self.sampleNumbers[name])
+        return columns
+
+    def regionArray(self, contig, start = None, end = None, samples = None):  #(positions, loci x samples array) for start <= position < end on one contig, always as floats
+        import os
+        import numpy
+        import colonialOne
+        contig = str(contig).replace("chr", "")
+        positions = numpy.asarray(self.contigPositions(contig))
+        first = 0 if start is None else int(numpy.searchsorted(positions, start, side = 'left'))
+        last = len(positions) if end is None else int(numpy.searchsorted(positions, end, side = 'left'))
+        columns = self.sampleColumns(samples)
+        values = numpy.full((max(last - first, 0), len(columns)), numpy.nan, dtype = numpy.float32)
+        for blockStart, blockEnd, blockFileName in self.blocks[contig]:
+            if blockEnd <= first or blockStart >= last:
+                continue
+            block = numpy.load(self.directory + os.sep + blockFileName, mmap_mode = 'r')  #samples x rows
+            lo = max(first, blockStart)
+            hi = min(last, blockEnd)
+            values[lo - first:hi - first] = colonialOne.decodeRatios(numpy.asarray(block[columns, lo - blockStart:hi - blockStart])).T
+            del block
+        return (positions[first:last], values)
+
+    def region(self, contig, start = None, end = None, samples = None):  #the same as a DataFrame, labelled like the text output
+        import pandas
+        contig = str(contig).replace("chr", "")
+        positions, values = self.regionArray(contig, start, end, samples)
+        columns = [self.samples[column] for column in self.sampleColumns(samples)]
+        return pandas.DataFrame(values, index = [contig + ":" + str(position) for position in positions.tolist()], columns = columns)
+
+    def fillRates(self, samples = None):  #fraction of loci with a value for each sample, computed a block at a time
+        import os
+        import numpy
+        import pandas
+        import colonialOne
+        columns = self.sampleColumns(samples)
+        observed = numpy.zeros(len(columns), dtype = numpy.int64)
+        for contig in self.contigs:
+            for blockStart, blockEnd, blockFileName in self.blocks[contig]:
+                block = numpy.load(self.directory + os.sep + blockFileName, mmap_mode = 'r')
+                observed += (~numpy.isnan(colonialOne.decodeRatios(numpy.asarray(block[columns])))).sum(axis = 1)
+                del block
+        return pandas.Series(observed / max(len(self), 1), index = [self.samples[column] for column in columns])
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#The Pegasus kept its own log and came back from the dead.  This module keeps the run manifest in the temporary directory: for each stage and each per-sample task, a hash of its inputs and parameters, the outputs it made, and whether it finished, so that a restarted run only redoes what is missing or stale.
+
+manifestFileName = "runManifest.json"
+manifestVersion = 2  #2 records the prior signature of each output instead of a start time
+
+def fileSignature(fileName):  #size and modification time, which is what we compare to decide if a file has changed.  Returns None if the file is not there.
+    import os
+    try:
+        status = os.stat(fileName)
+    except OSError:
+        return None
+    return [status.st_size, status.st_mtime_ns]
+
+def inputKey(parameters, inputFiles):  #hash of the parameters that matter and the signature of every input file.  Anything that changes either one changes the key.
+    import hashlib
+    import json
+    record = {"parameters" : parameters,
+              "inputs" : [[fileName, fileSignature(fileName)] for fileName in inputFiles]}
+    return hashlib.sha1(json.dumps(record, sort_keys = True).encode('utf-8')).hexdigest()
+
+def outputsStillValid(outputs):  #outputs is a dictionary of file name -> signature recorded when the work finished
+    if not outputs:
+        return False
+    for fileName in outputs:
+        if fileSignature(fileName) != outputs[fileName]:
+            return False
+    return True
+
+class RunManifest(object):
+
+    def __init__(self, tempdir):
+        import os
+        self.fileName = tempdir + os.sep + manifestFileName
+        self.stages = {}
+        self.tasks = {}
+        if os.path.isfile(self.fileName):
+            self.load()
+
+    def load(self):
+        import json
+        manifestFile = open(self.fileName, 'r')
+        record = json.load(manifestFile)
+        manifestFile.close()
+        if record.get("version") != manifestVersion:  #an old manifest we cannot trust, so everything reruns
+            return
+        self.stages = record["stages"]
+        self.tasks = record["tasks"]
+
+    def save(self):  #written to a temporary name and moved into place so a crash cannot leave half a manifest
+        import json
+        import os
+        manifestFile = open(self.fileName + ".tmp", 'w')
+        json.dump({"version" : manifestVersion, "stages" : self.stages, "tasks" : self.tasks}, manifestFile, indent = 1, sort_keys = True)
+        manifestFile.close()
+        os.rename(self.fileName + ".tmp", self.fileName)
+
+    def stageComplete(self, stage, key):
+        entry = self.stages.get(stage)
+        if not entry or entry["key"] != key or not entry["complete"]:
+            return False
+        return outputsStillValid(entry["outputs"])
+
+    def recordStage(self, stage, key, outputFiles):  #call once the stage has finished
+        self.stages[stage] = {"key" : key,
+                              "complete" : True,
+                              "outputs" : dict([(fileName, fileSignature(fileName)) for fileName in outputFiles])}
+        self.save()
+
+    def invalidateStage(self, stage):
+        if stage in self.stages:
+            del self.stages[stage]
+            self.save()
+
+    def taskComplete(self, stage, taskName, key):
+        entry = self.tasks.get(stage, {}).get(taskName)
+        if not entry or entry["key"] != key or not entry["complete"]:
+            return False
+        return outputsStillValid(entry["outputs"])
+
+    def startTasks(self, stage, taskOutputs, keys):  #taskOutputs is task name -> list of output files.  Recorded before launching so that even if we crash, finished outputs can be claimed later.  The signature each output had beforehand (None if it was not there) is kept, so settling only has to see it change and never compares our clock with the file server's.
+        stageTasks = self.tasks.setdefault(stage, {})
+        for taskName in taskOutputs:
+            stageTasks[taskName] = {"key" : keys[taskName],
+                                    "complete" : False,
+                                    "priorOutputs" : dict([(fileName, fileSignature(fileName)) for fileName in taskOutputs[taskName]]),
+                                    "outputs" : dict([(fileName, None) for fileName in taskOutputs[taskName]])}
+        self.save()
+
+    def settleTasks(self, stage):  #marks started tasks complete if every output was written since they started.  Outputs are all moved into place whole, so one that exists is one that finished.
+        settled = 0
+        for taskName, entry in self.tasks.get(stage, {}).items():
+            if entry["complete"]:
+                continue
+            signatures = dict([(fileName, fileSignature(fileName)) for fileName in entry["outputs"]])
+            if not signatures or None in signatures.values():
+                continue
+            if [fileName for fileName in signatures if signatures[fileName] == entry["priorOutputs"].get(fileName)]:  #left over from an earlier attempt
+                continue
+            entry["outputs"] = signatures
+            entry["complete"] = True
+            settled += 1
+        self.save()
+        return settled
+
+    def completedOutputs(self, stage):  #every output file of this stage's completed tasks
+        outputs = []
+        for entry in self.tasks.get(stage, {}).values():
+            if entry["complete"]:
+                outputs += list(entry["outputs"].keys())
+        return outputs
+
+def removeStrays(directory, suffix, keepFiles):  #removes files with this suffix that no current task owns, so stale results from an earlier attempt cannot be picked up by the next stage.  Returns how many were removed.
+    import os
+    keep = set([os.path.abspath(fileName) for fileName in keepFiles])
+    removed = 0
+    for file in os.listdir(directory):
+        fileName = directory + os.sep + file
+        if file.endswith(suffix) and not os.path.abspath(fileName) in keep:
+            os.remove(fileName)
+            removed += 1
+    return removed
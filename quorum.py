@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#The Quorum of Twelve outlasts any one session.  This module is the persistent cohort store: every sample's filtered arrays, the running locus representation counts, and the result matrix, so that a new batch of samples only costs its own parsing, its own columns, and the rows whose accepted status changed.
+
+cohortFileName = "cohort.json"  #also says which generation of index and matrix is current, and is always the last thing an update writes
+cohortVersion = 2  #1 kept a single index and matrix, which is what generation 0 is
+spareSlots = 0.25  #extra room left in each column whenever the matrix is laid out again, so loci can be added in place for a while
+
+class CohortStore(object):
+
+    def __init__(self, directory):
+        import os
+        self.directory = directory
+        self.sampleDirectory = directory + os.sep + "samples"
+        self.countsFileName = directory + os.sep + "counts.npz"
+        self.generation = 0
+        for folder in [directory, self.sampleDirectory]:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+        self.samples = {}  #sample name -> {"key" : input key, "file" : sample file in the store}
+        self.sampleOrder = []  #column order in the matrix, oldest samples first
+        self.changedSamples = set()  #samples added or replaced since the matrix was last brought up to date
+        if os.path.isfile(directory + os.sep + cohortFileName):
+            self.load()
+        self.indexBaseName, self.matrixBaseName = self.baseNames(self.generation)
+        self.locusCounts = False
+
+    def load(self):
+        import json
+        import os
+        cohortFile = open(self.directory + os.sep + cohortFileName, 'r')
+        record = json.load(cohortFile)
+        cohortFile.close()
+        if not record.get("version") in [1, cohortVersion]:
+            raise RuntimeError("Unrecognized cohort store version in " + self.directory)
+        self.samples = record["samples"]
+        self.sampleOrder = record["sampleOrder"]
+        self.changedSamples = set(record["changedSamples"])
+        self.generation = record.get("generation", 0)
+
+    def save(self):
+        import json
+        import os
+        fileName = self.directory + os.sep + cohortFileName
+        cohortFile = open(fileName + ".tmp", 'w')
+        json.dump({"version" : cohortVersion, "samples" : self.samples, "sampleOrder" : self.sampleOrder, "changedSamples" : sorted(self.changedSamples), "generation" : self.generation}, cohortFile, indent = 1, sort_keys = True)
+        cohortFile.close()
+        os.rename(fileName + ".tmp", fileName)
+
+    def __len__(self):
+        return len(self.sampleOrder)
+
+    def baseNames(self, generation):  #(index, matrix) base names for a generation.  Generation 0 uses the plain names, same as stores from before there were generations.
+        import os
+        suffix = ""
+        if generation:
+            suffix = ".g" + str(generation)
+        return (self.directory + os.sep + "acceptedIndex" + suffix, self.directory + os.sep + "resultMatrix" + suffix)
+
+    def removeStrays(self):  #removes index, matrix and sample files that the current generation does not use, whether from the generation it replaced or from an update that crashed before it was committed
+        import os
+        import colonialOne
+        keep = set([self.indexBaseName + ".json", self.indexBaseName + ".npy"])
+        if os.path.isfile(self.matrixBaseName + ".json"):
+            keep.update(colonialOne.ResultMatrix.open(self.matrixBaseName).files())
+        for file in os.listdir(self.directory):
+            fileName = self.directory + os.sep + file
+            if (file.startswith("acceptedIndex.") or file.startswith("resultMatrix.")) and not fileName in keep:
+                os.remove(fileName)
+        keepSamples = set()
+        for sample in self.samples.values():
+            keepSamples.update([os.path.abspath(sample["file"]), os.path.abspath(colonialOne.headerFileName(sample["file"]))])
+        for folder, subfolders, files in os.walk(self.sampleDirectory, topdown = False):
+            for file in files:
+                fileName = folder + os.sep + file
+                if not os.path.abspath(fileName) in keepSamples:
+                    os.remove(fileName)
+            if folder != self.sampleDirectory and not os.listdir(folder):
+                os.rmdir(folder)
+
+    def sampleKey(self, name):  #input key the stored sample was made from, or None if we do not have it
+        if name in self.samples:
+            return self.samples[name]["key"]
+        return None
+
+    def counts(self):
+        import os
+        import colonialOne
+        if not self.locusCounts:
+            if os.path.isfile(self.countsFileName):
+                self.locusCounts = colonialOne.LocusCounts.load(self.countsFileName)
+            else:
+                self.locusCounts = colonialOne.LocusCounts()
+        return self.locusCounts
+
+    def addSample(self, sampleFileName, key):  #moves a filter 1 sample file into the store and folds it into the counts.  A sample we already had is swapped out, taking its old observations back out of the counts first.
+        import os
+        import numpy
+        import colonialOne
+        name = colonialOne.sampleName(sampleFileName)
+        storedFileName = self.sampleDirectory + os.sep + sampleFileName.split(os.sep)[-1]
+        locusCounts = self.counts()
+        if name in self.samples:
+            oldSample = colonialOne.SampleData(self.samples[name]["file"])
+            for contig, positions, ratios in oldSample.byContig():
+                locusCounts.addPositions(contig, positions, numpy.full(len(positions), -1, dtype = numpy.int32))
+            del oldSample
+            storedFileName = self.sampleDirectory + os.sep + key + os.sep + sampleFileName.split(os.sep)[-1]  #the old file stays where cohort.json points until the update is saved, and removeStrays clears it after that
+            if not os.path.isdir(os.path.dirname(storedFileName)):
+                os.mkdir(os.path.dirname(storedFileName))
+        else:
+            self.sampleOrder.append(name)
+        os.rename(colonialOne.headerFileName(sampleFileName), colonialOne.headerFileName(storedFileName))
+        os.rename(sampleFileName, storedFileName)
+        locusCounts.addSample(colonialOne.SampleData(storedFileName))
+        self.samples[name] = {"key" : key, "file" : storedFileName}
+        self.changedSamples.add(name)
+
+    def saveCounts(self):
+        import os
+        self.counts().save(self.countsFileName + ".tmp")
+        os.rename(self.countsFileName + ".tmp", self.countsFileName)
+
+    def acceptedLoci(self, minRepresentationPercent):  #same rule as the counting step, against the whole cohort
+        return self.counts().accepted(len(self.sampleOrder) * minRepresentationPercent)
+
+    def update(self, acceptedIndex, quantizeRatios = False, verbose = False):  #brings the matrix in line with a new accepted index as the next generation.  Rows that stay accepted keep their slots and values, added loci go into free slots and are the only rows looked up in samples we already had, and new or changed samples get new columns on the end.  Nothing the current generation reads is written, and cohort.json switches generations last, so a crash at any point leaves the last complete index and matrix in place.
+        import os
+        import numpy
+        import colonialOne
+        self.saveCounts()
+        self.save()  #counts and samples are safe on disk before we touch the matrix
+        self.removeStrays()
+        if quantizeRatios:
+            dataType = "uint16"
+        else:
+            dataType = "float32"
+        if os.path.isfile(self.indexBaseName + ".json") and os.path.isfile(self.matrixBaseName + ".json"):
+            oldIndex = colonialOne.AcceptedIndex.load(self.indexBaseName, memoryMap = False)
+            oldMatrix = colonialOne.ResultMatrix.open(self.matrixBaseName)
+            if colonialOne.ratioEncodingOf(oldMatrix.dataType) != dataType:  #switching encodings means every column comes fresh from its sample rather than converted from the old matrix
+                oldMatrix = False
+        else:
+            oldIndex = colonialOne.AcceptedIndex([], [0], numpy.zeros(0, dtype = numpy.int32))
+            oldMatrix = False
+        oldRows, newRows, addedLoci = rowMapping(oldIndex, acceptedIndex)
+        oldSamples = [name for name in self.sampleOrder if oldMatrix and name in oldMatrix.columnNumbers and not name in self.changedSamples]
+        if verbose:
+            print(str(len(acceptedIndex)) + " accepted loci: " + str(len(newRows)) + " kept, " + str(len(oldIndex) - len(newRows)) + " dropped, " + str(len(acceptedIndex) - len(newRows)) + " added.  " + str(len(self.sampleOrder) - len(oldSamples)) + " new or changed sample column(s).")
+        if len(addedLoci):
+            addedIndex = colonialOne.AcceptedIndex.fromAcceptedLoci(addedLoci, [contig for contig in acceptedIndex.contigs if contig in addedLoci])
+            addedRows = numpy.asarray(rowMapping(addedIndex, acceptedIndex)[1])  #where each added locus lands in the new index
+        else:
+            addedIndex = False
+            addedRows = numpy.zeros(0, dtype = numpy.int64)
+        indexBaseName, matrixBaseName = self.baseNames(self.generation + 1)
+        matrix = False
+        if oldMatrix:
+            matrix = self.remapMatrix(oldMatrix, matrixBaseName, len(acceptedIndex), oldRows, newRows, addedRows, oldSamples)
+        inPlace = bool(matrix)
+        if inPlace:
+            if verbose:
+                print("Adding " + str(len(addedRows)) + " loci and " + str(len(self.sampleOrder) - len(oldSamples)) + " column(s) in place.")
+        else:
+            if verbose:
+                print("Laying out a new result matrix.")
+            matrix = colonialOne.ResultMatrix.create(matrixBaseName, len(acceptedIndex), self.sampleOrder, dataType, slots = int(len(acceptedIndex) * (1 + spareSlots)))
+        progress = 0
+        for name in self.sampleOrder:
+            progress += 1
+            if verbose:
+                print("Updating column " + str(progress) + " of " + str(len(self.sampleOrder)) + ".       ", end = "\r")
+            if name in oldSamples and inPlace and not len(addedRows):  #already there and nothing to add
+                continue
+            sample = colonialOne.SampleData(self.samples[name]["file"])
+            if not name in oldSamples:
+                writeSampleColumn(matrix, name, sample, acceptedIndex)
+                continue
+            addedColumn = numpy.full(len(addedRows), numpy.nan, dtype = numpy.float32)
+            if len(addedRows):  #only the loci that just became accepted are looked up in the sample
+                sampleRows, addedIndexRows = addedIndex.lookupSample(sample)
+                addedColumn[addedIndexRows] = numpy.asarray(sample.ratios())[sampleRows]
+            if inPlace:  #kept rows are already in their slots
+                matrix.writeColumn(name, addedColumn, rows = addedRows)
+                continue
+            column = numpy.full(len(acceptedIndex), numpy.nan, dtype = numpy.float32)
+            column[newRows] = colonialOne.decodeRatios(oldMatrix.readColumn(name)[oldRows])
+            column[addedRows] = addedColumn
+            matrix.writeColumn(name, column)
+        if verbose:
+            print("Updated " + str(len(self.sampleOrder)) + " columns.                  ")
+        acceptedIndex.save(indexBaseName)
+        matrix.saveHeader()
+        self.generation += 1
+        self.changedSamples = set()
+        self.save()  #the new generation is live from here
+        self.indexBaseName, self.matrixBaseName = indexBaseName, matrixBaseName
+        self.removeStrays()
+        return colonialOne.ResultMatrix.open(self.matrixBaseName)
+
+    def remapMatrix(self, oldMatrix, matrixBaseName, rows, oldRows, newRows, addedRows, oldSamples):  #the next generation as a view of the same data file: kept rows stay in their slots, added rows take slots the current generation does not read (a dropped row's slot is only reused one generation later, so an update that crashes leaves the live generation intact), and new or changed samples get columns past the last one.  Returns False if the slots run out or too many columns would be dead, and the matrix should be laid out again.
+        import numpy
+        import colonialOne
+        keptSlots = oldMatrix.rowSlots()[oldRows]
+        used = numpy.zeros(oldMatrix.slots, dtype = bool)
+        used[oldMatrix.rowSlots()] = True
+        freeSlots = numpy.flatnonzero(~used)
+        if len(freeSlots) < len(addedRows):
+            return False
+        columns = []
+        nextColumn = max(oldMatrix.columns + [-1]) + 1
+        for name in self.sampleOrder:
+            if name in oldSamples:
+                columns.append(oldMatrix.columns[oldMatrix.columnNumber(name)])
+            else:
+                columns.append(nextColumn)
+                nextColumn += 1
+        if nextColumn > 2 * len(self.sampleOrder):  #more dead columns (from replaced samples) than live ones
+            return False
+        rowMap = numpy.zeros(rows, dtype = numpy.int64)
+        rowMap[newRows] = keptSlots
+        rowMap[addedRows] = freeSlots[:len(addedRows)]
+        matrix = colonialOne.ResultMatrix(matrixBaseName, rows, self.sampleOrder, oldMatrix.dataType, mode = 'r+', slots = oldMatrix.slots, columns = columns, rowMap = rowMap, matrixFileName = oldMatrix.matrixFileName)
+        matrixFile = open(matrix.matrixFileName, 'r+b')
+        matrixFile.seek(0, 2)
+        if matrixFile.tell() < nextColumn * matrix.columnStride * matrix.dataType.itemsize:  #only ever grows, since the current generation still reads it
+            matrixFile.truncate(nextColumn * matrix.columnStride * matrix.dataType.itemsize)
+        matrixFile.close()
+        return matrix
+
+def rowMapping(oldIndex, newIndex):  #returns (old rows, new rows) for loci in both indexes, and contig -> positions of the loci only in the new one
+    import numpy
+    oldRows = []
+    newRows = []
+    addedLoci = {}
+    for contig in newIndex.contigs:
+        positions = numpy.asarray(newIndex.contigPositions(contig))
+        found, matches = oldIndex.lookup(contig, positions)
+        offset = newIndex.offsets[newIndex.contigNumbers[contig]]
+        oldRows.append(matches)
+        newRows.append(numpy.flatnonzero(found) + offset)
+        if not found.all():
+            addedLoci[contig] = positions[~found]
+    if not oldRows:
+        return (numpy.zeros(0, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.int64), addedLoci)
+    return (numpy.concatenate(oldRows).astype(numpy.int64), numpy.concatenate(newRows).astype(numpy.int64), addedLoci)
+
+def writeSampleColumn(matrix, name, sample, acceptedIndex):  #a whole column, the same way filter 2 fills it in
+    import numpy
+    sampleRows, indexRows = acceptedIndex.lookupSample(sample)
+    column = numpy.full(len(acceptedIndex), numpy.nan, dtype = numpy.float32)  #the matrix quantizes it on the way in if it holds uint16
+    column[indexRows] = numpy.asarray(sample.ratios())[sampleRows]
+    matrix.writeColumn(name, column)
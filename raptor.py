@@ -14,6 +14,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser = argparse.ArgumentParser()
         parser.add_argument("-t", "--tempdir", help = "Holds the name of the temporary directory we are using.")
         parser.add_argument("-c", "--clockOutDir", help = "Directory for clocking out when done.")
+        parser.add_argument("-q", "--taskQueue", help = "Work tasks from this queue directory until it is empty instead of running a single bash file.")
         rawArgs = parser.parse_args()
         if rawArgs.tempdir:
             if os.path.isdir(rawArgs.tempdir):
@@ -21,7 +22,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
         else:
-            raise RunTimeError("No temporary directory specified.")
+            raise RuntimeError("No temporary directory specified.")
         if rawArgs.clockOutDir:
             if os.path.isdir(rawArgs.clockOutDir):
                 self.clockOutDir = rawArgs.clockOutDir
@@ -31,9 +32,13 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
                 raise RuntimeError("Clock out directory not found: " + rawArgs.clockOutDir)
         else:
             raise RuntimeError("No clockout directory given.")
+        if rawArgs.taskQueue and not os.path.isdir(rawArgs.taskQueue):
+            raise RuntimeError("Task queue directory not found: " + rawArgs.taskQueue)
+        self.taskQueue = rawArgs.taskQueue
                 
 def main():
     import os  #import the library for making os system calls
+    import fleetCommand
     global args  #declare args as a global
     args = CheckArgs()  #get an object containing validated arguments
     try:
@@ -43,11 +48,15 @@ def main():
     tempdir = args.tempdir  #get the tempdir from arguments
     if not tempdir.endswith(os.sep):  #if it does not end with a separator
         tempdir += os.sep  #add one
-    bashFilePath = tempdir + "bashFiles" + os.sep + str(thisJob) + ".sh"  #initialize a string with our bash file name based upon our job number
-    jobStatus = os.system("bash " + bashFilePath)  #run the bash file we just identified and set jobStatus to its exit status
+    if args.taskQueue:  #keep claiming tasks until there are none left
+        jobStatus = fleetCommand.runQueueWorker(args.taskQueue)
+    else:
+        bashFilePath = tempdir + "bashFiles" + os.sep + str(thisJob) + ".sh"  #initialize a string with our bash file name based upon our job number
+        jobStatus = os.system("bash " + bashFilePath)  #run the bash file we just identified and set jobStatus to its exit status
     if jobStatus == 0:  #if the job finished successfully
         touchFilePath = args.clockOutDir + str(thisJob)  #define our clockout file
         touchFile = open(touchFilePath, 'w')  #create our clockout file
         touchFile.close()  #close it without writing anything
+        fleetCommand.notifyListener(args.clockOutDir, thisJob)  #tell the head node right away instead of waiting for it to notice the file
     
 main()
\ No newline at end of file
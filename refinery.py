@@ -6,11 +6,14 @@ University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
 email: [myfirstname].[mylastname] AT ucla.edu
 '''
 
+batchRows = 100000  #parsed lines filtered at a time.  The filters work on whole arrays, and this keeps the batch small next to the file.
+
 class CheckArgs():  #class that checks arguments and ultimately returns a validated set of arguments to the main program
     
     def __init__(self):
         import argparse
         import os
+        import dradis
         parser = argparse.ArgumentParser()
         parser.add_argument("-f", "--file", help = "Pass a filename for this job to work on directly.")
         parser.add_argument("-l", "--fileList", help = "Pass a pickle containing a list of files to operate on.")
@@ -19,8 +22,16 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
         parser.add_argument("-s", "--contextRequirement", help = "Specify context sequence requirements (multiples can be passed separated by commas)")
         parser.add_argument("-e", "--contextExclusion", help = "Specify context sequence exclusions (multiples can be passed separated by commas)")
+        parser.add_argument("--maxCoverage", help = "Maximum coverage (0 for no ceiling)", default = 0, type = int)
+        parser.add_argument("--minRatio", help = "Drop loci with a ratio below this", type = float)
+        parser.add_argument("--maxRatio", help = "Drop loci with a ratio above this", type = float)
+        parser.add_argument("--contigAllow", help = "Only keep these contigs (names or patterns such as 1,2,X or GL*, separated by commas).  Names are matched with any chr dropped, as they appear in the output.")
+        parser.add_argument("--contigDeny", help = "Drop these contigs (names or patterns such as M,Un*,*_random, separated by commas).  Names are matched with any chr dropped, as they appear in the output.")
+        parser.add_argument("--regions", help = "Only keep loci inside these target regions (a BED file, or the .npz index battleStar builds from one)")
         parser.add_argument("--sampleSize", help = "Specify how many lines from both the locus list and data set should be shown", default = 10, type = int)
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         if rawArgs.file and rawArgs.fileList:
             raise RuntimeError("Error: A single file and a list of files cannot both be specified for a run.  Too confusing.")
         if rawArgs.file:
@@ -39,7 +50,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             raise RuntimeError("No file name or file list pickle argument passed.  Nothing for me to work on.  Bored now.")
         self.minCoverage = rawArgs.minCoverage
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 self.tempdir = rawArgs.tempdir
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
@@ -56,10 +67,12 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             self.contextExclusion = [item.upper() for item in self.contextExclusion]
         else:
             self.contextExclusion = []
-        if self.contextExclusion and self.contextRequirement:  #why someone would specify both an inclusion and exclusion list is beyond me, but...
-            for item in self.contextRequirement:
-                if item in self.contextExclusion:
-                    raise RuntimeError("Error, " + item + " is included in both the requirement and exclusion lists.")
+        regions = None
+        if rawArgs.regions:
+            if not os.path.isfile(rawArgs.regions):
+                raise RuntimeError("Region file not found: " + rawArgs.regions)
+            regions = dradis.RegionIndex.load(rawArgs.regions)
+        self.locusFilter = dradis.LocusFilter(self.minCoverage, rawArgs.maxCoverage, self.contextRequirement, self.contextExclusion, rawArgs.minRatio, rawArgs.maxRatio, dradis.contigList(rawArgs.contigAllow), dradis.contigList(rawArgs.contigDeny), regions)  #also catches contradictory options
         self.sampleSize = rawArgs.sampleSize
 
 class HeaderLine(object):
@@ -102,32 +115,26 @@ class DataLine(object):
         else:
             self.ratioLine = (self.line[self.header.indexOf("chr")].replace("chr",""), self.line[self.header.indexOf("pos")], self.line[self.header.indexOf("ratio")])
             self.locusString = (self.line[self.header.indexOf("chr")].replace("chr",""), self.line[header.indexOf("pos")], self.line[header.indexOf("pos")]//1000000)
-    
-    def hasSufficientCoverage(self, minimum):
-        if self.line[self.header.indexOf("eff_ct_count")] >= minimum:
-            return True
-        else:
-            return False
-    
-    def hasCorrectContext(self, includedContext, excludedContext):
-        context = self.line[self.header.indexOf("context")]
-        if includedContext:
-            if not context in includedContext:
-                return False
-        if excludedContext:
-            if context in includedContext:
-                return False
-        return True
+            self.filterLine = (self.line[self.header.indexOf("chr")].replace("chr",""), self.line[self.header.indexOf("pos")], self.line[self.header.indexOf("ratio")], self.line[self.header.indexOf("eff_ct_count")], self.line[self.header.indexOf("context")])  #what the locus filters look at
     
     def locusString(self):
         return 
         
     def __str__(self):
         return self.rawLine
+
+def writeAccepted(outputFile, rawLines, parsedLines, badLines):  #runs a batch of parsed lines through the locus filters and writes out the raw lines that pass.  Returns how many did.
+    import numpy
+    import tylium
+    accepted = args.locusFilter.mask(tylium.chunkFromRows(parsedLines, len(parsedLines) + badLines))
+    for i in numpy.flatnonzero(accepted):
+        outputFile.write(rawLines[i] + "\n")
+    return int(numpy.count_nonzero(accepted))
         
 def processFile(fileName):
     import os
-    inputFile = open(fileName, 'r')
+    import tylium
+    inputFile = tylium.openRatioFile(fileName)  #plain or gzip/bgzip compressed
     outputFileName = args.tempdir + os.sep + "prefilter" + os.sep + fileName.split(os.sep)[-1] + ".prefilter"
     outputFile = open(outputFileName, 'w')
     if args.verbose:
@@ -141,8 +148,12 @@ def processFile(fileName):
     else:
         raise RuntimeError("File appears to have an empty header line.  Unable to identify columns.")
     outputFile.write(line + "\n")
+    recorder.readFile(fileName)
     progress = 1
     accepted = 0
+    rawLines = []  #the current batch, filtered together once it reaches batchRows
+    parsedLines = []
+    badLines = 0
     while line:
         if args.verbose and (progress % 10000 == 0 or progress == 1):
             print("Processed " + str(progress) + " raw lines.  Accepted " + str(accepted) + " lines.                    ", end = "\r")
@@ -155,24 +166,36 @@ def processFile(fileName):
             continue
         dataLine = DataLine(line, headerLine)
         if dataLine.isBadLine:
-            progress += 1
-            continue
-        if dataLine.hasSufficientCoverage(args.minCoverage) and dataLine.hasCorrectContext(args.contextRequirement, args.contextExclusion) :
-            outputFile.write(line + "\n")
-            accepted += 1
+            badLines += 1
+        else:
+            rawLines.append(line)
+            parsedLines.append(dataLine.filterLine)
+            if len(parsedLines) >= batchRows:
+                accepted += writeAccepted(outputFile, rawLines, parsedLines, badLines)
+                rawLines = []
+                parsedLines = []
+                badLines = 0
         progress += 1
+    accepted += writeAccepted(outputFile, rawLines, parsedLines, badLines)
+    args.locusFilter.reportTo(recorder)
     if args.verbose:
         print("Processed " + str(progress) + " raw lines.  Accepted " + str(accepted) + " lines.                    ")
         print("Closing working files.")
     inputFile.close()
     outputFile.close()
     os.rename(outputFileName, outputFileName + ".ratio")
+    recorder.count("rowsRead", progress - 1)
+    recorder.count("rowsAccepted", accepted)
+    recorder.wroteFile(outputFileName + ".ratio")
     
 def main():
     import pickle
     import datetime
+    import flightRecorder
     global args
     args = CheckArgs()
+    global recorder
+    recorder = flightRecorder.FlightRecorder("refinery", args.tempdir, args.profile)
     if args.verbose:
         start = datetime.datetime.now()
     if args.file:
@@ -180,6 +203,7 @@ def main():
     else:
         for fileName in args.fileList:
             processFile(fileName)
+    recorder.finish()
     if args.verbose:
         runtime = datetime.datetime.now() - start
         print("Context and coverage filter on large file complete in " + str(runtime))
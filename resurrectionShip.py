@@ -6,9 +6,6 @@ University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
 email: [myfirstname].[mylastname] AT ucla.edu
 '''
 
-global pythonInterpreterAbsolutePath
-pythonInterpreterAbsolutePath = "/u/local/apps/python/3.4.3/bin/python3"
-
 class CheckArgs():  #class that checks arguments and ultimately returns a validated set of arguments to the main program
     
     def __init__(self):
@@ -19,17 +16,66 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
         parser.add_argument("-o", "--outputFile", help = "Specify the output file name.", default = "output.txt")
         parser.add_argument("-k", "--pickleOut", help = "Output to a Pandas pickle instead of a delimited text file.", action = 'store_true')
+        parser.add_argument("-x", "--resultMatrix", help = "Build the table from this shared result matrix (base name, without extension) instead of gathering filter 2 pickles")
+        parser.add_argument("-m", "--emptyCellMarker", help = "Marker for blank cells in text output.", default = "")
+        parser.add_argument("--executor", help = "Where to run scatter jobs: sge or local", default = "sge", choices = ["sge", "local"])
+        parser.add_argument("--localWorkers", help = "Maximum number of processes for the local executor", default = 0, type = int)
+        parser.add_argument("--pythonInterpreter", help = "Python interpreter used to launch scatter jobs")
+        parser.add_argument("-p", "--maxParallelJobs", help = "Maximum number of parallel workers when work stealing", default = 301, type = int)
+        parser.add_argument("--fanIn", help = "How many partials each merge job combines when reducing scatter results in rounds", default = 8, type = int)
+        parser.add_argument("--workStealing", help = "Put scatter jobs in a task queue that workers pull from until it is empty", action = 'store_true')
+        parser.add_argument("--stream", help = "Write the text table in blocks of rows, formatted in parallel, instead of building the whole table in memory", action = 'store_true')
+        parser.add_argument("--sparse", help = "Gather the sparse filter 2 results into one CSR file (scipy.sparse.load_npz can read it) instead of a table", action = 'store_true')
+        parser.add_argument("--outputStore", help = "Write a chunked output store directory (per-contig blocks, locus index and sample list) at the output path instead of a table", action = 'store_true')
+        parser.add_argument("--columnNames", help = "JSON file with the sample column order and the header names to print for them")
+        parser.add_argument("--blockRows", help = "Rows per block when streaming the table", default = 100000, type = int)
+        parser.add_argument("--formatWorkers", help = "Processes formatting blocks when streaming (default: one per core)", default = 0, type = int)
+        parser.add_argument("--quantizedRatios", help = "The ratios were kept as 16-bit integers, so round them in text output to the precision they were kept at", action = 'store_true')
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 self.tempdir = rawArgs.tempdir
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
         else:
             raise RuntimeError("No temporary directory specified.  This is not designed to run without one.")
         self.verbose = rawArgs.verbose
+        self.executor = rawArgs.executor
+        self.localWorkers = rawArgs.localWorkers
+        self.pythonInterpreter = rawArgs.pythonInterpreter
+        self.maxParallelJobs = rawArgs.maxParallelJobs
+        self.workStealing = rawArgs.workStealing
+        if rawArgs.fanIn < 2:
+            raise RuntimeError("Fan in must be at least 2.  We got: " + str(rawArgs.fanIn))
+        self.fanIn = rawArgs.fanIn
         self.outputFile = rawArgs.outputFile  #this should already be sanitized from battlestar
         self.pickleOut = rawArgs.pickleOut
+        if rawArgs.resultMatrix:
+            if not os.path.isfile(rawArgs.resultMatrix + ".json"):
+                raise RuntimeError("Result matrix not found: " + rawArgs.resultMatrix)
+            self.resultMatrix = rawArgs.resultMatrix
+        else:
+            self.resultMatrix = False
+        self.emptyCellMarker = rawArgs.emptyCellMarker
+        if rawArgs.stream and rawArgs.pickleOut:
+            raise RuntimeError("Streaming output only applies to text tables, not pickles.")
+        self.stream = rawArgs.stream
+        if rawArgs.outputStore and (rawArgs.pickleOut or rawArgs.stream):
+            raise RuntimeError("An output store replaces the table, so it cannot be combined with pickle or streaming output.")
+        self.outputStore = rawArgs.outputStore
+        if rawArgs.sparse and (rawArgs.pickleOut or rawArgs.stream or rawArgs.outputStore or rawArgs.resultMatrix):
+            raise RuntimeError("Sparse output is its own output format and builds from sparse filter 2 results only.")
+        self.sparse = rawArgs.sparse
+        if rawArgs.columnNames and not os.path.isfile(rawArgs.columnNames):
+            raise RuntimeError("Column name file not found: " + rawArgs.columnNames)
+        self.columnNames = rawArgs.columnNames
+        if rawArgs.blockRows < 1:
+            raise RuntimeError("Block size must be at least one row.  We got: " + str(rawArgs.blockRows))
+        self.blockRows = rawArgs.blockRows
+        self.formatWorkers = rawArgs.formatWorkers
+        self.quantizedRatios = rawArgs.quantizedRatios
 
 def getListOfFiles():
     import os
@@ -51,72 +97,24 @@ def makeScatterCombiningList(fileList):
     return scatterFileList
 
 def runScatterJobs(scatterFileList):
-    import os
-    if not os.path.isdir("schedulerOutput"):
-        os.mkdir("schedulerOutput")
-    wrapperRunnerName = args.tempdir + os.sep + "bashFiles" + os.sep + "wrapper.sh"
-    wrapperRunner = open(wrapperRunnerName, 'w')
-    wrapperRunner.write("#!/bin/bash\n")
-    wrapperRunner.write(pythonInterpreterAbsolutePath + " raptor.py " + "--tempdir " + args.tempdir + " --clockOutDir " + args.tempdir + os.sep + "finalPartsClockOut")
-    wrapperRunner.close()
-    clockOutFlush(args.tempdir + os.sep + "finalPartsClockOut")
+    import fleetCommand
+    executor = fleetCommand.makeExecutor(args.executor, args.tempdir, args.pythonInterpreter, args.verbose, args.localWorkers, args.profile)
+    argumentStrings = []
     for i in range(0,len(scatterFileList)):
         arguments = {"--fileList" : ",".join(scatterFileList[i]),
                      "--tempdir" : args.tempdir}
-        argumentList = []
-        for key in list(arguments.keys()):
-            if arguments[key]:
-                argumentList.append(key + " " + arguments[key])
-        argumentString = " ".join(argumentList)
-        if i == 0:
-            if args.verbose:
-                argumentString += " -v"
-            thisNodesJob = pythonInterpreterAbsolutePath + " baseStar.py " + argumentString
-        else:
-            bashFileName = args.tempdir + os.sep + "bashFiles" + os.sep + str(i) + ".sh"
-            bashFile = open(bashFileName, 'w')
-            bashFile.write("#!/bin/bash\n")
-            bashFile.write(pythonInterpreterAbsolutePath + " baseStar.py " + argumentString)
-            bashFile.close()
-    jobRange = "1-" + str(len(scatterFileList) - 1) + " "
-    command = "qsub -cwd -V -N Toasters -l h_data=4G,time=23:59:00 -e " + os.getcwd() +  "/schedulerOutput/ -o " + os.getcwd() + "/schedulerOutput/ " + "-t " + jobRange + wrapperRunnerName
-    if args.verbose:
-        print("BASH " + command)
-    os.system(command)
-    if args.verbose:
-        print("Starting the job on this node.")
-        print("BASH " + thisNodesJob)
-    os.system(thisNodesJob)
-    if args.verbose:
-        print("Monitoring other nodes counting jobs.")
-    monitorJobs(args.tempdir + os.sep + "finalPartsClockOut", len(scatterFileList))
+        argumentStrings.append(fleetCommand.makeArgumentString(arguments))
+    if args.workStealing:
+        executor.runQueue("BaseStars", "baseStar.py", argumentStrings, "finalPartsClockOut", args.maxParallelJobs, memoryGB = 4)
+    else:
+        executor.runJobs("BaseStars", "baseStar.py", argumentStrings, "finalPartsClockOut", memoryGB = 4)
     
-def monitorJobs(clockOutDirectory, jobCount):
+def reduceGatheredFiles(fileList):  #merges the scatter partials in parallel rounds so that only a few are left for this node
     import os
-    import time
-    if args.verbose:
-        print("Monitoring jobs on other nodes.")
-    done = False
-    completed = 1
-    jobList = []
-    for i in range(1,jobCount):
-        jobList.append([i,False])
-    while not done:
-        if args.verbose:
-            print("Completed " + str(completed) + " of " + str(jobCount) + " jobs.       ", end = "\r")
-        for i in range(0,len(jobList)):
-            if not jobList[i][1]:
-                if os.path.isfile(clockOutDirectory + os.sep + str(jobList[i][0])):
-                    jobList[i][1] = True
-                    completed += 1
-                    if completed == len(jobList) + 1:
-                        done = True
-                        print()
-                        break
-        time.sleep(1)
-    if args.verbose:
-        print("Completed " + str(completed) + " of " + str(jobCount) + " jobs.       ", end = "\r")
-        
+    import fleetCommand
+    executor = fleetCommand.makeExecutor(args.executor, args.tempdir, args.pythonInterpreter, args.verbose, args.localWorkers, args.profile)
+    return fleetCommand.treeReduce(executor, "BaseStarMerge", "baseStar.py", fileList, args.tempdir + os.sep + "finalParts", ".scatter.pkl", "finalPartsClockOut", args.fanIn, memoryGB = 4, extraArguments = {"--tempdir" : args.tempdir})
+
 def gatherFiles():
     import os
     if args.verbose:
@@ -140,8 +138,10 @@ def combineGatheredData(fileList):  #assumes that locusList will come in as a gl
         if not os.path.isfile(fileName):
             raise RuntimeError("Expected to find a data file, but it was not found. " + fileName)
         file = open(fileName, 'rb')
-        data = pickle.load(file)
+        with recorder.timing("pickleLoad"):
+            data = pickle.load(file)
         file.close()
+        recorder.readFile(fileName)
         for key in list(data.keys()):
             try:
                 throwAway = fullDataSet[key]
@@ -154,59 +154,222 @@ def combineGatheredData(fileList):  #assumes that locusList will come in as a gl
     if args.verbose:
         print("All files processed.                                                        ")
     
-def clockOutFlush(clockOutDir):
-    import os
-    import shutil
-    shutil.rmtree(clockOutDir)
-    os.mkdir(clockOutDir)
-    
 def addDataFromFile(file):
     import os
     import pickle
     if not os.path.isfile(file):
         raise RuntimeError("Tried to open data file, but it does not exist. " + file)
     inputFile = open(file,'rb')
-    data = pickle.load(inputFile)
+    with recorder.timing("pickleLoad"):
+        data = pickle.load(inputFile)
     inputFile.close()
+    recorder.readFile(file)
     for key in list(data.keys()):
         fullDataSet[key] = data[key]
 
-def getAcceptedCoordiateList():
+def getColumnNames(sampleNames):  #(samples in column order, header for each) from battleStar's list if we have it, otherwise the matrix order as is
+    import json
+    if not args.columnNames:
+        return (sampleNames, sampleNames)
+    columnNameFile = open(args.columnNames, 'r')
+    columnNames = json.load(columnNameFile)
+    columnNameFile.close()
+    for name in columnNames["samples"]:
+        if not name in sampleNames:
+            raise RuntimeError("Sample " + name + " is in the column list but has no data.")
+    return (columnNames["samples"], columnNames["headers"])
+
+def matrixFromPickles(fileList, acceptedIndex):  #puts the filter 2 pickles into an on-disk matrix one file at a time, so that streaming never holds more than one pickle.  Each pickle is read once, and its columns go on the end of the matrix file as they come.
     import os
     import pickle
-    coordinateListFileName = args.tempdir + os.sep + 'loci' + os.sep + 'acceptedCoordinateList.pkl'
-    coordinateListFile = open(coordinateListFileName,'rb')
-    coordinateList = pickle.load(coordinateListFile)
-    coordinateListFile.close()
-    return coordinateList
+    import numpy
+    import colonialOne
+    baseName = args.tempdir + os.sep + "finalParts" + os.sep + "streamMatrix"
+    resultMatrix = colonialOne.ResultMatrix.create(baseName, len(acceptedIndex), [])
+    names = []
+    for fileName in fileList:
+        file = open(fileName, 'rb')
+        with recorder.timing("pickleLoad"):
+            data = pickle.load(file)
+        file.close()
+        recorder.readFile(fileName)
+        for key in list(data.keys()):
+            if key in names:
+                raise RuntimeError("Sample name collision.  Two samples being entered with name " + key)
+            names.append(key)
+            resultMatrix = colonialOne.ResultMatrix(baseName, len(acceptedIndex), names, mode = 'r+')
+            matrixFile = open(resultMatrix.matrixFileName, 'r+b')
+            matrixFile.truncate(resultMatrix.columnStride * resultMatrix.dataType.itemsize * len(names))
+            matrixFile.close()
+            resultMatrix.writeColumn(key, numpy.asarray(data[key], dtype = numpy.float32))
+        del data
+    sampleNames = sorted(names)  #same column order as before, whatever order the pickles came in
+    resultMatrix = colonialOne.ResultMatrix(baseName, len(acceptedIndex), sampleNames, columns = [names.index(name) for name in sampleNames])
+    resultMatrix.saveHeader()
+    return resultMatrix
+
+def quantizedText(dataType = "float32"):  #whether the ratios went through quantization and should be rounded when printed
+    import colonialOne
+    return args.quantizedRatios or colonialOne.ratioEncodingOf(dataType) == "uint16"
+
+def startFormatter(matrixBaseName, indexBaseName, columnNumbers, headers, emptyCellMarker, roundRatios):  #runs once in each formatting process
+    import colonialOne
+    global formatter
+    formatter = {"matrix" : colonialOne.ResultMatrix.open(matrixBaseName),
+                 "index" : colonialOne.AcceptedIndex.load(indexBaseName),
+                 "columnNumbers" : columnNumbers,
+                 "headers" : headers,
+                 "emptyCellMarker" : emptyCellMarker,
+                 "roundRatios" : roundRatios}
+
+def formatBlock(block):  #turns rows start to end into text, with the header line on the first block
+    import io
+    import pandas
+    import colonialOne
+    start, end = block
+    values = formatter["matrix"].values(start, end)[:, formatter["columnNumbers"]]  #dequantized here if the matrix holds uint16, so the text always shows ratios
+    if formatter["roundRatios"]:
+        values = colonialOne.roundRatios(values)
+    table = pandas.DataFrame(values, index = formatter["index"].rowLabels(start, end), columns = formatter["headers"])
+    text = io.StringIO()
+    table.to_csv(text, sep = "\t", na_rep = formatter["emptyCellMarker"], header = start == 0)
+    return text.getvalue()
+
+def writeStreamingTable(resultMatrix, acceptedIndexBaseName):  #writes the table in row blocks, formatted in parallel and written in order.  Memory stays at a few blocks no matter how many loci or samples there are.
+    import multiprocessing
+    import os
+    samples, headers = getColumnNames(resultMatrix.sampleNames)
+    columnNumbers = [resultMatrix.columnNumber(name) for name in samples]
+    blocks = [(start, min(start + args.blockRows, resultMatrix.rows)) for start in range(0, resultMatrix.rows, args.blockRows)]
+    if not blocks:
+        blocks = [(0, 0)]  #still want a header line
+    workers = args.formatWorkers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(blocks)))
+    initializerArguments = (resultMatrix.baseName, acceptedIndexBaseName, columnNumbers, headers, args.emptyCellMarker, quantizedText(resultMatrix.dataType))
+    outputFile = open(args.outputFile + ".tmp", 'w')
+    progress = 0
+    if workers == 1:
+        startFormatter(*initializerArguments)
+        formattedBlocks = map(formatBlock, blocks)
+        pool = False
+    else:
+        pool = multiprocessing.Pool(workers, initializer = startFormatter, initargs = initializerArguments)
+        formattedBlocks = pool.imap(formatBlock, blocks)  #comes back in order, so blocks can be written as they arrive
+    try:
+        for text in formattedBlocks:
+            outputFile.write(text)
+            progress += 1
+            if args.verbose:
+                print("Wrote " + str(progress) + " of " + str(len(blocks)) + " row blocks.       ", end = "\r")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    outputFile.close()
+    os.rename(args.outputFile + ".tmp", args.outputFile)
+    if args.verbose:
+        print("Wrote " + str(len(blocks)) + " row blocks.                  ")
+
+def buildSparseResult():  #reads each sample's observed entries and writes them as one CSR matrix.  Memory follows the number of observed values, not loci times samples.
+    import os
+    import colonialOne
+    sampleFileDirectory = args.tempdir + os.sep + "filter2" + os.sep
+    sampleFiles = {}
+    for file in os.listdir(sampleFileDirectory):
+        if file.endswith(colonialOne.sparseSuffix):
+            name = colonialOne.sampleName(file)
+            if name in sampleFiles:
+                raise RuntimeError("Sample name collision.  Two samples being entered with name " + name)
+            sampleFiles[name] = sampleFileDirectory + file
+    samples, headers = getColumnNames(sorted(sampleFiles.keys()))
+    acceptedIndex = colonialOne.AcceptedIndex.load(args.tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')
+    sparseColumns = []
+    for name in samples:
+        sparseColumns.append(colonialOne.readSparseColumn(sampleFiles[name]))
+    if args.verbose:
+        observed = sum([len(rows) for rows, values in sparseColumns])
+        print("Writing " + str(observed) + " observed values for " + str(len(samples)) + " samples and " + str(len(acceptedIndex)) + " loci (" + str(round(100 * observed / max(len(samples) * len(acceptedIndex), 1), 1)) + "% filled).")
+    colonialOne.writeSparseResult(args.outputFile, headers, sparseColumns, acceptedIndex)
+
+def getAcceptedCoordiateList():
+    import os
+    import colonialOne
+    acceptedIndex = colonialOne.AcceptedIndex.load(args.tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex')
+    return acceptedIndex.labels()
 
 def main():
     import pickle
     import datetime
     import os
     import pandas
+    import colonialOne
+    import flightRecorder
     start = datetime.datetime.now()
     global args
     args = CheckArgs()
+    global recorder
+    recorder = flightRecorder.FlightRecorder("resurrectionShip", args.tempdir, args.profile)
     global fullDataSet
     fullDataSet = {}
-    fileList = getListOfFiles()
-    acceptedcoordinateList = getAcceptedCoordiateList()
-    if len(fileList) < 20:
-        progress = 0
-        for file in fileList:
+    if args.sparse:
+        buildSparseResult()
+        recorder.wroteFile(args.outputFile)
+        recorder.finish()
+        if args.verbose:
+            print("Full dataset build completed in " + str(datetime.datetime.now() - start))
+        return
+    if args.stream or args.outputStore or (args.resultMatrix and not args.pickleOut):  #no data frame at all, just blocks of rows straight from a matrix on disk.  A shared result matrix is already on disk, so its text table is always written this way.
+        startWrite = datetime.datetime.now()
+        acceptedIndexBaseName = args.tempdir + os.sep + 'loci' + os.sep + 'acceptedIndex'
+        acceptedIndex = colonialOne.AcceptedIndex.load(acceptedIndexBaseName)
+        if args.resultMatrix:
+            resultMatrix = colonialOne.ResultMatrix.open(args.resultMatrix)
+            if resultMatrix.rows != len(acceptedIndex):
+                raise RuntimeError("Result matrix has " + str(resultMatrix.rows) + " rows, but there are " + str(len(acceptedIndex)) + " accepted loci.")
+        else:
             if args.verbose:
-                print("Processed " + str(progress) + " of " + str(len(fileList)) + " files.     ", end = "\r")
-                progress += 1
-            addLociFromFile(file)
+                print("Collecting filter 2 results into an on-disk matrix.")
+            resultMatrix = matrixFromPickles(getListOfFiles(), acceptedIndex)
+        if args.outputStore:
+            import kobol
+            samples, headers = getColumnNames(resultMatrix.sampleNames)
+            kobol.writeStore(args.outputFile, resultMatrix, acceptedIndex, samples, headers, args.blockRows, args.verbose)
+        else:
+            writeStreamingTable(resultMatrix, acceptedIndexBaseName)
+            recorder.wroteFile(args.outputFile)
+        recorder.count("rowsRead", len(acceptedIndex))
+        recorder.count("rowsAccepted", len(acceptedIndex))
+        recorder.finish()
+        if args.verbose:
+            print("Output written in " + str(datetime.datetime.now() - startWrite) + ".")
+            print("Full dataset build completed in " + str(datetime.datetime.now() - start))
+        return
+    acceptedcoordinateList = getAcceptedCoordiateList()
+    if args.resultMatrix:  #the filter 2 jobs already wrote their columns into one matrix, so there is nothing to gather.  Only a pandas pickle gets here, and that has to be one whole frame.
+        resultMatrix = colonialOne.ResultMatrix.open(args.resultMatrix)
+        if resultMatrix.rows != len(acceptedcoordinateList):
+            raise RuntimeError("Result matrix has " + str(resultMatrix.rows) + " rows, but there are " + str(len(acceptedcoordinateList)) + " accepted loci.")
+        fullDataSet = pandas.DataFrame(resultMatrix.values(), index = acceptedcoordinateList, columns = resultMatrix.sampleNames)
     else:
-        scatterCombiningList = makeScatterCombiningList(fileList)
-        runScatterJobs(scatterCombiningList)
-        jobFileList = gatherFiles()
-        combineGatheredData(jobFileList)
-    if args.verbose:
-        print("Collected all data.  Forming table.")
-    fullDataSet = pandas.DataFrame(fullDataSet, index = acceptedcoordinateList)
+        fileList = getListOfFiles()
+        if len(fileList) < 20:
+            progress = 0
+            for file in fileList:
+                if args.verbose:
+                    print("Processed " + str(progress) + " of " + str(len(fileList)) + " files.     ", end = "\r")
+                    progress += 1
+                addDataFromFile(file)
+        else:
+            scatterCombiningList = makeScatterCombiningList(fileList)
+            runScatterJobs(scatterCombiningList)
+            jobFileList = reduceGatheredFiles(gatherFiles())
+            combineGatheredData(jobFileList)
+        if args.verbose:
+            print("Collected all data.  Forming table.")
+        fullDataSet = pandas.DataFrame(fullDataSet, index = acceptedcoordinateList)
+    samples, headers = getColumnNames(list(fullDataSet.columns))  #same order and header names as the streamed, stored and sparse outputs
+    fullDataSet = fullDataSet[samples]
+    fullDataSet.columns = headers
     if args.verbose:
         print("Sample data:")
         print(fullDataSet)
@@ -217,9 +380,17 @@ def main():
             print("Saving table of all data. This may take several minutes.")
     startWrite = datetime.datetime.now()
     if args.pickleOut:
-        fullDataSet.to_pickle(args.outputFile)
+        with recorder.timing("pickleDump"):
+            fullDataSet.to_pickle(args.outputFile)
     else:
-        fullDataSet.to_csv(args.outputFile, sep = "\t")
+        if quantizedText():
+            fullDataSet = fullDataSet.round(colonialOne.quantizedDecimals)
+        with recorder.timing("tableWrite"):
+            fullDataSet.to_csv(args.outputFile, sep = "\t", na_rep = args.emptyCellMarker)
+    recorder.count("rowsRead", len(fullDataSet))
+    recorder.count("rowsAccepted", len(fullDataSet))
+    recorder.wroteFile(args.outputFile)
+    recorder.finish()
     if args.verbose:
         writeTime = datetime.datetime.now() - startWrite
         print("Table saved in " + str(writeTime) + ".")
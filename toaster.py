@@ -15,9 +15,13 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-l", "--fileList", help = "Pass a pickle containing a list of files to operate on.")
         parser.add_argument("-t", "--tempdir", help = "Holds the name of the temporary directory we are using.")
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
+        parser.add_argument("-m", "--merge", help = "The file list holds count partials from other toasters to be merged, not sample files", action = 'store_true')
+        parser.add_argument("-o", "--output", help = "Write the counts here instead of the default name in lociGather")
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 self.tempdir = rawArgs.tempdir
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
@@ -32,82 +36,68 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             self.fileList = fileList
         else:
             raise RuntimeError("This program needs a file list to run.  None was given.")
+        self.merge = rawArgs.merge
+        self.output = rawArgs.output
         
-def addLociFromFile(file):  #locusList should come in as a global variable.  Doing this to try and be kind to memory.
-    import pickle
-    dataFile = open(file, 'rb')
-    inputList = pickle.load(dataFile)
-    dataFile.close()
-    for line in inputList:
-        contig, position, group = line  #assuming it comes in with this form, which it should.  The group should just be the megabase number of the locus and should have been calculated by the parallel processes
-        try:
-            locusList[contig][group][position] += 1
-        except KeyError:
-            try:
-                locusList[contig][group][position] = 1
-            except KeyError:
-                try:
-                    locusList[contig][group] = {}
-                    locusList[contig][group][position] = 1
-                except KeyError:
-                    locusList[contig] = {}
-                    locusList[contig][group] = {}
-                    locusList[contig][group][position] = 1
+def addLociFromFile(file):  #locusCounts should come in as a global variable.  Doing this to try and be kind to memory.
+    import colonialOne
+    sample = colonialOne.SampleData(file)
+    recorder.readFile(file)
+    recorder.count("rowsRead", len(sample))
+    locusCounts.addSample(sample)
 
-def filteredLocusTree(minimumObservationCount):  #again, assuming locus list comes in as a global variable
-    filteredLocusList = {}
-    for contig in list(locusList.keys()):
-        for group in list(locusList[contig].keys()):
-            for position in list(locusList[contig][group].keys()):
-                if locusList[contig][group][position] >= minimumObservationCount:
-                    try:
-                        filteredLocusList[contig][group][position] = True
-                    except KeyError:
-                        try:
-                            filteredLocusList[contig][group] = {}
-                            filteredLocusList[contig][group][position] = True
-                        except KeyError:
-                            filteredLocusList[contig] = {}
-                            filteredLocusList[contig][group] = {}
-                            filteredLocusList[contig][group][position] = True
-    return filteredLocusList
+def addCountsFromFile(file):  #same idea, but for a partial that another toaster already counted
+    import colonialOne
+    partial = colonialOne.LocusCounts.load(file)
+    recorder.readFile(file)
+    recorder.count("rowsRead", len(partial))
+    locusCounts.addCounts(partial)
 
 def getListOfFiles():
     import os
-    locusFileDirectory = args.tempdir + os.sep + "loci" + os.sep
+    import colonialOne
+    locusFileDirectory = args.tempdir + os.sep + "filter1" + os.sep
     rawLocusFiles = os.listdir(locusFileDirectory)
     locusFiles = []
     for file in rawLocusFiles:
-        if file.endswith(".loci.pkl"):
+        if file.endswith(colonialOne.sampleSuffix):
             locusFiles.append(locusFileDirectory + file)
     return locusFiles
 
 def main():
-    import pickle
     import datetime
     import os
+    import colonialOne
+    import flightRecorder
     start = datetime.datetime.now()
     global args
     args = CheckArgs()
-    global locusList
-    locusList = {}
+    global recorder
+    recorder = flightRecorder.FlightRecorder("toaster", args.tempdir, args.profile)
+    global locusCounts
+    locusCounts = colonialOne.LocusCounts()
     progress = 0
     for file in args.fileList:
         if args.verbose:
             print("Processed " + str(progress) + " of " + str(len(args.fileList)) + " files.     ", end = "\r")
             progress += 1
-        addLociFromFile(file)
+        if args.merge:
+            addCountsFromFile(file)
+        else:
+            addLociFromFile(file)
     if args.verbose:
         print("Processed all individual sample files.                                   ")
-    gatheredLociFileName = args.tempdir + os.sep + "lociGather" + os.sep + args.fileList[0].split(os.sep)[-1] + ".andFriends.scatter.pkl"
-    gatheredLociFile = open(gatheredLociFileName, 'wb')
-    pickle.dump(locusList, gatheredLociFile)
-    gatheredLociFile.close()
+    if args.output:
+        gatheredLociFileName = args.output
+    else:
+        gatheredLociFileName = args.tempdir + os.sep + "lociGather" + os.sep + args.fileList[0].split(os.sep)[-1] + ".andFriends.counts.npz"
+    locusCounts.save(gatheredLociFileName + ".tmp")
+    os.rename(gatheredLociFileName + ".tmp", gatheredLociFileName)
+    recorder.count("rowsAccepted", len(locusCounts))
+    recorder.wroteFile(gatheredLociFileName)
+    recorder.finish()
     if args.verbose:
         runtime = datetime.datetime.now() - start
         print("Per-sample locus representation count(s) completed in " + str(runtime))
         
-main()
-    
-    
-        
\ No newline at end of file
+main()
\ No newline at end of file
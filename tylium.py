@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+'''
+BattleStar written by Michael Weinstein, 2016
+University of California, Los Angeles, Daniel Cohn laboratory and Collaboratory
+email: [myfirstname].[mylastname] AT ucla.edu
+'''
+
+#Tylium is the raw fuel for the fleet.  This module reads .ratio files in large blocks of rows and hands them back as typed numpy columns so that the filters can work on whole arrays at once instead of building a DataLine object for every row.
+
+import io  #GzipStream is built on its base class
+
+requiredColumns = ["chr", "pos", "context", "ratio", "eff_ct_count", "c_count", "ct_count", "rev_g_count", "rev_ga_count"]  #a line missing any of these is a bad line, just like in DataLine
+integerColumns = ["pos", "eff_ct_count", "c_count", "ct_count", "rev_g_count", "rev_ga_count"]  #these must parse as whole numbers (trailing zeros after a decimal are fine)
+ratioSuffixes = (".ratio", ".ratio.gz")  #gzip or bgzip compressed files are read as they are, no decompressing to scratch first
+gzipMagic = b"\x1f\x8b"
+compressedBlockBytes = 1048576  #compressed bytes read (and decompressed) at a time
+queuedBlocks = 16  #how far the decompression thread may run ahead of the parser
+
+def isRatioFile(fileName):
+    return fileName.endswith(ratioSuffixes)
+
+def isGzipped(fileName):  #goes by the first two bytes, not the name
+    file = open(fileName, 'rb')
+    magic = file.read(2)
+    file.close()
+    return magic == gzipMagic
+
+def inflate(compressedBlocks):  #generator of decompressed data from an iterable of compressed blocks.  Handles any number of gzip members back to back, which is all a bgzip file is.
+    import zlib
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    memberStarted = False
+    for compressed in compressedBlocks:
+        while compressed:
+            memberStarted = True
+            data = decompressor.decompress(compressed)
+            if data:
+                yield data
+            if decompressor.eof:  #end of one member.  Anything left over belongs to the next one.
+                compressed = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                memberStarted = False
+            else:
+                compressed = b""
+    if memberStarted:
+        raise RuntimeError("Compressed file ended in the middle of a gzip member.  It may be truncated.")
+
+def compressedBlocks(fileName, blockBytes = compressedBlockBytes):
+    file = open(fileName, 'rb')
+    try:
+        block = file.read(blockBytes)
+        while block:
+            yield block
+            block = file.read(blockBytes)
+    finally:
+        file.close()
+
+def estimatedRatioBytes(fileName, sampleBytes = compressedBlockBytes):  #uncompressed size of a ratio file, for scheduling and memory estimates.  Compressed files are scaled up by how much their first block expands.
+    import os
+    fileBytes = os.path.getsize(fileName)
+    if not isGzipped(fileName):
+        return fileBytes
+    file = open(fileName, 'rb')
+    sample = file.read(sampleBytes)
+    file.close()
+    inflated = 0
+    try:
+        for data in inflate([sample]):
+            inflated += len(data)
+    except RuntimeError:  #the sample stops partway through a member, which is expected
+        pass
+    if not sample:
+        return 0
+    return int(fileBytes * (inflated / len(sample)))
+
+class GzipStream(io.RawIOBase):  #read only binary stream over a gzip or bgzip file.  A background thread does the decompressing (zlib lets go of the GIL while it works), so it overlaps with parsing.
+
+    def __init__(self, fileName, blockBytes = compressedBlockBytes, queueLength = queuedBlocks):
+        import queue
+        import threading
+        io.RawIOBase.__init__(self)
+        self.fileName = fileName
+        self.blocks = queue.Queue(queueLength)
+        self.buffer = b""
+        self.position = 0
+        self.finished = False
+        self.stopping = False
+        self.thread = threading.Thread(target = self.decompress, args = (blockBytes,), daemon = True)
+        self.thread.start()
+
+    def decompress(self, blockBytes):
+        try:
+            for data in inflate(compressedBlocks(self.fileName, blockBytes)):
+                if not self.put(data):
+                    return
+            self.put(None)  #end of the data
+        except Exception as error:  #handed to the reader to raise, since nobody is watching this thread
+            self.put(error)
+
+    def put(self, item):  #False if the reader went away
+        import queue
+        while not self.stopping:
+            try:
+                self.blocks.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position >= len(self.buffer):
+            if self.finished:
+                return 0
+            item = self.blocks.get()
+            if item is None:
+                self.finished = True
+                return 0
+            if isinstance(item, Exception):
+                self.finished = True
+                raise RuntimeError("Unable to decompress " + self.fileName + ": " + str(item))
+            self.buffer = item
+            self.position = 0
+        size = min(len(buffer), len(self.buffer) - self.position)
+        buffer[:size] = self.buffer[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def close(self):
+        self.stopping = True
+        io.RawIOBase.close(self)
+
+def openRatioFile(fileName, binary = False):  #opens a plain or compressed ratio file for reading, as text unless binary is set
+    if not isGzipped(fileName):
+        if binary:
+            return open(fileName, 'rb')
+        return open(fileName, 'r')
+    stream = io.BufferedReader(GzipStream(fileName), compressedBlockBytes)
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream)
+
+def readHeader(fileName, delimiter = "\t"):  #returns a dictionary of lowercased column name to column index, the same way HeaderLine does it
+    file = openRatioFile(fileName)
+    line = file.readline()
+    file.close()
+    line = line.strip()
+    if not line:
+        raise RuntimeError("File appears to have an empty header line.  Unable to identify columns.  " + fileName)
+    line = line.split(delimiter)
+    colNames = {}
+    for i in range(0, len(line)):
+        colNames[line[i].lower()] = i
+    for column in requiredColumns:
+        if not column in colNames:
+            raise RuntimeError("Required column " + column + " was not found in the header of " + fileName)
+    return colNames
+
+class RatioChunk(object):  #one block of parsed rows, with bad lines already removed
+
+    def __init__(self, contig, position, ratio, coverage, context, rawRows):
+        self.contig = contig  #object array of contig names with "chr" removed
+        self.position = position  #int64 array
+        self.ratio = ratio  #float64 array, clamped to [0,1]
+        self.coverage = coverage  #int64 array of eff_ct_count
+        self.context = context  #object array of context strings
+        self.rawRows = rawRows  #how many rows were read to make this chunk (including bad lines)
+        self.badLines = rawRows - len(position)
+
+    def __len__(self):
+        return len(self.position)
+
+    def subset(self, mask):  #returns a new chunk with only the rows where mask is True
+        return RatioChunk(self.contig[mask], self.position[mask], self.ratio[mask], self.coverage[mask], self.context[mask], int(mask.sum()))
+
+def chunkFromRows(rows, rawRows):  #(contig, position, ratio, coverage, context) tuples from a line by line parser to a RatioChunk, so those parsers filter with the same vectorized predicates
+    import numpy
+    if rows:
+        contig, position, ratio, coverage, context = zip(*rows)
+    else:
+        contig, position, ratio, coverage, context = [], [], [], [], []
+    return RatioChunk(numpy.array(contig, dtype = object), numpy.array(position, dtype = numpy.int64), numpy.clip(numpy.array(ratio, dtype = numpy.float64), 0.0, 1.0), numpy.array(coverage, dtype = numpy.int64), numpy.array(context, dtype = object), rawRows)
+
+def parseFrame(frame, colNames):  #turns a raw data frame from the csv reader into a RatioChunk
+    import numpy
+    import pandas
+    rawRows = len(frame)
+    valid = numpy.ones(rawRows, dtype = bool)
+    numericColumns = {}
+    for column in requiredColumns:
+        if column in ["chr", "context"]:
+            continue
+        values = pandas.to_numeric(frame[colNames[column]], errors = "coerce").to_numpy(dtype = numpy.float64)  #anything that will not parse becomes NaN and the line gets marked bad
+        if column in integerColumns:
+            valid &= numpy.isfinite(values) & (values == numpy.floor(values))
+        else:
+            valid &= ~numpy.isnan(values)
+        numericColumns[column] = values
+    contig = frame[colNames["chr"]].to_numpy(dtype = object)
+    context = frame[colNames["context"]].to_numpy(dtype = object)
+    valid &= pandas.notna(contig) & pandas.notna(context)  #a short line will leave these empty
+    codes, names = pandas.factorize(contig[valid])  #a file has only a handful of contig names, so strip each one once instead of once per row
+    contig = numpy.array([name.replace("chr", "") for name in names], dtype = object)[codes]
+    position = numericColumns["pos"][valid].astype(numpy.int64)
+    ratio = numpy.clip(numericColumns["ratio"][valid], 0.0, 1.0)
+    coverage = numericColumns["eff_ct_count"][valid].astype(numpy.int64)
+    return RatioChunk(contig, position, ratio, coverage, context[valid], rawRows)
+
+def readRatioChunks(fileName, chunkRows = 1000000, delimiter = "\t"):  #generator that yields RatioChunk objects of up to chunkRows rows each
+    import pandas
+    colNames = readHeader(fileName, delimiter)
+    useColumns = sorted([colNames[column] for column in requiredColumns])
+    stringTypes = {colNames["chr"] : str, colNames["context"] : str}
+    file = openRatioFile(fileName, binary = True)
+    try:
+        try:
+            reader = pandas.read_csv(file, sep = delimiter, header = None, skiprows = 1, usecols = useColumns, dtype = stringTypes, chunksize = chunkRows, skip_blank_lines = True, keep_default_na = False, na_values = [""], on_bad_lines = "skip", engine = "c")
+        except pandas.errors.EmptyDataError:  #nothing past the header line, which is a sample with no calls rather than a broken file
+            return
+        for frame in reader:
+            yield parseFrame(frame, colNames)
+    finally:
+        file.close()
+
+bytesPerParsedRow = 400  #rough peak cost of one row while a chunk is being parsed (string columns, numeric copies and masks)
+
+def chunkRowsForMemory(memoryCeilingBytes, workingFraction = 0.5):  #picks a chunk size so that parsing stays within the given share of a memory ceiling
+    rows = int((memoryCeilingBytes * workingFraction) // bytesPerParsedRow)
+    if rows < 1000:
+        rows = 1000
+    return rows
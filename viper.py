@@ -11,6 +11,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
     def __init__(self):
         import argparse
         import os
+        import dradis
         parser = argparse.ArgumentParser()
         parser.add_argument("-f", "--file", help = "Pass a filename for this job to work on directly.")
         parser.add_argument("-l", "--fileList", help = "Pass a pickle containing a list of files to operate on.")
@@ -19,8 +20,20 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
         parser.add_argument("-v", "--verbose", help = "Run in verbose mode (indicate progress, etc.)", action = 'store_true')
         parser.add_argument("-s", "--contextRequirement", help = "Specify context sequence requirements (multiples can be passed separated by commas)")
         parser.add_argument("-e", "--contextExclusion", help = "Specify context sequence exclusions (multiples can be passed separated by commas)")
+        parser.add_argument("--maxCoverage", help = "Maximum coverage (0 for no ceiling)", default = 0, type = int)
+        parser.add_argument("--minRatio", help = "Drop loci with a ratio below this", type = float)
+        parser.add_argument("--maxRatio", help = "Drop loci with a ratio above this", type = float)
+        parser.add_argument("--contigAllow", help = "Only keep these contigs (names or patterns such as 1,2,X or GL*, separated by commas).  Names are matched with any chr dropped, as they appear in the output.")
+        parser.add_argument("--contigDeny", help = "Drop these contigs (names or patterns such as M,Un*,*_random, separated by commas).  Names are matched with any chr dropped, as they appear in the output.")
+        parser.add_argument("--regions", help = "Only keep loci inside these target regions (a BED file, or the .npz index battleStar builds from one)")
         parser.add_argument("--sampleSize", help = "Specify how many lines from both the locus list and data set should be shown", default = 10, type = int)
+        parser.add_argument("--chunkRows", help = "Number of rows to parse at a time with the columnar parser", default = 1000000, type = int)
+        parser.add_argument("-m", "--memoryCeiling", help = "Stream the file in chunks sized to stay under this much RAM (in GB), spilling accepted rows to disk as it goes", default = 0, type = float)
+        parser.add_argument("--lineByLine", help = "Use the original line by line parser instead of the columnar one", action = 'store_true')
+        parser.add_argument("-q", "--quantizeRatios", help = "Store ratios as 16-bit integers (within 7.6e-6 of the original value) to shrink the sample file", action = 'store_true')
+        parser.add_argument("--profile", help = "Run under cProfile (cpu), or cProfile and tracemalloc (memory), and leave the results in the temporary directory", choices = ["cpu", "memory"])
         rawArgs = parser.parse_args()
+        self.profile = rawArgs.profile
         if rawArgs.file and rawArgs.fileList:
             raise RuntimeError("Error: A single file and a list of files cannot both be specified for a run.  Too confusing.")
         if rawArgs.file:
@@ -39,7 +52,7 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             raise RuntimeError("No file name or file list pickle argument passed.  Nothing for me to work on.  Bored now.")
         self.minCoverage = rawArgs.minCoverage
         if rawArgs.tempdir:
-            if os.path.isdir:
+            if os.path.isdir(rawArgs.tempdir):
                 self.tempdir = rawArgs.tempdir
             else:
                 raise RuntimeError("Temporary directory not found: " + rawArgs.tempdir)
@@ -56,11 +69,26 @@ class CheckArgs():  #class that checks arguments and ultimately returns a valida
             self.contextExclusion = [item.upper() for item in self.contextExclusion]
         else:
             self.contextExclusion = []
-        if self.contextExclusion and self.contextRequirement:  #why someone would specify both an inclusion and exclusion list is beyond me, but...
-            for item in self.contextRequirement:
-                if item in self.contextExclusion:
-                    raise RuntimeError("Error, " + item + " is included in both the requirement and exclusion lists.")
+        regions = None
+        if rawArgs.regions:
+            if not os.path.isfile(rawArgs.regions):
+                raise RuntimeError("Region file not found: " + rawArgs.regions)
+            regions = dradis.RegionIndex.load(rawArgs.regions)
+        self.locusFilter = dradis.LocusFilter(self.minCoverage, rawArgs.maxCoverage, self.contextRequirement, self.contextExclusion, rawArgs.minRatio, rawArgs.maxRatio, dradis.contigList(rawArgs.contigAllow), dradis.contigList(rawArgs.contigDeny), regions)  #also catches contradictory options
         self.sampleSize = rawArgs.sampleSize
+        if rawArgs.chunkRows < 1:
+            raise RuntimeError("Chunk size must be at least one row.  We got: " + str(rawArgs.chunkRows))
+        self.chunkRows = rawArgs.chunkRows
+        if rawArgs.memoryCeiling < 0:
+            raise RuntimeError("Memory ceiling cannot be negative.  We got: " + str(rawArgs.memoryCeiling))
+        self.memoryCeiling = int(rawArgs.memoryCeiling * 1000000000)
+        self.lineByLine = rawArgs.lineByLine
+        if rawArgs.quantizeRatios:
+            self.ratioEncoding = "uint16"
+        else:
+            self.ratioEncoding = "float32"
+        if self.lineByLine and self.memoryCeiling:
+            raise RuntimeError("Error: The line by line parser reads the whole file into memory and cannot run under a memory ceiling.")
 
 class HeaderLine(object):
     
@@ -106,22 +134,7 @@ class DataLine(object):
         else:
             self.ratioLine = (self.line[self.header.indexOf("chr")].replace("chr",""), self.line[self.header.indexOf("pos")], self.line[self.header.indexOf("ratio")])
             self.locusString = (self.line[self.header.indexOf("chr")].replace("chr",""), self.line[header.indexOf("pos")], self.line[header.indexOf("pos")]//1000000)
-    
-    def hasSufficientCoverage(self, minimum):
-        if self.line[self.header.indexOf("eff_ct_count")] >= minimum:
-            return True
-        else:
-            return False
-    
-    def hasCorrectContext(self, includedContext, excludedContext):
-        context = self.line[self.header.indexOf("context")]
-        if includedContext:
-            if not context in includedContext:
-                return False
-        if excludedContext:
-            if context in includedContext:
-                return False
-        return True
+            self.filterLine = (self.line[self.header.indexOf("chr")].replace("chr",""), self.line[self.header.indexOf("pos")], self.line[self.header.indexOf("ratio")], self.line[self.header.indexOf("eff_ct_count")], self.line[self.header.indexOf("context")])  #what the locus filters look at
     
     def locusString(self):
         return 
@@ -129,21 +142,114 @@ class DataLine(object):
     def __str__(self):
         return self.rawLine
         
-def processFile(fileName):
-    import pickle
+class MemorySink(object):  #holds accepted columns in memory as compact arrays
+
+    def __init__(self):
+        self.contigNames = []
+        self.contigCodes = {}
+        self.codeChunks = []
+        self.positionChunks = []
+        self.ratioChunks = []
+
+    def encodeContigs(self, contigs):  #turns the contig name column into small integer codes so we are not holding one string per row
+        import numpy
+        names, inverse = numpy.unique(contigs.astype(str), return_inverse = True)
+        lookup = numpy.zeros(len(names), dtype = numpy.uint16)
+        for i in range(0, len(names)):
+            name = str(names[i])
+            if not name in self.contigCodes:
+                self.contigCodes[name] = len(self.contigNames)
+                self.contigNames.append(name)
+            lookup[i] = self.contigCodes[name]
+        return lookup[inverse.reshape(-1)]
+
+    def add(self, chunk):
+        self.codeChunks.append(self.encodeContigs(chunk.contig))
+        self.positionChunks.append(chunk.position)
+        self.ratioChunks.append(chunk.ratio)
+
+    def columns(self):  #returns contig codes, positions and ratios for everything accepted
+        import numpy
+        if not self.positionChunks:
+            return (numpy.zeros(0, dtype = numpy.uint16), numpy.zeros(0, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.float64))
+        return (numpy.concatenate(self.codeChunks), numpy.concatenate(self.positionChunks), numpy.concatenate(self.ratioChunks))
+
+    def remove(self):
+        pass
+
+class SpillSink(MemorySink):  #appends accepted columns to raw files on disk so that memory use does not grow with the size of the input
+
+    def __init__(self, baseName):
+        MemorySink.__init__(self)
+        self.fileNames = [baseName + ".contig.spill", baseName + ".pos.spill", baseName + ".ratio.spill"]
+        self.files = [open(fileName, 'wb') for fileName in self.fileNames]
+        self.rows = 0
+
+    def add(self, chunk):
+        import numpy
+        self.encodeContigs(chunk.contig).astype(numpy.uint16).tofile(self.files[0])
+        chunk.position.astype(numpy.int64).tofile(self.files[1])
+        chunk.ratio.astype(numpy.float64).tofile(self.files[2])
+        self.rows += len(chunk)
+
+    def columns(self):  #closes the spill files and maps them back in without reading them all into RAM
+        import numpy
+        for file in self.files:
+            file.close()
+        if not self.rows:
+            return MemorySink.columns(self)
+        dataTypes = [numpy.uint16, numpy.int64, numpy.float64]
+        return tuple([numpy.memmap(self.fileNames[i], dtype = dataTypes[i], mode = 'r', shape = (self.rows,)) for i in range(0, 3)])
+
+    def remove(self):
+        import os
+        for fileName in self.fileNames:
+            if os.path.isfile(fileName):
+                os.remove(fileName)
+
+def spillBaseName(fileName):
     import os
-    file = open(fileName, 'r')
+    if args.tempdir:
+        return args.tempdir + os.sep + "filter1" + os.sep + fileName.split(os.sep)[-1]
+    return fileName
+
+def processFileColumnar(fileName):  #reads the file in large blocks into numpy columns and filters each block with array operations
+    import tylium
+    if args.memoryCeiling:  #streaming mode: chunk size comes from the memory ceiling and accepted rows go to disk as we go
+        chunkRows = tylium.chunkRowsForMemory(args.memoryCeiling)
+        sink = SpillSink(spillBaseName(fileName))
+    else:
+        chunkRows = args.chunkRows
+        sink = MemorySink()
+    rowsRead = 0
+    acceptedCount = 0
+    for chunk in tylium.readRatioChunks(fileName, chunkRows):
+        rowsRead += chunk.rawRows
+        chunk = args.locusFilter.apply(chunk)
+        acceptedCount += len(chunk)
+        sink.add(chunk)
+        if args.verbose:
+            print("Processed " + str(rowsRead) + " lines.  Accepted " + str(acceptedCount) + " lines.                ", end = "\r")
+    recorder.count("rowsRead", rowsRead)
+    recorder.count("rowsAccepted", acceptedCount)
+    if args.verbose:
+        print("Processed " + str(rowsRead) + " lines.  Accepted " + str(acceptedCount) + " lines.                ")
+    return sink
+
+def processFileLineByLine(fileName):
+    import tylium
+    file = tylium.openRatioFile(fileName)
     wholeFile = file.read()
     file.close()
     wholeFile.strip()
     wholeFileLines = wholeFile.split("\n")
     del wholeFile
-    acceptedLines = []
-    observedLociList = []
+    parsedLines = []
+    badLines = 0
     totalLines = len(wholeFileLines)
     for i in range(0, totalLines):
         if args.verbose and i % 10000 == 0:
-            print("Processed " + str(i) + " of " + str(totalLines) + " lines.  Accepted " + str(len(acceptedLines)) + " lines.                ", end = "\r")
+            print("Parsed " + str(i) + " of " + str(totalLines) + " lines.                ", end = "\r")
         if i == 0:
             headerLine = HeaderLine(wholeFileLines[i])
         else:
@@ -151,44 +257,52 @@ def processFile(fileName):
             if rawDataLine:
                 dataLine = DataLine(rawDataLine, headerLine)
                 if dataLine.isBadLine:
-                    continue
-                if dataLine.hasSufficientCoverage(args.minCoverage) and dataLine.hasCorrectContext(args.contextRequirement, args.contextExclusion) :
-                    acceptedLines.append(dataLine)
-                    observedLociList.append(dataLine.locusString)
+                    badLines += 1
+                else:
+                    parsedLines.append(dataLine.filterLine)
     del wholeFileLines
+    chunk = tylium.chunkFromRows(parsedLines, len(parsedLines) + badLines)  #filtered with the same predicates as the columnar parser
+    del parsedLines
+    recorder.count("rowsRead", chunk.rawRows)
+    chunk = args.locusFilter.apply(chunk)
+    recorder.count("rowsAccepted", len(chunk))
     if args.verbose:
-        print("Processed " + str(i) + " of " + str(totalLines) + " lines.  Accepted " + str(len(acceptedLines)) + " lines.                ", end = "\r")
-        # print("Chr   Pos     Ratio")
-        # for i in range(0,args.sampleSize):
-        #     print(acceptedLines[i].ratioLine)
-        # print("Chr   Pos     Subgroup")
-        # for i in range(0,args.sampleSize):
-        #     print(observedLociList[i])
-    dataPickleName = fileName + ".data.pkl"
-    locusPickleName = fileName + ".loci.pkl"
-    acceptedLineMatrix = []
-    for line in acceptedLines:
-        acceptedLineMatrix.append(line.ratioLine)
-    del acceptedLines
+        print("Parsed " + str(i) + " of " + str(totalLines) + " lines.  Accepted " + str(len(chunk)) + " lines.                ", end = "\r")
+    sink = MemorySink()  #pack the accepted lines into the same columns the columnar parser produces
+    sink.add(chunk)
+    return sink
+
+def outputFileName(fileName):
+    import os
+    import colonialOne
+    sampleFileName = fileName + colonialOne.sampleSuffix
     if args.tempdir:
         if not os.path.isdir(args.tempdir):
             raise RuntimeError("Unable to find temporary directory: " + args.tempdir)
-        dataPickleName = args.tempdir + os.sep + "filter1" + os.sep + dataPickleName.split(os.sep)[-1]
-        locusPickleName = args.tempdir + os.sep + "loci" + os.sep + locusPickleName.split(os.sep)[-1]
+        sampleFileName = args.tempdir + os.sep + "filter1" + os.sep + sampleFileName.split(os.sep)[-1]
+    return sampleFileName
+
+def processFile(fileName):
+    import colonialOne
+    recorder.readFile(fileName)
+    if args.lineByLine:
+        sink = processFileLineByLine(fileName)
     else:
-        tempdir = ""
-    dataPickle = open(dataPickleName, 'wb')
-    pickle.dump(acceptedLineMatrix, dataPickle)
-    dataPickle.close()
-    locusPickle = open(locusPickleName, 'wb')
-    pickle.dump(observedLociList, locusPickle)
-    locusPickle.close()
+        sink = processFileColumnar(fileName)
+    args.locusFilter.reportTo(recorder)
+    codes, positions, ratios = sink.columns()
+    colonialOne.writeSample(outputFileName(fileName), sink.contigNames, codes, positions, ratios, ratioEncoding = args.ratioEncoding)
+    recorder.wroteFile(outputFileName(fileName))
+    del codes, positions, ratios
+    sink.remove()
     
 def main():
-    import pickle
     import datetime
+    import flightRecorder
     global args
     args = CheckArgs()
+    global recorder
+    recorder = flightRecorder.FlightRecorder("viper", args.tempdir, args.profile)
     if args.verbose:
         start = datetime.datetime.now()
     if args.file:
@@ -196,6 +310,7 @@ def main():
     else:
         for fileName in args.fileList:
             processFile(fileName)
+    recorder.finish()
     if args.verbose:
         runtime = datetime.datetime.now() - start
         print("Coverage filtering and data extraction process complete in " + str(runtime))